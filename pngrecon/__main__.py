@@ -1,39 +1,57 @@
-import pngrecon.commands.info
-import pngrecon.commands.encode
-import pngrecon.commands.decode
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from importlib import import_module
+import sys
 
 
 PNG_RECON_VERSION = '0.2.1'
 
+# Names of the subcommands we know about. Each one lives in a module of the
+# same name (with underscores for dashes) in pngrecon.commands and provides
+# gen_parser(sub_p) and main(args). The modules are only imported when they
+# are needed so that starting up for one command doesn't pay for the imports
+# of all the others.
+COMMANDS = (
+    'info', 'encode', 'decode', 'append', 'verify', 'index', 'find',
+    'serve', 'train-dict', 'bench', 'compare', 'carve')
 
-def create_parser():
+
+def get_command_module(command):
+    ''' Import and return the module implementing the given subcommand '''
+    assert command in COMMANDS
+    return import_module('pngrecon.commands.' + command.replace('-', '_'))
+
+
+def create_parser(commands=COMMANDS):
+    ''' Create the argument parser with subparsers for the given commands. By
+    default all commands are registered, which is needed for top-level help
+    output to list them all. '''
     p = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     sub_p = p.add_subparsers(dest='command')
-    pngrecon.commands.info.gen_parser(sub_p)
-    pngrecon.commands.encode.gen_parser(sub_p)
-    pngrecon.commands.decode.gen_parser(sub_p)
+    for command in commands:
+        get_command_module(command).gen_parser(sub_p)
     return p
 
 
+def requested_command(argv):
+    ''' Return the subcommand named on the command line, or None if there
+    isn't a known one. The top-level parser has no options of its own besides
+    help, so the command is always the first argument. '''
+    if len(argv) and argv[0] in COMMANDS:
+        return argv[0]
+    return None
+
+
 def main():
-    parser = create_parser()
+    command = requested_command(sys.argv[1:])
+    if command is None:
+        parser = create_parser()
+    else:
+        parser = create_parser(commands=[command])
     args = parser.parse_args()
-    def_args = [args]
-    def_kwargs = {}
-    known_commands = {
-        'info': {'f': pngrecon.commands.info.main,
-                 'a': def_args, 'kw': def_kwargs},
-        'encode': {'f': pngrecon.commands.encode.main,
-                   'a': def_args, 'kw': def_kwargs},
-        'decode': {'f': pngrecon.commands.decode.main,
-                   'a': def_args, 'kw': def_kwargs},
-    }
     try:
-        if args.command not in known_commands:
+        if args.command not in COMMANDS:
             parser.print_help()
         else:
-            comm = known_commands[args.command]
-            exit(comm['f'](*comm['a'], **comm['kw']))
+            exit(get_command_module(args.command).main(args))
     except KeyboardInterrupt:
         print('')
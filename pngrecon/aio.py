@@ -0,0 +1,214 @@
+''' Encode and decode over asyncio streams, for services that handle many
+transfers at once.
+
+    reader, writer = await asyncio.open_connection(...)
+    await pngrecon.aio.encode(reader, writer, password=b'hunter2')
+
+Only reading and writing happen on the event loop. Everything CPU-heavy
+(compressing, deriving keys, encrypting, hashing, CRCs) is done on an
+executor, shared by all transfers unless one is given. Each transfer only
+reads more once what it already read has been written out (and the writer
+drained), so a slow reader or writer holds up its own transfer instead of
+letting data pile up in memory. Each transfer holds a few buffer_max_bytes at
+most.
+
+Errors are raised as PngreconError. '''
+from .commands.decode import (StreamDecoder, SPILL_MAX_BYTES)
+from .commands.encode import (get_basic_source_image_chunks, new_compressor)
+from .lib.chunk import (Chunk, ChunkType, CompressMethod, EncodingType)
+from .lib.chunk import (EncryptionType, IndexChunk, DataChunk)
+from .lib.chunk import (CryptInfoChunk, ManifestChunk, ZDictChunk)
+from .lib.chunk import (PNG_SIG, TARGET_MAX_BUFFER_BYTES)
+from .lib.fingerprint import (Fingerprinter, fingerprint_key)
+from .lib.zdict import zdict_digest
+from .util.crypto import (gen_key, encrypt)
+from .util.crypto import key_check_value
+from .util.log import FailHard
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+import asyncio
+import hashlib
+import struct
+
+# Much smaller than the command line tool's default, since there may be
+# hundreds of transfers going at once
+AIO_BUFFER_MAX_BYTES = 1024 * 1024  # 1 MiB
+# Big enough for images made by the command line tool with its defaults
+MAX_CHUNK_BYTES = TARGET_MAX_BUFFER_BYTES + 64 * 1024
+
+_default_executor = None
+
+
+class PngreconError(Exception):
+    pass
+
+
+def get_default_executor():
+    ''' Return the executor shared by all transfers not given their own '''
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = ThreadPoolExecutor(
+            thread_name_prefix='pngrecon-aio')
+    return _default_executor
+
+
+async def _run(executor, func, *a):
+    ''' Call func on the executor and return its result, turning fail_hard
+    into PngreconError '''
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, partial(func, *a))
+    except FailHard as e:
+        raise PngreconError(e.message) from None
+
+
+async def _run_gen(executor, gen, writer):
+    ''' Step through the generator on the executor, writing out each item it
+    yields before asking it for the next one '''
+    while True:
+        b = await _run(executor, next, gen, None)
+        if b is None:
+            return
+        writer.write(b)
+        await writer.drain()
+
+
+def _make_data_chunk(fernet, index, data, digests):
+    if fernet is not None:
+        data = encrypt(fernet, data)
+    chunk = DataChunk(index, data)
+    if digests is not None:
+        digests[index] = hashlib.sha256(
+            memoryview(chunk.raw_data)[8:8+chunk.length]).digest()
+    return chunk
+
+
+async def encode(reader, writer, compress_method=CompressMethod.No,
+                 password=None, buffer_max_bytes=AIO_BUFFER_MAX_BYTES,
+                 index_first=True, manifest=False, executor=None,
+                 zdict=None, fingerprint=True, key_check=False):
+    ''' Read everything from the asyncio StreamReader reader and write a PNG
+    storing it to the StreamWriter writer, like `pngrecon encode`. The data is
+    encrypted if a password (bytes) is given, with a key check value like
+    `encode --key-check` if key_check is set, and compressed with the preset
+    dictionary zdict (bytes) if one is given. The index chunk goes first by
+    default so the image can be decoded as it streams in, and the data's
+    fingerprint is stored unless told not to. The writer is not closed. '''
+    if zdict is not None and compress_method != CompressMethod.Zlib:
+        raise PngreconError('Only zlib can compress with a dictionary')
+    executor = executor or get_default_executor()
+    source = get_basic_source_image_chunks()
+    writer.write(PNG_SIG + b''.join(c.raw_data for c in source[:-1]))
+    fernet = None
+    encryption_type = EncryptionType.No
+    if password is not None:
+        salt, fernet = await _run(executor, gen_key, password)
+        encryption_type = EncryptionType.SaltedPass01
+        writer.write(CryptInfoChunk(
+            salt, key_check_value(fernet) if key_check else None).raw_data)
+    if zdict is not None:
+        writer.write(ZDictChunk(zdict_digest(zdict)).raw_data)
+    generation = 0
+    if index_first:
+        writer.write(IndexChunk(EncodingType.SingleFile, encryption_type,
+                                compress_method, 0, generation).raw_data)
+        generation += 1
+    await writer.drain()
+    digests = {} if manifest else None
+    compressor = new_compressor(compress_method, zdict)
+    fingerprinter = Fingerprinter(fingerprint_key(fernet)) \
+        if fingerprint else None
+    pending = bytearray()
+    n = 0
+
+    async def write_data_chunks(final):
+        nonlocal n
+        while len(pending) >= buffer_max_bytes or (final and len(pending)):
+            data = bytes(pending[:buffer_max_bytes])
+            del pending[:buffer_max_bytes]
+            chunk = await _run(
+                executor, _make_data_chunk, fernet, n, data, digests)
+            writer.write(chunk.raw_data)
+            await writer.drain()
+            n += 1
+
+    while True:
+        b = await reader.read(buffer_max_bytes)
+        if not len(b):
+            break
+        if fingerprinter is not None:
+            await _run(executor, fingerprinter.update, b)
+        if compressor is not None:
+            b = await _run(executor, compressor.compress, b)
+        pending += b
+        await write_data_chunks(final=False)
+    if compressor is not None:
+        pending += await _run(executor, compressor.flush)
+    await write_data_chunks(final=True)
+    if manifest:
+        writer.write(ManifestChunk(digests).raw_data)
+    if fingerprinter is not None:
+        writer.write(fingerprinter.chunk(n).raw_data)
+    writer.write(IndexChunk(EncodingType.SingleFile, encryption_type,
+                            compress_method, n, generation).raw_data)
+    writer.write(source[-1].raw_data)
+    await writer.drain()
+
+
+async def _skip(reader, count):
+    ''' Read and throw away count bytes without holding on to them '''
+    while count > 0:
+        b = await reader.read(min(count, AIO_BUFFER_MAX_BYTES))
+        if not len(b):
+            raise PngreconError('Truncated chunk')
+        count -= len(b)
+
+
+async def decode(reader, writer, password=None,
+                 spill_max_bytes=SPILL_MAX_BYTES,
+                 max_chunk_bytes=MAX_CHUNK_BYTES,
+                 buffer_max_bytes=AIO_BUFFER_MAX_BYTES, executor=None,
+                 zdict=None):
+    ''' Read a PNG from the asyncio StreamReader reader and write the data
+    stored in it to the StreamWriter writer, like `pngrecon decode` does with
+    a pipe. Chunks that aren't ours are skipped over without being kept, and
+    ours may be at most max_chunk_bytes long. If the data was compressed with
+    a preset dictionary, zdict must be it. The writer is not closed. '''
+    executor = executor or get_default_executor()
+    try:
+        sig = await reader.readexactly(len(PNG_SIG))
+    except asyncio.IncompleteReadError:
+        sig = None
+    if sig != PNG_SIG:
+        raise PngreconError('Input does not appear to be a PNG')
+    decoder = StreamDecoder(password, spill_max_bytes, buffer_max_bytes,
+                            zdict=zdict)
+    while True:
+        try:
+            header = await reader.readexactly(8)
+        except asyncio.IncompleteReadError as e:
+            if len(e.partial):
+                raise PngreconError('Truncated chunk header') from None
+            break
+        chunk_len, chunk_type = struct.unpack('>I4s', header)
+        chunk_type = ChunkType.from_string(str(chunk_type, 'utf-8', 'replace'))
+        if chunk_type is None:
+            await _skip(reader, chunk_len + 4)
+            continue
+        if chunk_len > max_chunk_bytes:
+            raise PngreconError('{} chunk of {} bytes is too big'.format(
+                chunk_type, chunk_len))
+        try:
+            rest = await reader.readexactly(chunk_len + 4)
+        except asyncio.IncompleteReadError:
+            raise PngreconError('Truncated chunk of type {}'.format(
+                chunk_type)) from None
+        chunk = await _run(
+            executor, Chunk.from_byte_stream, BytesIO(header + rest))
+        if isinstance(chunk, IndexChunk) and password is None and \
+                chunk.encryption_type != EncryptionType.No:
+            # Otherwise the key derivation would prompt for one
+            raise PngreconError('Data is encrypted but no password given')
+        await _run_gen(executor, decoder.add_chunk(chunk), writer)
+    await _run_gen(executor, decoder.finish(), writer)
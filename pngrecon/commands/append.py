@@ -0,0 +1,179 @@
+from ..lib.chunk import (ChunkType, EncodingType, EncryptionType)
+from ..lib.chunk import (IndexChunk, DataChunk, ManifestChunk)
+from ..lib.chunk import (TARGET_MAX_BUFFER_BYTES, latest_index_chunk)
+from ..lib.layout import scan_image_stream
+from ..lib.layout import (read_chunk, read_data_chunk_index)
+from ..util.log import fail_hard
+from ..util.crypto import gen_key
+from ..util.crypto import decrypt
+from ..lib.parity import add_parity_chunks
+from ..lib.zdict import (check_zdict, read_zdict)
+from .decode import check_key_check
+from .encode import (encode_data_chunks, digest_data_chunks)
+from .encode import (parse_parity, write_chunk)
+from argparse import ArgumentDefaultsHelpFormatter
+import os
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'append', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('image', type=str,
+                   help='The pngrecon image to add data to. It is modified '
+                   'in place.')
+    p.add_argument('-i', '--input', type=str, default='/dev/stdin',
+                   help='Where to read the data to append')
+    p.add_argument(
+        '--key-file', type=str, default=None,
+        help='If the data in the image is encrypted, read its key from this '
+        'file.')
+    p.add_argument(
+        '--buffer-max-bytes', type=int, default=TARGET_MAX_BUFFER_BYTES,
+        help='Target maximum nubmer of bytes to encode at once.')
+    p.add_argument(
+        '--pipeline', action='store_true', help='Read, compress, encrypt, '
+        'and write on separate threads so they overlap.')
+    p.add_argument(
+        '--parity', type=str, default=None, metavar='K:M',
+        help='Add parity chunks for the appended data chunks, like `encode '
+        '--parity`. Parity chunks already in the image keep covering the '
+        'data chunks they were made for.')
+    p.add_argument(
+        '--zdict', type=str, default=None,
+        help='If the data in the image was compressed with a preset '
+        'dictionary, the file it\'s in. The appended data is compressed with '
+        'it too.')
+
+
+def read_image_state(fname, fd):
+    ''' Find out what we need to know to append to the image open as fd
+    without reading its data chunks: the layout of all its chunks, its current
+    index chunk, its crypt info chunk (or None), the headers of its data
+    chunks mapped to their indexes, whether it has a manifest, and its
+    dictionary chunk (or None). '''
+    layout = scan_image_stream(fd)
+    if layout is None:
+        fail_hard(fname, 'does not appear to be a PNG')
+    if not len(layout) or layout[-1].type != 'IEND':
+        fail_hard('Don\'t know how to append to an image that doesn\'t end '
+                  'with IEND')
+    index_chunks = []
+    crypt_info_chunks = []
+    data_chunk_indexes = {}
+    has_manifest = False
+    zdict_chunks = []
+    for h in layout:
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type == ChunkType.Index:
+            index_chunks.append(read_chunk(fd, h))
+        elif chunk_type == ChunkType.CryptInfo:
+            crypt_info_chunks.append(read_chunk(fd, h))
+        elif chunk_type == ChunkType.Data:
+            data_chunk_indexes[h] = read_data_chunk_index(fd, h)
+        elif chunk_type == ChunkType.Manifest:
+            has_manifest = True
+        elif chunk_type == ChunkType.ZDict:
+            zdict_chunks.append(read_chunk(fd, h))
+    if not len(index_chunks):
+        fail_hard(fname, 'has no index chunk')
+    index_chunk = latest_index_chunk(index_chunks)
+    if len(data_chunk_indexes) != index_chunk.num_data_chunks:
+        fail_hard('Expected {} data chunks but there are {}'.format(
+            index_chunk.num_data_chunks, len(data_chunk_indexes)))
+    crypt_info_chunk = None
+    if index_chunk.encryption_type != EncryptionType.No:
+        if len(crypt_info_chunks) != 1:
+            fail_hard('Data is encrypted. Expected 1 crypt info chunk but '
+                      'got {}'.format(len(crypt_info_chunks)))
+        crypt_info_chunk = crypt_info_chunks[0]
+    if len(zdict_chunks) > 1:
+        fail_hard('Expected at most 1 dictionary chunk but got {}'.format(
+            len(zdict_chunks)))
+    zdict_chunk = zdict_chunks[0] if len(zdict_chunks) else None
+    return layout, index_chunk, crypt_info_chunk, data_chunk_indexes, \
+        has_manifest, zdict_chunk
+
+
+def check_key(fd, fernet, data_chunk_indexes):
+    ''' Make sure fernet can decrypt the existing data before we add data
+    encrypted with it. Only the smallest data chunk is read. '''
+    if not len(data_chunk_indexes):
+        return
+    h = min(data_chunk_indexes, key=lambda h: h.length)
+    success, msg = decrypt(fernet, read_chunk(fd, h).data)
+    if not success:
+        fail_hard('Unable to decrypt existing data:', msg)
+
+
+def main(args):
+    if not os.path.isfile(args.image):
+        fail_hard(args.image, 'must exist')
+    if not os.path.exists(args.input):
+        fail_hard(args.input, 'must exist')
+    if os.path.isdir(args.input):
+        fail_hard('Input can\'t be a directory')
+    parity = parse_parity(args.parity)
+    with open(args.image, 'r+b') as fd:
+        layout, index_chunk, crypt_info_chunk, data_chunk_indexes, \
+            has_manifest, zdict_chunk = read_image_state(args.image, fd)
+        if index_chunk.encoding_type != EncodingType.SingleFile:
+            fail_hard('Can only append to images holding a single file, not',
+                      index_chunk.encoding_type)
+        if index_chunk.encryption_type == EncryptionType.No:
+            if args.key_file:
+                fail_hard('Don\'t specify --key-file when the data isn\'t '
+                          'encrypted')
+            fernet = None
+        elif index_chunk.encryption_type == EncryptionType.SaltedPass01:
+            pw = None
+            if args.key_file:
+                with open(args.key_file, 'rb') as key_fd:
+                    pw = key_fd.read()
+            salt, fernet = gen_key(
+                password=pw, salt=crypt_info_chunk.salt,
+                for_encryption=False)
+            check_key_check(crypt_info_chunk, fernet)
+            check_key(fd, fernet, data_chunk_indexes)
+        else:
+            fail_hard('Unimplemented encryption type',
+                      index_chunk.encryption_type)
+        # The new data is compressed with the same dictionary as the rest
+        zdict = None
+        if zdict_chunk is not None:
+            zdict = read_zdict(args.zdict) if args.zdict else None
+            check_zdict(zdict_chunk, zdict)
+        elif args.zdict:
+            fail_hard('Don\'t specify --zdict when the data wasn\'t '
+                      'compressed with a dictionary')
+        start = 0
+        if len(data_chunk_indexes):
+            start = max(data_chunk_indexes.values()) + 1
+        iend = layout[-1]
+        fd.seek(iend.offset, 0)
+        iend_bytes = fd.read(iend.size)
+        # Our new chunks overwrite IEND and go wherever the file used to end.
+        # Then a new index chunk supersedes the old one, and IEND goes back.
+        # If the image has a manifest, the new data chunks get one too.
+        fd.seek(iend.offset, 0)
+        n = 0
+        digests = {}
+        with open(args.input, 'rb') as in_fd:
+            data_chunks = encode_data_chunks(
+                in_fd, args, index_chunk.compress_method, fernet, start=start,
+                zdict=zdict)
+            if has_manifest:
+                data_chunks = digest_data_chunks(data_chunks, digests)
+            if parity is not None:
+                data_chunks = add_parity_chunks(data_chunks, *parity)
+            for chunk in data_chunks:
+                write_chunk(fd, chunk)
+                if isinstance(chunk, DataChunk):
+                    n += 1
+        if has_manifest and len(digests):
+            fd.write(ManifestChunk(digests).raw_data)
+        fd.write(IndexChunk(
+            index_chunk.encoding_type, index_chunk.encryption_type,
+            index_chunk.compress_method, index_chunk.num_data_chunks + n,
+            index_chunk.generation + 1).raw_data)
+        fd.write(iend_bytes)
+        fd.truncate()
@@ -0,0 +1,327 @@
+from ..lib.layout import (read_our_chunks, scan_image_stream)
+from ..util.config import (default_config_path, read_config)
+from ..util.crypto import KeyCache
+from ..util.log import log_stderr as log
+from ..util.log import (fail_hard, log_stdout)
+from .decode import decode_to_file
+from .encode import (check_compress_level, completely_encode_stream)
+from .encode import (encode_source_and_data_chunks_together)
+from .encode import (get_basic_source_image_chunks, get_compress_method)
+from argparse import (ArgumentDefaultsHelpFormatter, Namespace)
+from collections import namedtuple
+from itertools import product
+from tempfile import TemporaryDirectory
+import multiprocessing
+import os
+import random
+import resource
+import time
+
+# Default for how much data each trial encodes and decodes
+SAMPLE_BYTES = 8 * 1024 * 1024  # 8 MiB
+# --buffer-max-bytes values tried by default: powers of 4 from 256 KiB, up to
+# half the sample so that there are always a few data chunks
+BUFFER_CANDIDATES = tuple(256 * 1024 * 4 ** i for i in range(5))
+MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024  # 1 GiB
+# Trials quicker than this are repeated until they've taken this long, and
+# the quickest run counts, so that fast settings are timed well too
+TRIAL_MIN_SECONDS = 0.5
+# Synthetic samples are text made of words from a small vocabulary, which
+# compresses about as well as typical files, with every fourth piece random
+# bytes, which don't compress at all
+SYNTHETIC_WORDS = 2000
+SYNTHETIC_PIECE_BYTES = 64 * 1024
+# Only used to encrypt samples, and never stored
+BENCH_PASSWORD = b'pngrecon bench'
+
+Settings = namedtuple(
+    'Settings', ['compress', 'level', 'buffer_max_bytes', 'pipeline'])
+# How long encoding and decoding took and how much memory they needed (see
+# measure), and how big the image was
+Result = namedtuple('Result', [
+    'encode_time', 'encode_peak', 'decode_time', 'decode_peak', 'image_size'])
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'bench', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        '-i', '--input', type=str, default=None,
+        help='Try the settings on the start of this file, ideally one like '
+        'what will be encoded. Synthetic data that compresses about as well '
+        'as typical files if not given.')
+    p.add_argument(
+        '--sample-bytes', type=int, default=SAMPLE_BYTES,
+        help='How much data each trial encodes and decodes')
+    p.add_argument(
+        '-c', '--compress', type=str, action='append', default=None,
+        choices=['no', 'gzip', 'xz'],
+        help='Try this compression. Can be given more than once. All of '
+        'them if not given, but then not compressing is usually fastest, so '
+        'give the ones worth using.')
+    p.add_argument(
+        '--compress-level', type=int, action='append', default=None,
+        help='Try this compression level. Can be given more than once. Just '
+        'the compressor\'s default if not given.')
+    p.add_argument(
+        '-e', '--encrypt', action='store_true',
+        help='Encrypt in every trial, which is slower')
+    p.add_argument(
+        '--buffer-max-bytes', type=int, action='append', default=None,
+        help='Try this --buffer-max-bytes. Can be given more than once. '
+        'Powers of 4 from 256 KiB up to half of --sample-bytes if not given.')
+    p.add_argument(
+        '--memory-budget-bytes', type=int, default=MEMORY_BUDGET_BYTES,
+        help='Only recommend settings that needed at most this much memory. '
+        'It doesn\'t grow with the size of the input.')
+    p.add_argument(
+        '--save', action='store_true',
+        help='Save the recommended settings to --config, where encode and '
+        'decode read their defaults from')
+    p.add_argument(
+        '--config', type=str, default=default_config_path(),
+        help='The settings file to save to')
+
+
+def synthetic_sample(size, seed=1):
+    ''' Return size bytes of data that compresses about as well as typical
+    files do '''
+    rand = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rand.choices(letters, k=rand.randint(2, 10)))
+             for _ in range(SYNTHETIC_WORDS)]
+    pieces = []
+    for i in range(0, size, SYNTHETIC_PIECE_BYTES):
+        if i // SYNTHETIC_PIECE_BYTES % 4 == 3:
+            pieces.append(rand.randbytes(SYNTHETIC_PIECE_BYTES))
+        else:
+            # Words average 6 letters and a space, so this is plenty
+            text = ' '.join(rand.choices(
+                words, k=SYNTHETIC_PIECE_BYTES // 6))
+            pieces.append(bytes(text, 'utf-8')[:SYNTHETIC_PIECE_BYTES])
+    return b''.join(pieces)[:size]
+
+
+def buffer_candidates(sample_len):
+    ''' The --buffer-max-bytes values to try on a sample of the given length
+    by default '''
+    return [b for b in BUFFER_CANDIDATES
+            if b == BUFFER_CANDIDATES[0] or b <= sample_len // 2]
+
+
+def measure_child(func, conn):
+    ''' Call func in this (forked) process, and send back how long it took
+    and how far it raised the peak resident set size '''
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
+    func()
+    took = time.monotonic() - start
+    # ru_maxrss is in KiB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    conn.send((took, peak * 1024))
+    conn.close()
+
+
+def measure(func):
+    ''' Call func until it's taken at least TRIAL_MIN_SECONDS altogether.
+    Return the quickest call's wall time and the most memory any of them
+    needed.
+
+    Each call is made in a forked process of its own, whose peak resident
+    set size starts out at what it was when forked, so that memory freed by
+    earlier calls can't hide what later ones need. Unlike tracing Python's
+    allocations, this counts what zlib and lzma allocate themselves. '''
+    ctx = multiprocessing.get_context('fork')
+    best = None
+    peak = 0
+    total = 0
+    while total < TRIAL_MIN_SECONDS:
+        recv, send = ctx.Pipe(duplex=False)
+        child = ctx.Process(target=measure_child, args=(func, send))
+        child.start()
+        send.close()
+        try:
+            took, run_peak = recv.recv()
+        except EOFError:
+            fail_hard('A trial failed')
+        finally:
+            recv.close()
+            child.join()
+        peak = max(peak, run_peak)
+        best = took if best is None else min(best, took)
+        total += took
+    return best, peak
+
+
+def run_trial(workdir, sample_fname, keys, settings, encrypt):
+    ''' Encode the sample with the given Settings and decode it back,
+    returning the Result '''
+    compress, level, buffer_max_bytes, use_pipeline = settings
+    image = os.path.join(workdir, 'bench.png')
+    key_file = os.path.join(workdir, 'bench.key')
+    args = Namespace(
+        output=image, source=None, encrypt=encrypt,
+        key_file=key_file if encrypt else None, key_check=False,
+        buffer_max_bytes=buffer_max_bytes, pipeline=use_pipeline,
+        index_first=False, manifest=False, parity=None, zdict=None,
+        compress_level=level, fingerprint=True)
+    compress_method = get_compress_method(compress)
+
+    def do_encode():
+        with open(sample_fname, 'rb') as fd:
+            chunks = completely_encode_stream(
+                fd, args, compress_method, gen_key=keys.gen_key)
+            encode_source_and_data_chunks_together(
+                args, get_basic_source_image_chunks(), chunks)
+
+    def do_decode():
+        with open(image, 'rb') as fd:
+            layout = scan_image_stream(fd)
+            decode_to_file(read_our_chunks(fd, layout, data_refs=True),
+                           Namespace(
+                               output=os.devnull, key_file=args.key_file,
+                               pipeline=use_pipeline,
+                               buffer_max_bytes=buffer_max_bytes, pool=None,
+                               zdict=None),
+                           gen_key=keys.gen_key)
+
+    encode_time, encode_peak = measure(do_encode)
+    decode_time, decode_peak = measure(do_decode)
+    return Result(encode_time, encode_peak, decode_time, decode_peak,
+                  os.path.getsize(image))
+
+
+def fastest(trials, what, budget):
+    ''' Return the Settings of the (Settings, Result) trial that was quickest
+    at what ('encode' or 'decode') within the memory budget, or None '''
+    fits = [t for t in trials
+            if getattr(t[1], what + '_peak') <= budget]
+    if not fits:
+        return None
+    return min(fits, key=lambda t: getattr(t[1], what + '_time'))[0]
+
+
+def recommended_settings(trials, budget):
+    ''' Return the settings for encode and decode that were fastest within
+    the memory budget. Decoding is only compared among trials of the
+    compression recommended for encoding, since that's what it'll decode. '''
+    best = fastest(trials, 'encode', budget)
+    if best is None:
+        fail_hard('None of the settings tried fit in a memory budget of',
+                  budget, 'bytes. The least any needed was', min(
+                      t[1].encode_peak for t in trials), 'bytes.')
+    encode_settings = {
+        'compress': best.compress, 'compress_level': best.level,
+        'buffer_max_bytes': best.buffer_max_bytes,
+        'pipeline': best.pipeline}
+    best = fastest([t for t in trials if t[0].compress == best.compress and
+                    t[0].level == best.level], 'decode', budget)
+    if best is None:
+        return encode_settings, None
+    decode_settings = {
+        'buffer_max_bytes': best.buffer_max_bytes, 'pipeline': best.pipeline}
+    return encode_settings, decode_settings
+
+
+def update_config(conf, command, settings):
+    ''' Set the settings for the command in conf, removing ones that are None
+    so that the command's own default applies '''
+    if not conf.has_section(command):
+        conf.add_section(command)
+    for key, value in settings.items():
+        if value is None:
+            conf.remove_option(command, key)
+        else:
+            conf.set(command, key, str(value))
+
+
+def print_trial(settings, result, sample_len):
+    log_stdout(
+        '{:<8} {:>5} {:>16} {:<8} {:>11.1f} {:>10.1f} {:>11.1f} {:>10.1f} '
+        '{:>6.1%}'.format(
+            settings.compress, '-' if settings.level is None else
+            settings.level, settings.buffer_max_bytes,
+            str(settings.pipeline), sample_len / result.encode_time / 1e6,
+            result.encode_peak / 1024 / 1024,
+            sample_len / result.decode_time / 1e6,
+            result.decode_peak / 1024 / 1024,
+            result.image_size / sample_len), flush=True)
+
+
+def main(args):
+    if args.input is not None and not os.path.isfile(args.input):
+        fail_hard(args.input, 'must be a file')
+    if args.sample_bytes < 1:
+        fail_hard('--sample-bytes must be positive')
+    if args.buffer_max_bytes and min(args.buffer_max_bytes) < 1:
+        fail_hard('--buffer-max-bytes must be positive')
+    compresses = args.compress or ['no', 'gzip', 'xz']
+    levels = args.compress_level or [None]
+    for level in levels:
+        check_compress_level(level)
+    if args.input is not None:
+        with open(args.input, 'rb') as fd:
+            sample = fd.read(args.sample_bytes)
+        if not len(sample):
+            fail_hard(args.input, 'is empty')
+    else:
+        sample = synthetic_sample(args.sample_bytes)
+    buffers = args.buffer_max_bytes or buffer_candidates(len(sample))
+    candidates = []
+    for compress in compresses:
+        # Not compressing has no levels
+        for level in levels if compress != 'no' else [None]:
+            for settings in product(
+                    [compress], [level], buffers, [False, True]):
+                settings = Settings(*settings)
+                if settings not in candidates:
+                    candidates.append(settings)
+    keys = KeyCache()
+    # Derive the key up front so it isn't counted against the first trial
+    keys.gen_key(BENCH_PASSWORD)
+    log('Trying', len(candidates), 'settings on', len(sample), 'bytes of',
+        args.input or 'synthetic data')
+    log_stdout(
+        '{:<8} {:>5} {:>16} {:<8} {:>11} {:>10} {:>11} {:>10} {:>6}'.format(
+            'compress', 'level', 'buffer_max_bytes', 'pipeline',
+            'encode MB/s', 'encode MiB', 'decode MB/s', 'decode MiB',
+            'size'))
+    trials = []
+    with TemporaryDirectory(prefix='pngrecon-bench-') as workdir:
+        sample_fname = os.path.join(workdir, 'sample')
+        with open(sample_fname, 'wb') as fd:
+            fd.write(sample)
+        with open(os.path.join(workdir, 'bench.key'), 'wb') as fd:
+            fd.write(BENCH_PASSWORD)
+        sample_len = len(sample)
+        # Trials run in forked processes, which shouldn't start out holding
+        # the sample
+        del sample
+        for settings in candidates:
+            result = run_trial(
+                workdir, sample_fname, keys, settings, args.encrypt)
+            print_trial(settings, result, sample_len)
+            trials.append((settings, result))
+    encode_settings, decode_settings = recommended_settings(
+        trials, args.memory_budget_bytes)
+    conf = read_config(args.config if args.save else None)
+    update_config(conf, 'encode', encode_settings)
+    if decode_settings is not None:
+        update_config(conf, 'decode', decode_settings)
+    log_stdout('')
+    log_stdout('Fastest within a memory budget of', args.memory_budget_bytes,
+               'bytes:')
+    log_stdout('')
+    for command in ('encode', 'decode'):
+        if conf.has_section(command):
+            log_stdout('[{}]'.format(command))
+            for key, value in conf.items(command):
+                log_stdout(key, '=', value)
+            log_stdout('')
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.config)),
+                    exist_ok=True)
+        with open(args.config, 'w') as fd:
+            conf.write(fd)
+        log('Saved to', args.config + ', where encode and decode read their '
+            'defaults from')
@@ -0,0 +1,99 @@
+from ..lib.carve import CARVE_REGION_BYTES
+from ..lib.carve import (outermost_images, salvage_runs, scan_region)
+from ..lib.chunk import PNG_SIG
+from ..util.fastcopy import copy_file_object_range
+from ..util.log import log_stderr as log
+from ..util.log import (log_stdout, fail_hard)
+from argparse import ArgumentDefaultsHelpFormatter
+import mmap
+import os
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'carve', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        'input', type=str, help='The file to search, like a disk image or a '
+        'tar archive. It may be a block device.')
+    p.add_argument(
+        '-o', '--output', type=str, default=None,
+        help='Extract what\'s found into this directory, each image named '
+        'after the offset it was found at. Only list it if not given.')
+    p.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='Number of worker processes searching different regions of the '
+        'input at the same time')
+    p.add_argument(
+        '--region-bytes', type=int, default=CARVE_REGION_BYTES,
+        help='How much of the input each worker searches at a time')
+    p.add_argument(
+        '--all', action='store_true',
+        help='Also extract whole PNGs that have no pngrecon data')
+
+
+def scan(fname, size, region_bytes, jobs):
+    ''' Search the whole file a region at a time, on jobs worker processes.
+    Return all the CarvedImages and chunk offsets found, in order. '''
+    starts = list(range(0, size, region_bytes))
+    ends = [min(size, start + region_bytes) for start in starts]
+    if jobs > 1:
+        # only imported when needed, to keep startup fast
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(
+                scan_region, [fname] * len(starts), starts, ends))
+    else:
+        results = list(map(scan_region, [fname] * len(starts), starts, ends))
+    images = []
+    tags = []
+    # Regions are in order and don't overlap, so neither do their results
+    for region_images, region_tags in results:
+        images.extend(region_images)
+        tags.extend(region_tags)
+    return images, tags
+
+
+def extract(in_fd, out_fname, start, end, prefix=b''):
+    with open(out_fname, 'wb') as out_fd:
+        out_fd.write(prefix)
+        copy_file_object_range(in_fd, out_fd, start, end)
+
+
+def main(args):
+    if not os.path.exists(args.input):
+        fail_hard(args.input, 'must exist')
+    if os.path.isdir(args.input):
+        fail_hard(args.input, 'can\'t be a directory')
+    if args.jobs < 1:
+        fail_hard('--jobs must be positive')
+    if args.region_bytes < len(PNG_SIG):
+        fail_hard('--region-bytes must be at least', len(PNG_SIG))
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    with open(args.input, 'rb') as in_fd:
+        size = in_fd.seek(0, 2)
+        if not size:
+            fail_hard(args.input, 'is empty')
+        images, tags = scan(args.input, size, args.region_bytes, args.jobs)
+        images = outermost_images(images)
+        with mmap.mmap(in_fd.fileno(), size, access=mmap.ACCESS_READ) as buf:
+            runs = salvage_runs(buf, size, images, tags)
+        found = [(image.start, image.end, 'image' if image.ours else 'png',
+                  '') for image in images if image.ours or args.all]
+        # Runs of chunks get a signature of their own so that they can be
+        # read like any image
+        found += [(run.start, run.end, 'salvaged', '-salvaged')
+                  for run in runs]
+        for start, end, kind, suffix in sorted(found):
+            if args.output is None:
+                log_stdout(start, end - start, kind)
+                continue
+            out_fname = os.path.join(
+                args.output, '{}{}.png'.format(start, suffix))
+            extract(in_fd, out_fname, start, end,
+                    prefix=PNG_SIG if kind == 'salvaged' else b'')
+            log_stdout(start, end - start, kind, out_fname)
+    num_ours = sum(image.ours for image in images)
+    log('Found', num_ours, 'pngrecon images,', len(images) - num_ours,
+        'other PNGs, and', len(runs), 'runs of chunks outside any whole image '
+        'in', size, 'bytes')
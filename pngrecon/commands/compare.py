@@ -0,0 +1,186 @@
+from ..lib.catalog import (default_catalog_path, lookup_layout)
+from ..lib.chunk import (ChunkType, EncryptionType)
+from ..lib.chunk import latest_index_chunk
+from ..lib.chunk import TARGET_MAX_BUFFER_BYTES
+from ..lib.fingerprint import (fingerprint_digest_type, fingerprint_key)
+from ..lib.fingerprint import fingerprint_stream
+from ..lib.layout import (read_chunk, scan_image_stream)
+from ..util.crypto import gen_key
+from ..util.log import log_stderr as log
+from ..util.log import (log_stdout, fail_hard)
+from .append import check_key
+from .decode import (check_key_check, decode_to_file, get_password)
+from .decode import read_chunks_to_decode
+from argparse import (ArgumentDefaultsHelpFormatter, Namespace)
+import os
+import stat
+
+
+class Different(Exception):
+    ''' Raised by FileComparer as soon as what's written to it differs '''
+    pass
+
+
+class FileComparer():
+    ''' A write-only file-like object that checks what's written to it
+    against what's next in the file open as fd instead of storing it '''
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, b):
+        if self.fd.read(len(b)) != b:
+            raise Different()
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        ''' Once everything has been written, make sure that was all of fd '''
+        if len(self.fd.read(1)):
+            raise Different()
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'compare', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('file', type=str, help='The local file')
+    p.add_argument('image', type=str, help='The pngrecon image')
+    p.add_argument(
+        '--key-file', type=str, default=None,
+        help='If the data in the image is encrypted, read its key from this '
+        'file. Its fingerprint is keyed with it.')
+    p.add_argument(
+        '--decode', action='store_true',
+        help='If the image has no fingerprint, or data was appended to it '
+        'after it was taken, decode the image and compare the data instead '
+        'of failing')
+    p.add_argument(
+        '--catalog', type=str, default=default_catalog_path(),
+        help='If this catalog (see `index`) has an up to date entry for the '
+        'image, use it to seek straight to our chunks. Give an empty string '
+        'to not use a catalog.')
+    p.add_argument(
+        '--pool', type=str, default=None,
+        help='With --decode, the pool the image\'s blocks are in, if it was '
+        'encoded with --pool')
+    p.add_argument(
+        '--zdict', type=str, default=None,
+        help='With --decode, the preset dictionary the data was compressed '
+        'with, if any')
+
+
+def read_image_state(fname, fd, layout):
+    ''' Return the current index chunk, crypt info chunk (or None), and
+    fingerprint chunk (or None) of the image open as fd, and the headers of
+    its data chunks, without reading any of those '''
+    index_chunks = []
+    crypt_info_chunks = []
+    fingerprint_chunks = []
+    data_headers = []
+    for h in layout:
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type == ChunkType.Index:
+            index_chunks.append(read_chunk(fd, h))
+        elif chunk_type == ChunkType.CryptInfo:
+            crypt_info_chunks.append(read_chunk(fd, h))
+        elif chunk_type == ChunkType.Fingerprint:
+            fingerprint_chunks.append(read_chunk(fd, h))
+        elif chunk_type == ChunkType.Data:
+            data_headers.append(h)
+    if not len(index_chunks):
+        fail_hard(fname, 'has no index chunk')
+    index_chunk = latest_index_chunk(index_chunks)
+    crypt_info_chunk = None
+    if index_chunk.encryption_type != EncryptionType.No:
+        if len(crypt_info_chunks) != 1:
+            fail_hard('Data is encrypted. Expected 1 crypt info chunk but '
+                      'got {}'.format(len(crypt_info_chunks)))
+        crypt_info_chunk = crypt_info_chunks[0]
+    if len(fingerprint_chunks) > 1:
+        fail_hard('Expected at most 1 fingerprint chunk but got {}'.format(
+            len(fingerprint_chunks)))
+    fingerprint_chunk = fingerprint_chunks[0] \
+        if len(fingerprint_chunks) else None
+    return index_chunk, crypt_info_chunk, fingerprint_chunk, data_headers
+
+
+def file_size(fd):
+    ''' Return the size of the file open as fd, or None if it isn't a regular
+    file and can't tell '''
+    st = os.fstat(fd.fileno())
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def compare_fingerprint(args, fd, in_fd, crypt_info_chunk,
+                        fingerprint_chunk, data_headers):
+    ''' Return whether the file open as in_fd has the fingerprint the image
+    open as fd has. If the sizes differ, that's all that's needed. '''
+    size = file_size(in_fd)
+    if size is not None and size != fingerprint_chunk.size:
+        return False
+    fernet = None
+    if crypt_info_chunk is not None:
+        pw = get_password(args)
+        _, fernet = gen_key(password=pw, salt=crypt_info_chunk.salt,
+                            for_encryption=False)
+        # A wrong key would just make a different hash
+        check_key_check(crypt_info_chunk, fernet)
+        check_key(fd, fernet, dict.fromkeys(data_headers))
+    key = fingerprint_key(fernet)
+    if fingerprint_chunk.digest_type != fingerprint_digest_type(key):
+        fail_hard('Unexpected fingerprint digest type',
+                  fingerprint_chunk.digest_type)
+    fingerprinter = fingerprint_stream(in_fd, key)
+    return fingerprinter.size == fingerprint_chunk.size and \
+        fingerprinter.hash.digest() == fingerprint_chunk.digest
+
+
+def compare_decoded(args, fd, in_fd, layout):
+    ''' Return whether the file open as in_fd has the data the image open as
+    fd has, by decoding it. Stops at the first difference. '''
+    decode_args = Namespace(
+        output=None, key_file=args.key_file, pipeline=False,
+        buffer_max_bytes=TARGET_MAX_BUFFER_BYTES, pool=args.pool,
+        zdict=args.zdict)
+    comparer = FileComparer(in_fd)
+    try:
+        decode_to_file(read_chunks_to_decode(fd, layout), decode_args,
+                       out_fd=comparer)
+        comparer.finish()
+    except Different:
+        return False
+    return True
+
+
+def main(args):
+    if not os.path.isfile(args.image):
+        fail_hard(args.image, 'must exist')
+    if not os.path.exists(args.file):
+        fail_hard(args.file, 'must exist')
+    if os.path.isdir(args.file):
+        fail_hard(args.file, 'can\'t be a directory')
+    with open(args.image, 'rb') as fd, open(args.file, 'rb') as in_fd:
+        layout = lookup_layout(args.catalog, args.image)
+        if layout is None:
+            layout = scan_image_stream(fd)
+        if layout is None:
+            fail_hard(args.image, 'does not appear to be a PNG')
+        index_chunk, crypt_info_chunk, fingerprint_chunk, data_headers = \
+            read_image_state(args.image, fd, layout)
+        if fingerprint_chunk is not None and \
+                fingerprint_chunk.num_data_chunks == \
+                index_chunk.num_data_chunks:
+            same = compare_fingerprint(
+                args, fd, in_fd, crypt_info_chunk, fingerprint_chunk,
+                data_headers)
+        else:
+            why = 'has no fingerprint' if fingerprint_chunk is None else \
+                'has had data appended since its fingerprint was taken'
+            if not args.decode:
+                fail_hard(args.image, why + '. Give --decode to compare by '
+                          'decoding it.')
+            log(args.image, why + ', so decoding it')
+            same = compare_decoded(args, fd, in_fd, layout)
+    log_stdout('same' if same else 'different')
+    return 0 if same else 1
@@ -1,14 +1,36 @@
-from ..lib.chunk import read_image_stream
-from ..lib.chunk import (ChunkType, EncryptionType, CompressMethod)
+from ..lib import blocks
+from ..lib.catalog import (default_catalog_path, lookup_layout)
+from ..lib.chunk import iter_image_stream
+from ..lib.chunk import (ChunkType, EncodingType, EncryptionType)
+from ..lib.chunk import CompressMethod
 from ..lib.chunk import (IndexChunk, DataChunk, CryptInfoChunk)
+from ..lib.chunk import (FingerprintChunk, ZDictChunk)
+from ..lib.chunk import latest_index_chunk
+from ..lib.chunk import (PNG_SIG, TARGET_MAX_BUFFER_BYTES)
+from ..lib.layout import (read_chunk, read_our_chunks, scan_image_stream)
+from ..lib.layout import DataChunkRef
+from ..lib.parity import read_repaired_chunks
+from ..lib.zdict import (check_zdict, read_zdict)
+from ..util.config import set_config_defaults
+from ..util.log import log_stderr as log
 from ..util.log import fail_hard
-from ..util.crypto import gen_key
-from ..util.crypto import decrypt
+from ..util.fastcopy import (copy_file_object_range, crc32_range)
+from ..util.crypto import (gen_key, KeyCache)
+from ..util.crypto import (decrypt, key_check_matches)
+from ..util.pipeline import (pipeline, ThreadedIterator)
 from argparse import ArgumentDefaultsHelpFormatter
+from contextlib import nullcontext
+from functools import partial
+from io import BytesIO
+from tempfile import TemporaryFile
+import hashlib
+import struct
 import zlib
-import lzma
 import os
 
+# Default for how much out-of-order data a streaming decode may hold on to
+SPILL_MAX_BYTES = 1024 * 1024 * 1024  # 1 GiB
+
 
 def gen_parser(sub_p):
     p = sub_p.add_parser(
@@ -18,9 +40,46 @@ def gen_parser(sub_p):
     p.add_argument('-o', '--output', type=str, default='/dev/stdout',
                    help='Where to write data')
     p.add_argument(
-        '--key-file', type=str, default=None,
+        '--key-file', type=str, action='append', default=None,
         help='If the data was encrypted, read decryption key  '
-        'from this file.')
+        'from this file. Give it more than once to try several, and the '
+        'one that\'s right is used.')
+    p.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='With several --key-file, how many of their keys to derive at '
+        'the same time')
+    p.add_argument(
+        '--embed', type=str, default='chunks', choices=['chunks', 'lsb'],
+        help='Where the data was put when encoding. See `encode -h`.')
+    p.add_argument(
+        '--pipeline', action='store_true', help='Decrypt, decompress, and '
+        'write on separate threads so they overlap.')
+    p.add_argument(
+        '--stream', action='store_true', help='Decode in one pass as chunks '
+        'are read instead of reading the whole image first. This is always '
+        'done when the input is a pipe.')
+    p.add_argument(
+        '--buffer-max-bytes', type=int, default=TARGET_MAX_BUFFER_BYTES,
+        help='Target maximum number of decoded bytes to hold at once. Data '
+        'chunks are read one at a time, so their size matters too.')
+    p.add_argument(
+        '--spill-max-bytes', type=int, default=SPILL_MAX_BYTES,
+        help='When streaming, the most data that may be held in a temporary '
+        'file while waiting for the chunks needed to decode it.')
+    p.add_argument(
+        '--catalog', type=str, default=default_catalog_path(),
+        help='If this catalog (see `index`) has an up to date entry for the '
+        'input, use it to seek straight to our chunks instead of reading the '
+        'whole image. Give an empty string to not use a catalog.')
+    p.add_argument(
+        '--pool', type=str, default=None,
+        help='If the data was encoded with --pool, the pool its blocks are '
+        'in.')
+    p.add_argument(
+        '--zdict', type=str, default=None,
+        help='If the data was compressed with a preset dictionary, the file '
+        'it\'s in.')
+    set_config_defaults(p, 'decode')
 
 
 def keep_and_parse_our_chunks(chunks):
@@ -44,9 +103,17 @@ def validate_chunk_set(chunks):
     index_chunks = [c for c in chunks if isinstance(c, IndexChunk)]
     if len(index_chunks) < 1:
         return False, 'There is no index chunk'
-    if len(index_chunks) > 1:
-        return False, 'There is more than one index chunk'
-    index_chunk = index_chunks[0]
+    generations = [c.generation for c in index_chunks]
+    if len(generations) != len(set(generations)):
+        return False, 'There is more than one index chunk with the same '\
+            'generation'
+    index_chunk = latest_index_chunk(index_chunks)
+    for c in index_chunks:
+        if (c.encoding_type, c.encryption_type, c.compress_method) != \
+                (index_chunk.encoding_type, index_chunk.encryption_type,
+                 index_chunk.compress_method):
+            return False, 'Index chunks from different generations disagree '\
+                'on how the data is stored'
     expected_num_data_chunks = index_chunk.num_data_chunks
     data_chunks = [c for c in chunks if isinstance(c, DataChunk)]
     if len(data_chunks) != expected_num_data_chunks:
@@ -62,6 +129,18 @@ def validate_chunk_set(chunks):
         if len(crypt_info_chunks) != 1:
             return False, 'Data is encrypted. Expected 1 crypt info chunk '\
                 'but got {}'.format(len(crypt_info_chunks))
+    zdict_chunks = [c for c in chunks if isinstance(c, ZDictChunk)]
+    if len(zdict_chunks) > 1:
+        return False, 'Expected at most 1 dictionary chunk but got {}'.format(
+            len(zdict_chunks))
+    if len(zdict_chunks) and \
+            index_chunk.compress_method != CompressMethod.Zlib:
+        return False, 'Only zlib compressed data can have a dictionary'
+    fingerprint_chunks = [c for c in chunks
+                          if isinstance(c, FingerprintChunk)]
+    if len(fingerprint_chunks) > 1:
+        return False, 'Expected at most 1 fingerprint chunk but got {}'\
+            .format(len(fingerprint_chunks))
     for i, chunk in enumerate(chunks):
         if not chunk.is_valid:
             return False, 'Invalid {} at index {}'.format(type(chunk), i)
@@ -69,13 +148,12 @@ def validate_chunk_set(chunks):
 
 
 def get_index_chunk_from_chunks(chunks):
-    ''' Given a validated list of chunks, find the index chunk and return it
-    '''
+    ''' Given a validated list of chunks, find the index chunk with the
+    highest generation and return it '''
     valid, error_msg = validate_chunk_set(chunks)
     assert valid
     index_chunks = [c for c in chunks if isinstance(c, IndexChunk)]
-    assert len(index_chunks) == 1
-    return index_chunks[0]
+    return latest_index_chunk(index_chunks)
 
 
 def get_crypt_info_chunk_from_chunks(chunks):
@@ -88,60 +166,238 @@ def get_crypt_info_chunk_from_chunks(chunks):
     return crypt_info_chunks[0]
 
 
-def decrypt_data(chunks, pw):
-    ''' Given a validated list of chunks, decrypt the data in the data chunks
-    and return a list of the resulting data '''
+def check_key_check(crypt_info_chunk, fernet):
+    ''' Fail if the crypt info chunk has a key check value and fernet isn't
+    the key it was made with. Without one, a wrong key is only found out
+    when decrypting data. '''
+    if crypt_info_chunk.key_check is None:
+        return
+    if not key_check_matches(fernet, crypt_info_chunk.key_check):
+        fail_hard('Unable to decrypt data: Passphrase appears to be '
+                  'incorrect')
+
+
+def get_fernet(chunks, pw, gen_key=gen_key):
+    ''' Given a validated list of chunks, derive the key needed to decrypt the
+    data in them and return it. Return None if the data isn't encrypted. '''
     valid, error_msg = validate_chunk_set(chunks)
     assert valid
     index_chunk = get_index_chunk_from_chunks(chunks)
-    data_chunks = [c for c in chunks if isinstance(c, DataChunk)]
-    data_chunks = sorted(data_chunks, key=lambda c: c.index)
-    #data = b''.join([c.data for c in data_chunks])
     t = index_chunk.encryption_type
     if t == EncryptionType.No:
-        return b''.join([c.data for c in data_chunks])
+        return None
     elif t == EncryptionType.SaltedPass01:
         crypt_info_chunk = get_crypt_info_chunk_from_chunks(chunks)
         salt = crypt_info_chunk.salt
         salt, fernet = gen_key(password=pw, salt=salt, for_encryption=False)
-        data = b''
-        for chunk in data_chunks:
-            success, d = decrypt(fernet, chunk.data)
-            if not success:
-                fail_hard('Unable to decrypt data:', d)
-            data += d
-        return data
+        check_key_check(crypt_info_chunk, fernet)
+        return fernet
     else:
         fail_hard('Unimplemented decryption type', t)
 
 
-def decompress_data(index_chunk, data):
-    ''' Given a valid index chunk and data from data chunks,
-    decompress the bites if necessary. Return a list of the resulting data '''
-    assert isinstance(data, bytes)
-    assert index_chunk.is_valid
-    m = index_chunk.compress_method
-    if m == CompressMethod.No:
-        return data
-    elif m == CompressMethod.Zlib:
-        return zlib.decompress(data)
+def get_zdict(chunks, zdict):
+    ''' Given a validated list of chunks and the preset dictionary the user
+    gave (or None), return the dictionary the data needs to be decompressed
+    with, or None if it doesn't need one '''
+    valid, error_msg = validate_chunk_set(chunks)
+    assert valid
+    zdict_chunks = [c for c in chunks if isinstance(c, ZDictChunk)]
+    if not len(zdict_chunks):
+        return None
+    check_zdict(zdict_chunks[0], zdict)
+    return zdict
+
+
+def iter_data(chunks):
+    ''' Given a validated list of chunks, yield the data in the data chunks
+    in order '''
+    valid, error_msg = validate_chunk_set(chunks)
+    assert valid
+    data_chunks = [c for c in chunks if isinstance(c, DataChunk)]
+    data_chunks = sorted(data_chunks, key=lambda c: c.index)
+    for chunk in data_chunks:
+        yield chunk.data
+
+
+def decrypt_bites(bites, fernet):
+    ''' Decrypt each of the given bites with fernet, yielding the results. If
+    fernet is None, the bites aren't encrypted and are passed through. '''
+    for b in bites:
+        if fernet is None:
+            yield b
+            continue
+        success, d = decrypt(fernet, b)
+        if not success:
+            fail_hard('Unable to decrypt data:', d)
+        yield d
+
+
+def new_decompressor(compress_method, zdict=None):
+    m = compress_method
+    if m == CompressMethod.Zlib:
+        if zdict is not None:
+            return zlib.decompressobj(zdict=zdict)
+        return zlib.decompressobj()
     elif m == CompressMethod.Lzma:
-        return lzma.decompress(data)
+        import lzma  # only imported when needed, to keep startup fast
+        return lzma.LZMADecompressor()
     else:
         fail_hard('Unimplemented compress method', m)
 
 
-def completely_decode_chunks(chunks, pw):
+class StreamDecompressor():
+    ''' Decompress bytes fed to it bit by bit with the given method, at most
+    max_size bytes of output at a time.
+
+    The compressed bytes may be several complete compressed streams one after
+    another (each append to an image adds one). They are decompressed back to
+    back, each with the preset dictionary zdict if one is given. '''
+    def __init__(self, compress_method, max_size, zdict=None):
+        self.compress_method = compress_method
+        self.max_size = max_size
+        self.zdict = zdict
+        self._d = None
+
+    def feed(self, b):
+        ''' Yield the decompressed bytes that b makes available '''
+        m = self.compress_method
+        if m == CompressMethod.No:
+            if len(b):
+                yield b
+            return
+        while len(b):
+            if self._d is None or self._d.eof:
+                self._d = new_decompressor(m, self.zdict)
+            d = self._d
+            data = d.decompress(b, self.max_size)
+            if m == CompressMethod.Zlib:
+                b = d.unused_data if d.eof else d.unconsumed_tail
+            else:
+                # lzma keeps input it couldn't get to yet internally
+                while not d.eof and not d.needs_input:
+                    if len(data):
+                        yield data
+                    data = d.decompress(b'', self.max_size)
+                b = d.unused_data if d.eof else b''
+            if len(data):
+                yield data
+
+    def finish(self):
+        ''' Yield whatever is left once there is no more input, and make sure
+        the compressed data wasn't cut short '''
+        m = self.compress_method
+        if m == CompressMethod.No:
+            return
+        d = self._d
+        if m == CompressMethod.Zlib and d is not None and not d.eof:
+            data = d.flush()
+            if len(data):
+                yield data
+        if d is None or not d.eof:
+            fail_hard('Compressed data ended early')
+
+
+def decompress_bites(bites, compress_method, max_size, zdict=None):
+    ''' Decompress the given iterable of bytes with the given method (and
+    preset dictionary, if any), yielding the decompressed bytes at most
+    max_size at a time '''
+    d = StreamDecompressor(compress_method, max_size, zdict)
+    for b in bites:
+        yield from d.feed(b)
+    yield from d.finish()
+
+
+def completely_decode_chunks(chunks, pw, use_pipeline=False,
+                             max_size=TARGET_MAX_BUFFER_BYTES,
+                             gen_key=gen_key, zdict=None):
     ''' Given a validated list of chunks, decyrpt/decompress as needed and
-    return the bytes stored within '''
+    yield the bytes stored within, at most max_size at a time. If
+    use_pipeline, decrypting and decompressing happen on their own threads.
+    If the data is encrypted, the key comes from gen_key. If it was
+    compressed with a preset dictionary, zdict must be that dictionary. '''
     valid, error_msg = validate_chunk_set(chunks)
     assert valid
     index_chunk = get_index_chunk_from_chunks(chunks)
-    data = decrypt_data(chunks, pw)
-    data = decompress_data(index_chunk, data)
+    fernet = get_fernet(chunks, pw, gen_key=gen_key)
+    zdict = get_zdict(chunks, zdict)
+    stages = [
+        partial(decrypt_bites, fernet=fernet),
+        partial(decompress_bites, compress_method=index_chunk.compress_method,
+                max_size=max_size, zdict=zdict),
+    ]
+    if use_pipeline:
+        return pipeline(iter_data(chunks), stages)
+    data = iter_data(chunks)
+    for stage in stages:
+        data = stage(data)
     return data
 
 
+def read_pool_block(pool, digest, length, pw, keys):
+    ''' Decode the image holding the block with the given digest and length
+    from the pool and return the block. If its blocks are encrypted, the key
+    comes from the KeyCache keys. '''
+    path = blocks.block_path(pool, digest)
+    if not os.path.isfile(path):
+        fail_hard('Block', digest.hex(), 'is missing from the pool in', pool)
+    with open(path, 'rb') as fd:
+        layout = scan_image_stream(fd)
+        if layout is None:
+            fail_hard(path, 'does not appear to be a PNG')
+        chunks = keep_and_parse_our_chunks(read_our_chunks(fd, layout))
+    valid, error_msg = validate_chunk_set(chunks)
+    if not valid:
+        fail_hard(path, error_msg)
+    if get_index_chunk_from_chunks(chunks).encoding_type != \
+            EncodingType.SingleFile:
+        fail_hard(path, 'isn\'t a block')
+    block = b''.join(completely_decode_chunks(
+        chunks, pw, max_size=length, gen_key=keys.gen_key))
+    if len(block) != length or hashlib.sha256(block).digest() != digest:
+        fail_hard('Block', digest.hex(), 'in the pool in', pool, 'is corrupt')
+    return block
+
+
+class BlockExpander():
+    ''' Turns a list of blocks (see `encode --pool`), fed to it a piece at a
+    time, into the blocks themselves, read from the pool in the given
+    directory. Blocks are read one at a time. '''
+    def __init__(self, pool, pw):
+        if pool is None:
+            fail_hard('The data is stored as blocks in a pool. Give --pool.')
+        self.pool = pool
+        self.pw = pw
+        # Blocks stored at the same time share a salt, so this only has to
+        # derive a key once for each time the pool was added to
+        self.keys = KeyCache()
+        self.pending = bytearray()
+
+    def feed(self, b):
+        ''' Take the next bytes of the block list and yield the blocks it
+        completes '''
+        self.pending += b
+        size = blocks.BLOCK_REF.size
+        end = len(self.pending) - len(self.pending) % size
+        for digest, length in blocks.BLOCK_REF.iter_unpack(
+                self.pending[:end]):
+            yield read_pool_block(self.pool, digest, length, self.pw,
+                                  self.keys)
+        del self.pending[:end]
+
+    def finish(self):
+        if len(self.pending):
+            fail_hard('The list of blocks is truncated')
+
+
+def expand_blocks(data, pool, pw):
+    ''' Yield the blocks listed in the given block list bytes '''
+    expander = BlockExpander(pool, pw)
+    for b in data:
+        yield from expander.feed(b)
+    expander.finish()
+
+
 def data_is_encrypted(chunks):
     valid, error_msg = validate_chunk_set(chunks)
     assert valid
@@ -149,33 +405,438 @@ def data_is_encrypted(chunks):
     return index_chunk.encryption_type != EncryptionType.No
 
 
+class StreamDecoder():
+    ''' Decode chunks handed to it one at a time, in whatever order they
+    appear in the image, in one pass.
+
+    Data chunks are decoded as soon as they arrive if they are next in index
+    order and the index chunk (and crypt info chunk, if encrypting) have
+    already been seen. Encoders only number data chunks 0, 1, 2, ... and write
+    them in that order, so with `encode --index-first` nothing has to wait.
+    Any other data chunk is spilled to a temporary file, which may hold at
+    most spill_max_bytes at once, and decoded once it can be. If the data is
+    encrypted, the key comes from gen_key (e.g. a KeyCache's).
+
+    zdict is the preset dictionary the user gave, if any. zlib only uses it
+    if the data was compressed with one, so it's handed to the decompressor
+    either way, and checked against the dictionary chunk when that arrives.
+    '''
+    def __init__(self, pw, spill_max_bytes, max_size=TARGET_MAX_BUFFER_BYTES,
+                 gen_key=gen_key, pool=None, zdict=None):
+        self.pw = pw
+        self.zdict = zdict
+        self.zdict_chunk = None
+        self.gen_key = gen_key
+        self.pool = pool
+        self.expander = None
+        self.spill_max_bytes = spill_max_bytes
+        self.max_size = max_size
+        self.index_chunk = None
+        self.crypt_info_chunk = None
+        self.fernet = None
+        self.decompressor = None
+        self.generations = set()
+        self.seen_data_indexes = set()
+        self.next_index = 0
+        # index -> (offset, length) of data chunks waiting in the spill file
+        self.spilled = {}
+        self.spill = None
+        self.spill_len = 0
+        # (offset, length) of space in the spill file that chunks which have
+        # since been decoded left behind
+        self.spill_free = []
+        # Bytes of data chunks waiting in the spill file
+        self.spill_bytes = 0
+
+    @property
+    def ready(self):
+        ''' Whether we know enough to decode data chunks '''
+        return self.decompressor is not None
+
+    def _prepare(self):
+        ''' Once everything needed to decode data is known, get set up to do
+        so '''
+        if self.ready or self.index_chunk is None:
+            return
+        t = self.index_chunk.encryption_type
+        if t == EncryptionType.SaltedPass01:
+            if self.crypt_info_chunk is None:
+                return
+            salt, self.fernet = self.gen_key(
+                password=self.pw, salt=self.crypt_info_chunk.salt,
+                for_encryption=False)
+            check_key_check(self.crypt_info_chunk, self.fernet)
+        elif t != EncryptionType.No:
+            fail_hard('Unimplemented decryption type', t)
+        if self.index_chunk.encoding_type == EncodingType.Blocks:
+            self.expander = BlockExpander(self.pool, self.pw)
+        self.decompressor = StreamDecompressor(
+            self.index_chunk.compress_method, self.max_size, self.zdict)
+
+    def _expand(self, data):
+        ''' Pass decoded bytes through, unless they are a block list, in
+        which case pass the blocks through instead '''
+        if self.expander is None:
+            yield from data
+            return
+        for b in data:
+            yield from self.expander.feed(b)
+
+    def _decode(self, data):
+        for d in decrypt_bites([data], self.fernet):
+            yield from self._expand(self.decompressor.feed(d))
+
+    def _spill_space(self, length):
+        ''' Find room for length bytes in the spill file, reusing space freed
+        by chunks that have been decoded if any of it is big enough '''
+        for i, (offset, free) in enumerate(self.spill_free):
+            if free >= length:
+                if free == length:
+                    del self.spill_free[i]
+                else:
+                    self.spill_free[i] = (offset + length, free - length)
+                return offset
+        offset = self.spill_len
+        self.spill_len += length
+        return offset
+
+    def _spill(self, chunk):
+        if self.spill is None:
+            self.spill = TemporaryFile()
+        length = len(chunk.data)
+        if self.spill_bytes + length > self.spill_max_bytes:
+            fail_hard(
+                'More than --spill-max-bytes of data arrived out of order. '
+                'Give a larger value, or encode with --index-first.')
+        offset = self._spill_space(length)
+        self.spilled[chunk.index] = (offset, length)
+        self.spill.seek(offset, 0)
+        self.spill.write(chunk.data)
+        self.spill_bytes += length
+
+    def _unspill(self, index):
+        offset, length = self.spilled.pop(index)
+        self.spill.seek(offset, 0)
+        data = self.spill.read(length)
+        self.spill_bytes -= length
+        if self.spilled:
+            self.spill_free.append((offset, length))
+        else:
+            # Nothing is waiting any more, so start the file over
+            self.spill_free = []
+            self.spill_len = 0
+            self.spill.truncate(0)
+        return data
+
+    def _drain(self):
+        ''' Decode spilled data chunks that are now next in line '''
+        while self.ready and self.next_index in self.spilled:
+            yield from self._decode(self._unspill(self.next_index))
+            self.next_index += 1
+
+    def add_chunk(self, chunk):
+        ''' Take the next chunk from the image and yield whatever decoded
+        bytes it makes available '''
+        if not chunk.is_valid:
+            fail_hard('Invalid', type(chunk).__name__)
+        if isinstance(chunk, IndexChunk):
+            if chunk.generation in self.generations:
+                fail_hard('There is more than one index chunk with the same '
+                          'generation')
+            self.generations.add(chunk.generation)
+            prev = self.index_chunk
+            if prev is not None and \
+                    (prev.encoding_type, prev.encryption_type,
+                     prev.compress_method) != \
+                    (chunk.encoding_type, chunk.encryption_type,
+                     chunk.compress_method):
+                fail_hard('Index chunks from different generations disagree '
+                          'on how the data is stored')
+            if prev is None or chunk.generation > prev.generation:
+                self.index_chunk = chunk
+        elif isinstance(chunk, CryptInfoChunk):
+            if self.crypt_info_chunk is not None:
+                fail_hard('Expected 1 crypt info chunk but got more')
+            self.crypt_info_chunk = chunk
+        elif isinstance(chunk, ZDictChunk):
+            if self.zdict_chunk is not None:
+                fail_hard('Expected at most 1 dictionary chunk but got more')
+            check_zdict(chunk, self.zdict)
+            self.zdict_chunk = chunk
+        elif isinstance(chunk, DataChunk):
+            if chunk.index in self.seen_data_indexes:
+                fail_hard('The data chunk indexes are not unique and they '
+                          'can\'t be ordered')
+            self.seen_data_indexes.add(chunk.index)
+            if self.ready and chunk.index == self.next_index:
+                yield from self._decode(chunk.data)
+                self.next_index += 1
+            else:
+                self._spill(chunk)
+        self._prepare()
+        yield from self._drain()
+
+    def finish(self):
+        ''' Once all the chunks have been added, check they formed a valid
+        set and yield the rest of the decoded bytes '''
+        if self.index_chunk is None:
+            fail_hard('There is no index chunk')
+        if len(self.seen_data_indexes) != self.index_chunk.num_data_chunks:
+            fail_hard('Expected {} data chunks but there are {}'.format(
+                self.index_chunk.num_data_chunks,
+                len(self.seen_data_indexes)))
+        if not self.ready:
+            fail_hard('Data is encrypted. Expected 1 crypt info chunk but got '
+                      '0')
+        if self.zdict_chunk is not None and \
+                self.index_chunk.compress_method != CompressMethod.Zlib:
+            fail_hard('Only zlib compressed data can have a dictionary')
+        # Whatever is left didn't have consecutive indexes. It still goes in
+        # index order.
+        for index in sorted(self.spilled):
+            yield from self._decode(self._unspill(index))
+        if self.spill is not None:
+            self.spill.close()
+        yield from self._expand(self.decompressor.finish())
+        if self.expander is not None:
+            self.expander.finish()
+
+
+def stream_decode(fd, pw, args, gen_key=gen_key):
+    ''' Decode the image being read from fd in one pass, without seeking,
+    yielding the decoded bytes '''
+    if fd.read(len(PNG_SIG)) != PNG_SIG:
+        fail_hard(args.input, 'does not appear to be a PNG')
+    chunks = iter_image_stream(fd)
+    if args.pipeline:
+        chunks = ThreadedIterator(chunks)
+    decoder = StreamDecoder(
+        pw, args.spill_max_bytes, args.buffer_max_bytes, gen_key=gen_key,
+        pool=args.pool, zdict=read_zdict(args.zdict) if args.zdict else None)
+    for chunk in chunks:
+        yield from decoder.add_chunk(chunk)
+    yield from decoder.finish()
+
+
+def read_chunks_from_pixels(fd, args):
+    ''' Read the image from fd (which may be a pipe) and return the list of
+    our chunks hidden in the least significant bits of its pixels '''
+    from ..lib import lsb  # only imported when needed, to keep startup fast
+    if fd.read(len(PNG_SIG)) != PNG_SIG:
+        fail_hard(args.input, 'does not appear to be a PNG')
+    image = lsb.read_pixel_image(list(iter_image_stream(fd)))
+    payload = lsb.extract(image)
+    if payload is None:
+        fail_hard('There is no data hidden in the pixels of', args.input)
+    return list(iter_image_stream(BytesIO(payload)))
+
+
+def read_key_file(fname):
+    if os.path.isdir(fname):
+        fail_hard(fname, 'must be a file')
+    with open(fname, 'rb') as fd:
+        return fd.read()
+
+
 def get_password(args):
     if args.key_file is None:
         fail_hard('Data is encrypted but not --key-file given')
-    elif os.path.isdir(args.key_file):
-        fail_hard(args.key_file, 'must be a file')
-    with open(args.key_file, 'rb') as fd:
-        return fd.read()
+    return read_key_file(args.key_file)
 
 
-def main(args):
-    if not os.path.exists(args.input):
-        fail_hard(args.input, 'must exist')
-    if os.path.isdir(args.input):
-        fail_hard('Input can\'t be a directory')
-    with open(args.input, 'rb') as fd:
-        chunks = read_image_stream(fd)
-    if chunks is None:
-        fail_hard(args.input, 'does not appear to be a PNG')
+def read_key_state(fd, layout):
+    ''' Return the latest index chunk and the crypt info chunk (or None for
+    either if there isn't one) of the image open as fd, whose chunks are the
+    ChunkHeaders in layout, and the headers of its data chunks, which aren't
+    read. Whether they make a complete set is left for later. '''
+    index_chunks = []
+    crypt_info_chunk = None
+    data_headers = []
+    for h in layout:
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type == ChunkType.Index:
+            index_chunks.append(read_chunk(fd, h))
+        elif chunk_type == ChunkType.CryptInfo and crypt_info_chunk is None:
+            crypt_info_chunk = read_chunk(fd, h)
+        elif chunk_type == ChunkType.Data:
+            data_headers.append(h)
+    index_chunk = latest_index_chunk(index_chunks) if len(index_chunks) \
+        else None
+    return index_chunk, crypt_info_chunk, data_headers
+
+
+def try_key(password, salt, key_check, data):
+    ''' Return whether the key derived from password and salt is the one
+    with the given key check value or, if there is none, whether it can
+    decrypt data (if there's any). Module level, so that it can be run on a
+    process pool. '''
+    _, fernet = gen_key(password=password, salt=salt, for_encryption=False)
+    if key_check is not None:
+        return key_check_matches(fernet, key_check)
+    return data is None or decrypt(fernet, data)[0]
+
+
+def pick_key_file(fd, key_files, crypt_info_chunk, data_headers, jobs):
+    ''' Return which of the key files has the key the data in the image open
+    as fd was encrypted with. Their keys are derived at the same time on up
+    to jobs worker processes, and checked against the crypt info chunk's key
+    check value, or if it has none, by decrypting the smallest data chunk. '''
+    passwords = [read_key_file(fname) for fname in key_files]
+    data = None
+    if crypt_info_chunk.key_check is None and len(data_headers):
+        h = min(data_headers, key=lambda h: h.length)
+        data = read_chunk(fd, h).data
+    a = (passwords, [crypt_info_chunk.salt] * len(passwords),
+         [crypt_info_chunk.key_check] * len(passwords),
+         [data] * len(passwords))
+    if jobs > 1:
+        # only imported when needed, to keep startup fast
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(
+                max_workers=min(jobs, len(passwords))) as executor:
+            right = list(executor.map(try_key, *a))
+    else:
+        right = list(map(try_key, *a))
+    for fname, is_right in zip(key_files, right):
+        if is_right:
+            log('Using the key in', fname)
+            return fname
+    fail_hard('None of the', len(key_files), 'key files has the right key')
+
+
+def check_key_early(fd, layout, args, gen_key=gen_key):
+    ''' Before any data chunk is read, pick the right one of several
+    --key-file (see pick_key_file) and, if the image has a key check value,
+    make sure the key is right, so a wrong one doesn't cost reading the whole
+    image. args.key_file is left as the one to use. '''
+    index_chunk, crypt_info_chunk, data_headers = read_key_state(fd, layout)
+    if index_chunk is None or crypt_info_chunk is None or \
+            index_chunk.encryption_type != EncryptionType.SaltedPass01:
+        return
+    if len(args.key_files) > 1:
+        args.key_file = pick_key_file(fd, args.key_files, crypt_info_chunk,
+                                      data_headers, args.jobs)
+    if args.key_file is None or crypt_info_chunk.key_check is None:
+        return
+    _, fernet = gen_key(password=get_password(args),
+                        salt=crypt_info_chunk.salt, for_encryption=False)
+    check_key_check(crypt_info_chunk, fernet)
+
+
+def is_plain(index_chunk):
+    ''' Whether the data chunks described by the index chunk hold the data
+    just as it is, so decoding is only putting them back together '''
+    return index_chunk.encoding_type == EncodingType.SingleFile and \
+        index_chunk.encryption_type == EncryptionType.No and \
+        index_chunk.compress_method == CompressMethod.No
+
+
+def copy_plain_data(refs, out_fd):
+    ''' Write the data of the given DataChunkRefs, all from the same image, to
+    out_fd (a buffered file object) in index order. Only for plain data (see
+    is_plain), so the kernel can copy it straight from the image. Each data
+    chunk's CRC is still checked, without copying its data into Python (see
+    crc32_range). '''
+    for ref in sorted(refs, key=lambda c: c.index):
+        stream, h = ref.stream, ref.header
+        crc = crc32_range(stream.fileno(), h.offset + 4, h.length + 4)
+        stream.seek(h.crc_offset, 0)
+        if struct.unpack('>I', stream.read(4))[0] != crc:
+            log('Data chunk', ref.index, 'at offset', h.offset, 'has a CRC '
+                'that doesn\'t match the given one.')
+        copy_file_object_range(stream, out_fd, h.data_offset + 4,
+                               h.crc_offset)
+
+
+def open_output(args, out_fd=None):
+    ''' Open args.output to write decoded data to, unless out_fd (a buffered
+    file object) is given to write to instead '''
+    if out_fd is not None:
+        return nullcontext(out_fd)
+    return open(args.output, 'wb')
+
+
+def decode_to_file(chunks, args, gen_key=gen_key, out_fd=None):
+    ''' Check the chunks form a complete set, and write the data stored in
+    them to args.output, or out_fd if it's given (see open_output). If the
+    data is encrypted, the key comes from gen_key. '''
     chunks = keep_and_parse_our_chunks(chunks)
     valid, error_msg = validate_chunk_set(chunks)
     if not valid:
         fail_hard(error_msg)
     if data_is_encrypted(chunks) and args.key_file:
-        with open(args.key_file, 'rb') as fd:
-            pw = fd.read()
+        pw = get_password(args)
     else:
         pw = None
-    data = completely_decode_chunks(chunks, pw)
-    with open(args.output, 'wb') as fd:
-        fd.write(data)
+    data_chunks = [c for c in chunks if isinstance(c, DataChunk)]
+    if is_plain(get_index_chunk_from_chunks(chunks)) and \
+            all(isinstance(c, DataChunkRef) for c in data_chunks):
+        with open_output(args, out_fd) as fd:
+            copy_plain_data(data_chunks, fd)
+        return
+    data = completely_decode_chunks(
+        chunks, pw, args.pipeline, args.buffer_max_bytes, gen_key=gen_key,
+        zdict=read_zdict(args.zdict) if args.zdict else None)
+    if get_index_chunk_from_chunks(chunks).encoding_type == \
+            EncodingType.Blocks:
+        data = expand_blocks(data, args.pool, pw)
+    with open_output(args, out_fd) as fd:
+        for d in data:
+            fd.write(d)
+
+
+def read_chunks_to_decode(fd, layout):
+    ''' Return our chunks in the image open as fd, whose chunks are the
+    ChunkHeaders in layout. Data chunks are only read as they are decoded, so
+    this doesn't hold the whole image in memory. With parity chunks, every
+    data chunk's CRC is checked first, and any that are damaged are rebuilt.
+    '''
+    if any(ChunkType.from_string(h.type) == ChunkType.Parity
+           for h in layout):
+        return read_repaired_chunks(fd, layout)
+    return read_our_chunks(fd, layout, data_refs=True)
+
+
+def main(args):
+    if not os.path.exists(args.input):
+        fail_hard(args.input, 'must exist')
+    if os.path.isdir(args.input):
+        fail_hard('Input can\'t be a directory')
+    if args.jobs < 1:
+        fail_hard('--jobs must be positive')
+    args.key_files = args.key_file or []
+    args.key_file = args.key_files[0] if len(args.key_files) else None
+    # The key checked before decoding is derived once, not again to decode.
+    # Without a key file, there's no checking first, and gen_key prompts.
+    keys = KeyCache() if args.key_file is not None else None
+    gen = keys.gen_key if keys is not None else gen_key
+    with open(args.input, 'rb') as fd:
+        if args.embed == 'lsb':
+            if len(args.key_files) > 1:
+                fail_hard('Only one --key-file can be given with --embed lsb')
+            return decode_to_file(read_chunks_from_pixels(fd, args), args)
+        elif args.stream or not fd.seekable():
+            if len(args.key_files) > 1:
+                if not fd.seekable():
+                    fail_hard('Several --key-file can only be tried on an '
+                              'image that can be read twice, not a pipe')
+                layout = scan_image_stream(fd)
+                if layout is None:
+                    fail_hard(args.input, 'does not appear to be a PNG')
+                check_key_early(fd, layout, args, gen_key=gen)
+                fd.seek(0, 0)
+            # We don't know yet if the key will be needed, so read it now
+            pw = None
+            if args.key_file:
+                pw = get_password(args)
+            with open(args.output, 'wb') as out_fd:
+                for data in stream_decode(fd, pw, args, gen_key=gen):
+                    out_fd.write(data)
+            return
+        layout = lookup_layout(args.catalog, args.input)
+        if layout is None:
+            layout = scan_image_stream(fd)
+        if layout is None:
+            fail_hard(args.input, 'does not appear to be a PNG')
+        check_key_early(fd, layout, args, gen_key=gen)
+        decode_to_file(read_chunks_to_decode(fd, layout), args, gen_key=gen)
@@ -2,53 +2,231 @@ from ..lib.chunk import read_image_stream
 from ..lib.chunk import (CompressMethod, EncodingType, EncryptionType)
 from ..lib.chunk import (PNG_SIG, TARGET_MAX_BUFFER_BYTES)
 from ..lib.chunk import (Chunk, IndexChunk, DataChunk, CryptInfoChunk)
+from ..lib.chunk import (ChunkType, ManifestChunk, ZDictChunk)
+from ..lib import blocks
+from ..lib.blocks import BLOCK_AVG_BYTES
+from ..lib.checkpoint import (CHECKPOINT_BYTES, Checkpoint)
+from ..lib.checkpoint import check_partial_output
+from ..lib.checkpoint import (checkpoint_path, read_checkpoint)
+from ..lib.checkpoint import write_checkpoint
+from ..lib.layout import get_carrier_layout
+from ..lib.layout import (read_chunk, read_data_chunk_index)
+from ..lib.fingerprint import (Fingerprinter, fingerprint_bites)
+from ..lib.fingerprint import fingerprint_key
+from ..lib.parity import (MAX_STRIPE_CHUNKS, add_parity_chunks)
+from ..lib.zdict import (read_zdict, zdict_digest)
+from ..util.log import log_stderr as log
+from ..util.config import set_config_defaults
 from ..util.log import fail_hard
-from ..util.crypto import gen_key
-from ..util.crypto import encrypt
-from argparse import ArgumentDefaultsHelpFormatter
+from ..util.fastcopy import (copy_file_object_range, mapped_range)
+from ..util.fastcopy import hash_range
+from ..util.pipeline import pipeline
+from ..util.crypto import (gen_key, KeyCache)
+from ..util.crypto import (decrypt, encrypt, key_check_value)
+from argparse import (ArgumentDefaultsHelpFormatter, Namespace)
+from functools import partial
+import hashlib
+import io
 import os
+import stat
 import struct
 import zlib
-import lzma
-import random
 
 
-def encode_source_and_data_chunks_together(args, source_chunks, data_chunks):
-    assert len(source_chunks) >= 2
-    assert source_chunks[0].type == 'IHDR'
-    assert source_chunks[-1].type == 'IEND'
-    with open(args.output, 'wb') as fd:
+def copy_source_image_range(fname, out_fd, start, end):
+    ''' Copy the bytes [start, end) of the given file to out_fd, a buffered
+    file object, without bringing them into Python if the kernel can help it
+    '''
+    with open(fname, 'rb') as in_fd:
+        copy_file_object_range(in_fd, out_fd, start, end)
+
+
+def is_regular_file(stream):
+    ''' Return whether the stream is backed by a regular file with something
+    in it, as opposed to a pipe, a socket, or something only in memory. Files
+    in procfs and the like say they're regular but empty, however much they
+    hold, so they're read like pipes, as are empty files. '''
+    try:
+        st = os.fstat(stream.fileno())
+        return stat.S_ISREG(st.st_mode) and st.st_size > 0
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return False
+
+
+class FileDataChunk(DataChunk):
+    ''' Stands in for the DataChunk whose data is the bytes [offset, offset +
+    count) of the regular file open as stream. Its CRC is computed when it's
+    made without copying the data into Python (see mapped_range), and write_to
+    has the kernel copy the data to the output. Everything else about it
+    still works, by reading the data. '''
+    def __init__(self, stream, index, offset, count, fingerprinter=None):
+        assert count > 0
+        self.stream = stream
+        self.offset = offset
+        self.count = count
+        self._index = index
+        self._prefix = struct.pack(
+            '>I4sI', 4 + count, bytes(ChunkType.Data.value, 'utf-8'), index)
+        # The data is added to the Fingerprinter, if given, in the same pass
+        crc = zlib.crc32(self._prefix[4:])
+        for window in mapped_range(stream.fileno(), offset, count):
+            crc = zlib.crc32(window, crc)
+            if fingerprinter is not None:
+                fingerprinter.update(window)
+        self._crc = crc
+
+    def write_to(self, fd):
+        ''' Write the whole chunk to fd, a buffered file object '''
+        fd.write(self._prefix)
+        copy_file_object_range(
+            self.stream, fd, self.offset, self.offset + self.count)
+        fd.write(struct.pack('>I', self._crc))
+
+    @property
+    def length(self):
+        return 4 + self.count
+
+    @property
+    def type(self):
+        return ChunkType.Data.value
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def data(self):
+        return os.pread(self.stream.fileno(), self.count, self.offset)
+
+    @property
+    def crc(self):
+        return self._crc
+
+    @property
+    def raw_data(self):
+        return b''.join(
+            (self._prefix, self.data, struct.pack('>I', self._crc)))
+
+    @property
+    def is_valid(self):
+        return True
+
+
+def file_data_chunks(stream, max_size, start=0, fingerprinter=None,
+                     count=None):
+    ''' Yield FileDataChunks for the rest of the regular file open as stream
+    (or only the next count bytes of it), at most max_size bytes of it each,
+    numbered starting at start. The data is added to the Fingerprinter, if
+    given, without reading it into Python. The stream's position isn't
+    moved. '''
+    offset = stream.tell()
+    size = os.fstat(stream.fileno()).st_size
+    if count is not None:
+        size = min(size, offset + count)
+    for i, offset in enumerate(range(offset, size, max_size), start):
+        yield FileDataChunk(stream, i, offset, min(max_size, size - offset),
+                            fingerprinter)
+
+
+def write_chunk(fd, chunk):
+    ''' Write the whole chunk to fd, leaving the data of FileDataChunks for
+    the kernel to copy '''
+    if isinstance(chunk, FileDataChunk):
+        chunk.write_to(fd)
+    else:
+        fd.write(chunk.raw_data)
+
+
+def write_image_head(fd, source_fname, source):
+    ''' Write the source image up to IEND to fd. See write_image. '''
+    assert len(source) >= 2
+    assert source[0].type == 'IHDR'
+    assert source[-1].type == 'IEND'
+    if source_fname:
+        copy_source_image_range(source_fname, fd, 0, source[-1].offset)
+    else:
         fd.write(PNG_SIG)
-        for c in source_chunks[0:-1]:
+        for c in source[0:-1]:
             fd.write(c.raw_data)
-        for c in data_chunks:
-            fd.write(c.raw_data)
-        fd.write(source_chunks[-1].raw_data)
+
+
+def write_image_tail(fd, source_fname, source):
+    ''' Write the IEND of the source image to fd. See write_image. '''
+    if source_fname:
+        copy_source_image_range(
+            source_fname, fd, source[-1].offset, source[-1].end)
+    else:
+        fd.write(source[-1].raw_data)
+
+
+def write_image(fd, source_fname, source, data_chunks):
+    ''' Write the output image to fd. If source_fname is set, source is the
+    layout of that image and its bytes up to IEND are copied over unparsed.
+    Otherwise source is the list of chunks of the basic image. Either way, our
+    chunks are put right before IEND. '''
+    write_image_head(fd, source_fname, source)
+    for c in data_chunks:
+        write_chunk(fd, c)
+    write_image_tail(fd, source_fname, source)
+
+
+def encode_source_and_data_chunks_together(args, source, data_chunks):
+    ''' Write the output image to args.output. See write_image. '''
+    with open(args.output, 'wb') as fd:
+        write_image(fd, args.source, source, data_chunks)
 
 
 def break_into_bites(iter, max_bite_len):
-    b = b''
+    # A bytearray grows in place. Adding to bytes copies the whole thing each
+    # time, which is quadratic when lots of little pieces come in.
+    b = bytearray()
     for i in iter:
         b += i
         while len(b) > max_bite_len:
-            yield b[0:max_bite_len]
-            b = b[max_bite_len:]
+            yield bytes(b[0:max_bite_len])
+            del b[0:max_bite_len]
     if len(b) > 0:
+        yield bytes(b)
+
+
+def read_stream(stream, max_size, count=None):
+    ''' Yield the bytes remaining in the stream (or only the next count bytes
+    of it), at most max_size at a time '''
+    while count is None or count > 0:
+        b = stream.read(max_size if count is None else min(max_size, count))
+        if not len(b):
+            break
+        if count is not None:
+            count -= len(b)
         yield b
 
 
-def compress_stream(stream, compress_method, max_size):
+def new_compressor(compress_method, zdict=None, level=None):
+    ''' Return a compressor for the given method, or None if the method is
+    to not compress. zlib can be given a preset dictionary. level is from 0 to
+    9, or None for the compressor's default. '''
     assert isinstance(compress_method, CompressMethod)
+    assert zdict is None or compress_method == CompressMethod.Zlib
     if compress_method == CompressMethod.Zlib:
-        compressor = zlib.compressobj()
+        kwargs = {}
+        if level is not None:
+            kwargs['level'] = level
+        if zdict is not None:
+            kwargs['zdict'] = zdict
+        return zlib.compressobj(**kwargs)
     elif compress_method == CompressMethod.Lzma:
-        compressor = lzma.LZMACompressor()
-    else:
-        assert compress_method == CompressMethod.No
-        compressor = None
-    b = b''
-    while len(stream.peek(1)) > 0:
-        b = stream.read(max_size)
+        import lzma  # only imported when needed, to keep startup fast
+        return lzma.LZMACompressor(preset=level)
+    assert compress_method == CompressMethod.No
+    return None
+
+
+def compress_bites(bites, compress_method, zdict=None, level=None):
+    ''' Compress the given iterable of bytes with the given method (and
+    preset dictionary and level, if any), yielding compressed bytes as the
+    compressor produces them '''
+    compressor = new_compressor(compress_method, zdict, level)
+    for b in bites:
         if compressor:
             data = compressor.compress(b)
             if len(data):
@@ -61,28 +239,85 @@ def compress_stream(stream, compress_method, max_size):
             yield data
 
 
+def compress_stream(stream, compress_method, max_size):
+    return compress_bites(read_stream(stream, max_size), compress_method)
+
+
 def encrypt_bytes(iter, fernet, max_size):
     if not fernet:
         for i in iter:
             yield i
     else:
-        b = b''
-        for i in iter:
-            b += i
-            while len(b) > max_size:
-                yield encrypt(fernet, b[:max_size])
-                b = b[max_size:]
-        if len(b):
+        for b in break_into_bites(iter, max_size):
             yield encrypt(fernet, b)
 
 
-def completely_encode_stream(stream, args, compress_method):
+def make_data_chunks(bites, start=0):
+    ''' Put each bite in its own data chunk, numbering them in order starting
+    at start '''
+    for i, bite in enumerate(bites, start):
+        yield DataChunk(i, bite)
+
+
+def encode_data_chunks(stream, args, compress_method, fernet, start=0,
+                       zdict=None, level=None, fingerprinter=None,
+                       count=None):
+    ''' Read the rest of the stream (or only the next count bytes of it, after
+    which the position of a regular file is undefined) and return an
+    iterable over the data chunks storing it, numbered starting at start,
+    compressed at the given level with the preset dictionary zdict if
+    they're given. The data is added to the Fingerprinter, if given, as it's
+    read. If args.pipeline is set, reading, compressing, encrypting, and
+    building data chunks each happen on their own thread so that they
+    overlap with each other and with the caller writing the chunks out.
+
+    If the data is neither compressed nor encrypted and the stream is a
+    regular file, the data chunks are just slices of it, and they are
+    FileDataChunks so that it isn't read into Python at all. '''
+    if compress_method == CompressMethod.No and fernet is None and \
+            is_regular_file(stream):
+        return file_data_chunks(
+            stream, args.buffer_max_bytes, start, fingerprinter, count)
+    bites = read_stream(stream, args.buffer_max_bytes, count)
+    if fingerprinter is not None:
+        bites = fingerprint_bites(bites, fingerprinter)
+    stages = [
+        partial(compress_bites, compress_method=compress_method,
+                zdict=zdict, level=level),
+        partial(encrypt_bytes, fernet=fernet, max_size=args.buffer_max_bytes),
+        partial(make_data_chunks, start=start),
+    ]
+    if args.pipeline:
+        return pipeline(bites, stages)
+    data_chunks = bites
+    for stage in stages:
+        data_chunks = stage(data_chunks)
+    return data_chunks
+
+
+def digest_data_chunks(data_chunks, digests):
+    ''' Pass through the given data chunks, recording in the dict digests the
+    SHA-256 digest of each one's data field, as stored in a manifest chunk '''
+    for c in data_chunks:
+        digests[c.index] = hashlib.sha256(
+            memoryview(c.raw_data)[8:8+c.length]).digest()
+        yield c
+
+
+def completely_encode_stream(stream, args, compress_method, gen_key=gen_key,
+                             encoding_type=EncodingType.SingleFile,
+                             fingerprinter=None):
     ''' The input stream should contain bytes that the user wishes to encode
     into a PNG. If seekable, seek to the start. Otherwise assume we are at the
-    start of the data the user wishes to encode.
+    start of the data the user wishes to encode. If encrypting, the key comes
+    from gen_key (e.g. a KeyCache's). The index chunk says the bytes are
+    encoding_type.
+
+    If args.fingerprint is set, the fingerprint of the bytes is stored too.
+    When they aren't the data itself (like a block list), the Fingerprinter
+    of the data must be given, already fed all of it.
 
-    Returns an ordered list of all the chunks that need to be stored in the
-    image. '''
+    Yields, in order, all the chunks that need to be stored in the image. '''
     if stream.seekable():
         stream.seek(0, 0)
     if args.encrypt:
@@ -95,19 +330,45 @@ def completely_encode_stream(stream, args, compress_method):
     else:
         salt, fernet = None, None
         encryption_type = EncryptionType.No
-    b = encrypt_bytes(
-        compress_stream(stream, compress_method, args.buffer_max_bytes),
-        fernet,
-        args.buffer_max_bytes)
-    #bites = break_into_bites(b, args.buffer_max_bytes)
-    bites = b
+    zdict = read_zdict(args.zdict) if args.zdict else None
+    data_fingerprinter = None
+    if args.fingerprint and fingerprinter is None:
+        assert encoding_type == EncodingType.SingleFile
+        fingerprinter = data_fingerprinter = Fingerprinter(
+            fingerprint_key(fernet))
+    data_chunks = encode_data_chunks(
+        stream, args, compress_method, fernet, zdict=zdict,
+        level=args.compress_level, fingerprinter=data_fingerprinter)
+    digests = {}
+    if args.manifest:
+        data_chunks = digest_data_chunks(data_chunks, digests)
+    parity = parse_parity(args.parity)
+    if parity is not None:
+        data_chunks = add_parity_chunks(data_chunks, *parity)
     if args.encrypt:
-        yield CryptInfoChunk(salt)
+        yield CryptInfoChunk(
+            salt, key_check_value(fernet) if args.key_check else None)
+    if zdict is not None:
+        yield ZDictChunk(zdict_digest(zdict))
+    generation = 0
+    if args.index_first:
+        # We don't know how many data chunks there will be yet. This index
+        # chunk tells a streaming decoder how to decode them, and the one at
+        # the end supersedes it with the count.
+        yield IndexChunk(encoding_type, encryption_type, compress_method, 0,
+                         generation)
+        generation += 1
     n = 0
-    for i, bite in enumerate(bites):
-        yield DataChunk(i, bite)
-        n += 1
-    yield IndexChunk(EncodingType.SingleFile, encryption_type, compress_method, n)
+    for chunk in data_chunks:
+        yield chunk
+        if isinstance(chunk, DataChunk):
+            n += 1
+    if args.manifest:
+        yield ManifestChunk(digests)
+    if args.fingerprint:
+        yield fingerprinter.chunk(n)
+    yield IndexChunk(encoding_type, encryption_type, compress_method, n,
+                     generation)
     #################################################
     #crypt_info_chunk = [CryptInfoChunk(salt)] if args.encrypt else []
     #data_chunks = [DataChunk(i, bite) for i, bite in enumerate(bites)]
@@ -123,21 +384,97 @@ def completely_encode_stream(stream, args, compress_method):
     #return all_chunks
 
 
-def get_provided_source_image_chunks(args):
-    with open(args.source, 'rb') as fd:
-        source_chunks = read_image_stream(fd)
-    if source_chunks is None:
+def write_pool_block(args, compress_method, keys, digest, block):
+    ''' Encode the block into an image of its own in the pool, compressed and
+    encrypted like the rest of the data. The image only appears once it's
+    complete. '''
+    path = blocks.block_path(args.pool, digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    block_args = Namespace(**vars(args))
+    block_args.index_first = False
+    block_args.manifest = False
+    block_args.parity = None
+    block_args.fingerprint = False
+    chunks = completely_encode_stream(
+        io.BytesIO(block), block_args, compress_method, gen_key=keys.gen_key)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fd:
+        write_image(fd, None, get_basic_source_image_chunks(), chunks)
+    os.replace(tmp, path)
+
+
+def check_pool_key(args, conn, keys):
+    ''' Make sure the key is the one the pool's blocks are encrypted with
+    before adding blocks encrypted with it. Only the smallest block is read.
+    '''
+    # only imported when needed, to keep startup fast
+    from .decode import read_pool_block
+    block = blocks.smallest_block(conn)
+    if block is None:
+        return
+    with open(args.key_file, 'rb') as fd:
+        pw = fd.read()
+    read_pool_block(args.pool, *block, pw, keys)
+
+
+def encode_blocks_into_pool(stream, args, compress_method, keys,
+                            fingerprinter=None):
+    ''' Cut the rest of the stream into content-defined blocks, store each
+    one that isn't in the args.pool yet in an image of its own there, and
+    return the list of blocks (see BLOCK_REF) that makes up the stream. The
+    stream is added to the Fingerprinter, if given. '''
+    conn = blocks.open_pool(args.pool)
+    try:
+        blocks.pool_settings(
+            conn, compress_method, EncryptionType.SaltedPass01
+            if args.encrypt else EncryptionType.No)
+        if args.encrypt:
+            check_pool_key(args, conn, keys)
+        block_list = bytearray()
+        num_blocks = 0
+        new_blocks = 0
+        new_bytes = 0
+        for block in blocks.iter_blocks(stream, args.block_avg_bytes):
+            if fingerprinter is not None:
+                fingerprinter.update(block)
+            digest = hashlib.sha256(block).digest()
+            block_list += blocks.pack_block_ref(digest, len(block))
+            num_blocks += 1
+            if blocks.has_block(conn, digest):
+                continue
+            write_pool_block(args, compress_method, keys, digest, block)
+            blocks.add_block(conn, digest, len(block))
+            new_blocks += 1
+            new_bytes += len(block)
+            # Blocks stored but not indexed are just stored again next time,
+            # so there's no need to commit after every one
+            if new_blocks % 256 == 0:
+                conn.commit()
+        conn.commit()
+    finally:
+        conn.close()
+    log('Stored {} new blocks of {} ({} bytes) in {}'.format(
+        new_blocks, num_blocks, new_bytes, args.pool))
+    return bytes(block_list)
+
+
+def get_provided_source_image_layout(args):
+    ''' Scan the headers of the chunks in the --source image and make sure
+    we know where to put our chunks in it. Only chunk headers are read; the
+    image's bytes are copied over as-is later. '''
+    layout = get_carrier_layout(args.source)
+    if layout is None:
         fail_hard(args.source, 'does not appear to be a PNG')
-    if len(source_chunks) < 2:
+    if len(layout) < 2:
         fail_hard('Don\'t know how to handle image with only',
-                  len(source_chunks), 'chunks in it. They\'re', source_chunks)
-    if source_chunks[0].type != 'IHDR':
+                  len(layout), 'chunks in it. They\'re', layout)
+    if layout[0].type != 'IHDR':
         fail_hard('Don\'t know how to handle image with first chunk type',
-                  source_chunks[0].type)
-    if source_chunks[-1].type != 'IEND':
+                  layout[0].type)
+    if layout[-1].type != 'IEND':
         fail_hard('Don\'t know how to handle image with last chunk type',
-                  source_chunks[-1].type)
-    return source_chunks
+                  layout[-1].type)
+    return layout
 
 
 def get_basic_source_image_chunks():
@@ -147,6 +484,195 @@ def get_basic_source_image_chunks():
     return [IHDR, IDAT, IEND]
 
 
+def resume_settings(args, compress_method, zdict):
+    ''' The settings an encode must be resumed with, which are stored in its
+    checkpoints. The input mustn't have changed either. '''
+    st = os.stat(args.input)
+    return {
+        'input': os.path.realpath(args.input), 'input_bytes': st.st_size,
+        'input_mtime_ns': st.st_mtime_ns,
+        'source': os.path.realpath(args.source) if args.source else None,
+        'compress': compress_method.name,
+        'compress_level': args.compress_level, 'encrypt': args.encrypt,
+        'key_check': args.key_check,
+        'zdict': zdict_digest(zdict).hex() if zdict is not None else None,
+        'buffer_max_bytes': args.buffer_max_bytes,
+        'checkpoint_bytes': args.checkpoint_bytes,
+        'index_first': args.index_first, 'manifest': args.manifest,
+        'parity': args.parity, 'fingerprint': args.fingerprint}
+
+
+def sync_output(fd):
+    ''' Make sure everything written to fd is on disk, so that a checkpoint
+    can say it is '''
+    fd.flush()
+    os.fsync(fd.fileno())
+
+
+def encryption_type_of(args):
+    return EncryptionType.SaltedPass01 if args.encrypt else \
+        EncryptionType.No
+
+
+def start_resumable_output(fd, args, compress_method, source, settings,
+                           zdict, pw):
+    ''' Write what goes before the data chunks to fd, and return the
+    Checkpoint of there and the key to encrypt with (or None) '''
+    salt, fernet = None, None
+    if args.encrypt:
+        salt, fernet = gen_key(password=pw)
+    write_image_head(fd, args.source, source)
+    if args.encrypt:
+        fd.write(CryptInfoChunk(
+            salt, key_check_value(fernet) if args.key_check else None
+        ).raw_data)
+    if zdict is not None:
+        fd.write(ZDictChunk(zdict_digest(zdict)).raw_data)
+    if args.index_first:
+        fd.write(IndexChunk(
+            EncodingType.SingleFile, encryption_type_of(args),
+            compress_method, 0, 0).raw_data)
+    offset = fd.tell()
+    return Checkpoint(settings, salt, 0, 0, offset, offset), fernet
+
+
+def check_resumable_output(args, checkpoint, pw, digests):
+    ''' Make sure the output of an interrupted encode can be carried on
+    with (see check_partial_output), recording the digests of its data chunks
+    if it has a manifest. Return the key to encrypt with (or None), which
+    must be the one the output was started with. '''
+    # only imported when needed, to keep startup fast
+    from .decode import check_key_check
+    with open(args.output, 'rb') as fd:
+        data_headers, crypt_info_chunk = check_partial_output(
+            args.output, fd, checkpoint)
+        fernet = None
+        if args.encrypt:
+            _, fernet = gen_key(password=pw, salt=checkpoint.salt,
+                                for_encryption=False)
+            check_key_check(crypt_info_chunk, fernet)
+            if not len(data_headers) and crypt_info_chunk.key_check is None:
+                fail_hard('Can\'t resume: there\'s nothing in', args.output,
+                          'to tell whether the key is the one it was started '
+                          'with. Remove', checkpoint_path(args.output),
+                          'to start over.')
+            if len(data_headers):
+                h = min(data_headers, key=lambda h: h.length)
+                success, msg = decrypt(fernet, read_chunk(fd, h).data)
+                if not success:
+                    fail_hard('Unable to decrypt existing data:', msg)
+        if args.manifest:
+            for h in data_headers:
+                digest = hashlib.sha256()
+                hash_range(fd.fileno(), h.data_offset, h.length, digest)
+                digests[read_data_chunk_index(fd, h)] = digest.digest()
+    return fernet
+
+
+def encode_resumably(args, compress_method, source):
+    ''' Encode args.input to args.output a frame of args.checkpoint_bytes at
+    a time, checkpointing after each one (see lib.checkpoint), or carry on
+    from the last checkpoint if an earlier encode was interrupted '''
+    zdict = read_zdict(args.zdict) if args.zdict else None
+    settings = resume_settings(args, compress_method, zdict)
+    checkpoint_fname = checkpoint_path(args.output)
+    checkpoint = read_checkpoint(checkpoint_fname)
+    if checkpoint is not None:
+        differ = sorted(k for k in set(settings) | set(checkpoint.settings)
+                        if settings.get(k) != checkpoint.settings.get(k))
+        if len(differ):
+            fail_hard('Can\'t resume: the interrupted encode had different',
+                      ', '.join(differ) + '. Remove', checkpoint_fname,
+                      'to start over.')
+        if not os.path.isfile(args.output):
+            fail_hard('Can\'t resume:', args.output, 'is gone. Remove',
+                      checkpoint_fname, 'to start over.')
+    pw = None
+    if args.encrypt and args.key_file:
+        with open(args.key_file, 'rb') as fd:
+            pw = fd.read()
+    digests = {}
+    if checkpoint is not None:
+        fernet = check_resumable_output(args, checkpoint, pw, digests)
+        log('Resuming from', checkpoint.input_offset, 'of',
+            settings['input_bytes'], 'bytes')
+    parity = parse_parity(args.parity)
+    with open(args.input, 'rb') as in_fd, \
+            open(args.output, 'wb' if checkpoint is None else 'r+b') as fd:
+        if checkpoint is None:
+            checkpoint, fernet = start_resumable_output(
+                fd, args, compress_method, source, settings, zdict, pw)
+            sync_output(fd)
+            write_checkpoint(checkpoint_fname, checkpoint)
+        else:
+            # Anything written after the checkpoint is redone
+            fd.truncate(checkpoint.output_offset)
+            fd.seek(checkpoint.output_offset, 0)
+        fingerprinter = None
+        if args.fingerprint:
+            fingerprinter = Fingerprinter(fingerprint_key(fernet))
+            fingerprinter.update_range(
+                in_fd.fileno(), 0, checkpoint.input_offset)
+        n = checkpoint.num_data_chunks
+        size = settings['input_bytes']
+        for offset in range(checkpoint.input_offset, size,
+                            args.checkpoint_bytes):
+            frame_offset = fd.tell()
+            in_fd.seek(offset, 0)
+            data_chunks = encode_data_chunks(
+                in_fd, args, compress_method, fernet, start=n, zdict=zdict,
+                level=args.compress_level, fingerprinter=fingerprinter,
+                count=args.checkpoint_bytes)
+            if args.manifest:
+                data_chunks = digest_data_chunks(data_chunks, digests)
+            if parity is not None:
+                data_chunks = add_parity_chunks(data_chunks, *parity)
+            for chunk in data_chunks:
+                write_chunk(fd, chunk)
+                if isinstance(chunk, DataChunk):
+                    n += 1
+            sync_output(fd)
+            checkpoint = checkpoint._replace(
+                input_offset=min(size, offset + args.checkpoint_bytes),
+                num_data_chunks=n, output_offset=fd.tell(),
+                frame_offset=frame_offset)
+            write_checkpoint(checkpoint_fname, checkpoint)
+        if args.manifest:
+            fd.write(ManifestChunk(digests).raw_data)
+        if args.fingerprint:
+            fd.write(fingerprinter.chunk(n).raw_data)
+        fd.write(IndexChunk(
+            EncodingType.SingleFile, encryption_type_of(args),
+            compress_method, n, 1 if args.index_first else 0).raw_data)
+        write_image_tail(fd, args.source, source)
+    os.remove(checkpoint_fname)
+
+
+def encode_into_pixels(args, compress_method):
+    ''' Encode the input like usual, but instead of adding our chunks to the
+    --source image, hide them in the least significant bits of its pixels '''
+    from ..lib import lsb  # only imported when needed, to keep startup fast
+    with open(args.source, 'rb') as fd:
+        source_chunks = read_image_stream(fd)
+    if source_chunks is None:
+        fail_hard(args.source, 'does not appear to be a PNG')
+    image = lsb.read_pixel_image(source_chunks)
+    log(args.source, 'can hold', image.capacity, 'bytes in its pixels')
+    # Compression is the only thing that can make the data smaller, so
+    # without it we can tell if the data won't fit before doing anything
+    if compress_method == CompressMethod.No and os.path.isfile(args.input) \
+            and os.path.getsize(args.input) > image.capacity:
+        fail_hard(args.input, 'is', os.path.getsize(args.input), 'bytes, '
+                  'which won\'t fit')
+    with open(args.input, 'rb') as fd:
+        payload = b''.join(
+            c.raw_data for c in completely_encode_stream(
+                fd, args, compress_method))
+    lsb.embed(image, payload)
+    with open(args.output, 'wb') as fd:
+        lsb.write_pixel_image(image, fd)
+
+
 def gen_parser(sub_p):
     p = sub_p.add_parser(
         'encode', formatter_class=ArgumentDefaultsHelpFormatter)
@@ -158,11 +684,22 @@ def gen_parser(sub_p):
         '-s', '--source', type=str, default=None,
         help='Use the specified source PNG as a base instead of the tiny '
         'default base PNG')
+    p.add_argument(
+        '--embed', type=str, default='chunks', choices=['chunks', 'lsb'],
+        help='Where to put the data. chunks: in extra chunks added to the '
+        'image. lsb: in the least significant bits of the --source image\'s '
+        'pixels, which survives tools that drop unknown chunks. lsb needs '
+        'NumPy.')
     p.add_argument(
         '-c', '--compress', type=str, default='no', nargs='?',
         choices=['no', 'gzip', 'xz'], help='Compress data before encoding. If '
         'not specified, do not compress. If specified with no argument, '
         'compress with gzip. Otherwise, compress according to the argument.')
+    p.add_argument(
+        '--compress-level', type=int, default=None,
+        help='How hard to compress, from 0 (fastest) to 9 (smallest). The '
+        'compressor\'s own default if not given. Ignored when not '
+        'compressing.')
     p.add_argument(
         '-e', '--encrypt', action='store_true', help='If specified, encrypt '
         'data before encoding')
@@ -170,10 +707,124 @@ def gen_parser(sub_p):
         '--key-file', type=str, default=None,
         help='If encrypting, read key to use for symmetric encryption '
         'from this file.')
+    p.add_argument(
+        '--key-check', action='store_true',
+        help='If encrypting, store a value made from the key next to the '
+        'salt, so that decoding with the wrong key fails as soon as the key '
+        'is derived instead of once data is read. Versions of pngrecon from '
+        'before this option was added can\'t decode such images.')
     p.add_argument(
         '--buffer-max-bytes', type=int, default=TARGET_MAX_BUFFER_BYTES,
         help='Target maximum nubmer of bytes to encode at once. Weird (but '
         'safe) stuff happens with highly compressible data.')
+    p.add_argument(
+        '--pipeline', action='store_true', help='Read, compress, encrypt, '
+        'and write on separate threads so they overlap. Uses up to a few '
+        'times --buffer-max-bytes more memory.')
+    p.add_argument(
+        '--index-first', action='store_true', help='Put the chunks saying '
+        'how the data is stored before the data chunks, so that a streaming '
+        'decode (e.g. from a pipe) can decode data as it arrives instead of '
+        'holding on to it. Adds a second index chunk.')
+    p.add_argument(
+        '--manifest', action='store_true', help='Store a SHA-256 digest of '
+        'each data chunk so `pngrecon verify` can check the data without '
+        'decrypting or decompressing it.')
+    p.add_argument(
+        '--parity', type=str, default=None, metavar='K:M',
+        help='After every K data chunks, add M parity chunks from which any '
+        'M of those K can be rebuilt if they get damaged or lost. Needs '
+        'NumPy.')
+    p.add_argument(
+        '--pool', type=str, default=None,
+        help='Cut the data into content-defined blocks and store each one in '
+        'its own image in this directory, unless it\'s already there. The '
+        'output image only lists the blocks. Decode with the same --pool. '
+        'Needs NumPy.')
+    p.add_argument(
+        '--block-avg-bytes', type=int, default=BLOCK_AVG_BYTES,
+        help='With --pool, the average size of a block')
+    p.add_argument(
+        '--zdict', type=str, default=None,
+        help='Compress with the preset dictionary in this file (see '
+        '`train-dict`), which helps a lot with small inputs. Only for -c '
+        'gzip. Decode with the same --zdict.')
+    p.add_argument(
+        '--no-fingerprint', dest='fingerprint', action='store_false',
+        help='Don\'t store the size and hash of the data, which `compare` '
+        'uses to check files against the image without decoding it. Saves '
+        'hashing the data.')
+    p.add_argument(
+        '--resume', action='store_true',
+        help='Checkpoint the encode every --checkpoint-bytes of input, in a '
+        'file next to the output, so that if it\'s interrupted, running it '
+        'again with --resume carries on from the last checkpoint instead of '
+        'starting over. The input and output must be regular files.')
+    p.add_argument(
+        '--checkpoint-bytes', type=int, default=CHECKPOINT_BYTES,
+        help='With --resume, how much input to encode between checkpoints. '
+        'Each such frame is compressed on its own.')
+    set_config_defaults(p, 'encode')
+
+
+def parse_parity(parity):
+    ''' Return (K, M) for the given --parity value, or None if not using
+    parity chunks '''
+    if parity is None:
+        return None
+    k, _, m = parity.partition(':')
+    try:
+        k, m = int(k), int(m)
+    except ValueError:
+        fail_hard('--parity must be K:M, like 10:2')
+    if k < 1 or m < 1:
+        fail_hard('--parity K and M must both be positive')
+    if k + m > MAX_STRIPE_CHUNKS:
+        fail_hard('--parity K plus M can be at most', MAX_STRIPE_CHUNKS)
+    return k, m
+
+
+def check_zdict_args(args, compress_method):
+    ''' Make sure --zdict can be used with the rest of the arguments '''
+    if compress_method != CompressMethod.Zlib:
+        fail_hard('--zdict only works with -c gzip')
+    if args.pool:
+        fail_hard('--zdict can\'t be used with --pool')
+    if not os.path.isfile(args.zdict):
+        fail_hard(args.zdict, 'must be a file')
+
+
+def check_resume_args(args):
+    ''' Make sure --resume can be used with the rest of the arguments '''
+    if args.pool:
+        fail_hard('--resume can\'t be used with --pool')
+    if args.embed == 'lsb':
+        fail_hard('--resume can\'t be used with --embed lsb')
+    if not os.path.isfile(args.input):
+        fail_hard('--resume needs the input to be a regular file')
+    if os.path.exists(args.output) and not os.path.isfile(args.output):
+        fail_hard('--resume needs the output to be a regular file')
+    if args.checkpoint_bytes < 1:
+        fail_hard('--checkpoint-bytes must be positive')
+
+
+def check_compress_level(level):
+    ''' Make sure the --compress-level value is one compressors take '''
+    if level is not None and (level < 0 or level > 9):
+        fail_hard('--compress-level must be from 0 to 9')
+
+
+def get_compress_method(compress):
+    ''' Return the CompressMethod for the given --compress value '''
+    if compress == 'no':
+        return CompressMethod.No
+    elif compress == 'gzip':
+        return CompressMethod.Zlib
+    elif compress == 'xz':
+        return CompressMethod.Lzma
+    elif compress is None:
+        return CompressMethod.Zlib
+    fail_hard('Unknown --compress value', compress)
 
 
 def main(args):
@@ -184,28 +835,61 @@ def main(args):
     if os.path.isdir(args.input):
         fail_hard('Input can\'t be a directory')
 
-    if args.compress == 'no':
-        compress_method = CompressMethod.No
-    elif args.compress == 'gzip':
-        compress_method = CompressMethod.Zlib
-    elif args.compress == 'xz':
-        compress_method = CompressMethod.Lzma
-    elif args.compress is None:
-        compress_method = CompressMethod.Zlib
-    else:
-        fail_hard('Unknown --compress value', args.compress)
-
-    if args.source:
-        source_chunks = get_provided_source_image_chunks(args)
-    else:
-        source_chunks = get_basic_source_image_chunks()
+    compress_method = get_compress_method(args.compress)
+    check_compress_level(args.compress_level)
+    parse_parity(args.parity)
+    if args.zdict:
+        check_zdict_args(args, compress_method)
 
     if args.encrypt:
         if args.key_file is not None and os.path.isdir(args.key_file):
             fail_hard(args.key_file, 'must be a file')
     elif args.key_file:
         fail_hard('Don\'t specify --key-file when not doing encryption')
+    elif args.key_check:
+        fail_hard('Don\'t specify --key-check when not doing encryption')
+
+    if args.resume:
+        check_resume_args(args)
+
+    if args.embed == 'lsb':
+        if not args.source:
+            fail_hard('--embed lsb needs a --source image to hide data in')
+        if args.pool:
+            fail_hard('--pool can\'t be used with --embed lsb')
+        return encode_into_pixels(args, compress_method)
+
+    if args.source:
+        source = get_provided_source_image_layout(args)
+    else:
+        source = get_basic_source_image_chunks()
+
+    if args.pool:
+        if args.encrypt and not args.key_file:
+            fail_hard('Encrypting with --pool needs --key-file, since every '
+                      'block is encrypted with it')
+        # Every block gets the same key, so it's only derived once
+        keys = KeyCache()
+        fingerprinter = None
+        if args.fingerprint:
+            fernet = None
+            if args.encrypt:
+                with open(args.key_file, 'rb') as fd:
+                    _, fernet = keys.gen_key(password=fd.read())
+            fingerprinter = Fingerprinter(fingerprint_key(fernet))
+        with open(args.input, 'rb') as fd:
+            block_list = encode_blocks_into_pool(
+                fd, args, compress_method, keys, fingerprinter)
+        chunks = completely_encode_stream(
+            io.BytesIO(block_list), args, compress_method,
+            gen_key=keys.gen_key, encoding_type=EncodingType.Blocks,
+            fingerprinter=fingerprinter)
+        encode_source_and_data_chunks_together(args, source, chunks)
+        return
+
+    if args.resume:
+        return encode_resumably(args, compress_method, source)
 
     with open(args.input, 'rb') as fd:
         chunks = completely_encode_stream(fd, args, compress_method)
-        encode_source_and_data_chunks_together(args, source_chunks, chunks)
+        encode_source_and_data_chunks_together(args, source, chunks)
@@ -0,0 +1,55 @@
+from ..lib.catalog import (default_catalog_path, open_catalog, find_images)
+from ..lib.chunk import CompressMethod
+from ..util.log import log_stdout as log
+from ..util.log import fail_hard
+from argparse import ArgumentDefaultsHelpFormatter
+
+# The names encode uses for compression methods
+COMPRESS_METHODS = {
+    'no': CompressMethod.No,
+    'gzip': CompressMethod.Zlib,
+    'xz': CompressMethod.Lzma,
+}
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'find', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        '--catalog', type=str, default=default_catalog_path(),
+        help='The catalog made by `index` to search. The images themselves '
+        'are not read.')
+    enc_g = p.add_mutually_exclusive_group()
+    enc_g.add_argument(
+        '--encrypted', dest='encrypted', action='store_true', default=None,
+        help='Only images with encrypted data')
+    enc_g.add_argument(
+        '--not-encrypted', dest='encrypted', action='store_false',
+        help='Only images with unencrypted data')
+    p.add_argument(
+        '-c', '--compress', type=str, default=None,
+        choices=list(COMPRESS_METHODS),
+        help='Only images with data compressed this way')
+    p.add_argument(
+        '--min-data-bytes', type=int, default=None,
+        help='Only images with at least this many bytes of (encoded) data')
+    p.add_argument(
+        '--max-data-bytes', type=int, default=None,
+        help='Only images with at most this many bytes of (encoded) data')
+
+
+def main(args):
+    conn = open_catalog(args.catalog)
+    if conn is None:
+        fail_hard('No catalog at', args.catalog, '(make one with `index`)')
+    compression = None
+    if args.compress is not None:
+        compression = COMPRESS_METHODS[args.compress].name
+    try:
+        for path in find_images(
+                conn, encrypted=args.encrypted, compression=compression,
+                min_data_bytes=args.min_data_bytes,
+                max_data_bytes=args.max_data_bytes):
+            log(path)
+    finally:
+        conn.close()
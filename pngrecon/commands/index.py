@@ -0,0 +1,96 @@
+from ..lib.catalog import (default_catalog_path, open_catalog, catalog_key)
+from ..lib.catalog import (is_current, store_record, delete_image)
+from ..lib.catalog import cataloged_paths
+from ..lib.chunk import PNG_SIG
+from ..util.log import log_stderr as log
+from ..util.log import fail_hard
+from .info import inspect_image
+from argparse import ArgumentDefaultsHelpFormatter
+import os
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'index', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        'path', nargs='+', help='Directories to search for images, or '
+        'images themselves.')
+    p.add_argument(
+        '--catalog', type=str, default=default_catalog_path(),
+        help='The catalog to update. It is created if it doesn\'t exist.')
+    p.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of worker processes inspecting images at the same time')
+
+
+def looks_like_png(fname):
+    try:
+        with open(fname, 'rb') as fd:
+            return fd.read(len(PNG_SIG)) == PNG_SIG
+    except OSError:
+        return False
+
+
+def iter_files(paths):
+    ''' Yield every file in the given paths, descending into directories '''
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, _, fnames in os.walk(path):
+            for fname in fnames:
+                yield os.path.join(dirpath, fname)
+
+
+def main(args):
+    for path in args.path:
+        if not os.path.exists(path):
+            fail_hard(path, 'must exist')
+    conn = open_catalog(args.catalog, create=True)
+    seen = set()
+    to_inspect = []
+    num_unchanged = 0
+    for fname in iter_files(args.path):
+        key = catalog_key(fname)
+        if key is None or key[0] in seen:
+            continue
+        path, st = key
+        seen.add(path)
+        if is_current(conn, path, st):
+            num_unchanged += 1
+        elif looks_like_png(fname):
+            to_inspect.append((path, st))
+    if args.jobs > 1:
+        # only imported when needed, to keep startup fast
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        records = executor.map(
+            inspect_image, [path for path, _ in to_inspect],
+            chunksize=max(1, min(64, len(to_inspect) // (args.jobs * 4))))
+    else:
+        executor = None
+        records = map(inspect_image, [path for path, _ in to_inspect])
+    num_removed = 0
+    try:
+        with conn:
+            for (path, st), record in zip(to_inspect, records):
+                if not len(record['chunks']):
+                    # Not a PNG after all, or couldn't be read
+                    delete_image(conn, path)
+                    continue
+                store_record(conn, path, st, record)
+            # Forget about images that are gone from the directories that
+            # were searched
+            for path in args.path:
+                if not os.path.isdir(path):
+                    continue
+                gone = cataloged_paths(conn, os.path.realpath(path)) - seen
+                for gone_path in gone:
+                    delete_image(conn, gone_path)
+                num_removed += len(gone)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        conn.close()
+    log('Indexed', len(to_inspect), 'images,', num_unchanged, 'unchanged,',
+        num_removed, 'removed')
@@ -1,81 +1,300 @@
-from ..lib.chunk import read_image_stream
+from ..lib.catalog import (default_catalog_path, lookup_records)
 from ..lib.chunk import ChunkType
 from ..lib.chunk import (IndexChunk, DataChunk, CryptInfoChunk)
+from ..lib.chunk import (ManifestChunk, ParityChunk, ZDictChunk)
+from ..lib.chunk import FingerprintChunk
+from ..lib.chunk import (EncodingType, EncryptionType, CompressMethod)
+from ..lib.chunk import (DigestType, latest_index_chunk)
+from ..lib.layout import scan_image_stream
+from ..lib.layout import (chunk_crc_matches, check_chunk_set, read_chunk)
 from ..util.log import log_stdout as log
-from ..util.log import fail_hard
 from argparse import ArgumentDefaultsHelpFormatter
+from io import BytesIO
+import json
+import mmap
 import os
+import stat
 
 
 def gen_parser(sub_p):
     p = sub_p.add_parser('info', formatter_class=ArgumentDefaultsHelpFormatter)
     p.add_argument('image', nargs='*', default='/dev/stdin')
+    p.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of worker processes inspecting images at the same time')
+    p.add_argument(
+        '--format', type=str, default='text', choices=['text', 'jsonl'],
+        help='text: human readable. jsonl: one JSON object per image, per '
+        'line.')
+    p.add_argument(
+        '--catalog', type=str, default=default_catalog_path(),
+        help='Describe images that have an up to date entry in this catalog '
+        '(see `index`) from it instead of reading them. Give an empty string '
+        'to always read the images.')
 
 
-def get_chunk_extra_info_index(chunk):
+def get_chunk_fields_index(chunk):
     assert isinstance(chunk, IndexChunk)
-    encoding_type = chunk.encoding_type
-    encryption_type = chunk.encryption_type
-    compress_method = chunk.compress_method
-    num_data_chunks = 'Claiming {} data chunks'.format(chunk.num_data_chunks)
-    return [encoding_type, encryption_type, compress_method, num_data_chunks]
+    return {
+        'encoding': chunk.encoding_type.name,
+        'encryption': chunk.encryption_type.name,
+        'compression': chunk.compress_method.name,
+        'num_data_chunks': chunk.num_data_chunks,
+        'generation': chunk.generation,
+    }
 
 
-def get_chunk_extra_info_data(chunk):
+def get_chunk_fields_data(chunk):
     assert isinstance(chunk, DataChunk)
-    index = 'Index {}'.format(chunk.index)
-    payload = '{} bytes of data'.format(len(chunk.data))
-    return [index, payload]
+    return {
+        'index': chunk.index,
+        'data_bytes': len(chunk.data),
+    }
 
 
-def get_chunk_extra_info_crypt_info(chunk):
+def get_chunk_fields_crypt_info(chunk):
     assert isinstance(chunk, CryptInfoChunk)
-    return []
+    return {
+        'key_check': chunk.key_check is not None,
+    }
+
+
+def get_chunk_fields_manifest(chunk):
+    assert isinstance(chunk, ManifestChunk)
+    return {
+        'digest_type': chunk.digest_type.name,
+        'num_digests': len(chunk.digests),
+    }
+
+
+def get_chunk_fields_parity(chunk):
+    assert isinstance(chunk, ParityChunk)
+    members = chunk.members
+    return {
+        'parity_row': chunk.row,
+        'first_index': members[0][0],
+        'last_index': members[-1][0],
+        'num_members': len(members),
+    }
+
+
+def get_chunk_fields_zdict(chunk):
+    assert isinstance(chunk, ZDictChunk)
+    return {
+        'zdict_digest_type': chunk.digest_type.name,
+        'zdict_digest': chunk.digest.hex(),
+    }
 
 
-def get_chunk_extra_info(chunk):
-    ''' if chunk is one of our chunks and we have extra info to log about it,
-    return a list of strings that should be printed to the user containing the
-    extra info '''
+def get_chunk_fields_fingerprint(chunk):
+    assert isinstance(chunk, FingerprintChunk)
+    return {
+        'fingerprint_digest_type': chunk.digest_type.name,
+        'fingerprint_digest': chunk.digest.hex(),
+        'fingerprint_bytes': chunk.size,
+        'fingerprint_num_data_chunks': chunk.num_data_chunks,
+    }
+
+
+def get_chunk_fields(chunk):
+    ''' if chunk is one of our chunks, return a dict of the things worth
+    knowing about it '''
     if isinstance(chunk, IndexChunk):
-        return get_chunk_extra_info_index(chunk)
+        return get_chunk_fields_index(chunk)
     elif isinstance(chunk, DataChunk):
-        return get_chunk_extra_info_data(chunk)
+        return get_chunk_fields_data(chunk)
     elif isinstance(chunk, CryptInfoChunk):
-        return get_chunk_extra_info_crypt_info(chunk)
+        return get_chunk_fields_crypt_info(chunk)
+    elif isinstance(chunk, ManifestChunk):
+        return get_chunk_fields_manifest(chunk)
+    elif isinstance(chunk, ParityChunk):
+        return get_chunk_fields_parity(chunk)
+    elif isinstance(chunk, ZDictChunk):
+        return get_chunk_fields_zdict(chunk)
+    elif isinstance(chunk, FingerprintChunk):
+        return get_chunk_fields_fingerprint(chunk)
     else:
-        return []
+        return {}
+
+
+def get_pngrecon_fields(chunks, data_bytes):
+    ''' Given our parsed chunks (except data chunks) from an image, summarize
+    what it holds. Return None if the image has no index chunk. '''
+    index_chunks = [c for c in chunks if isinstance(c, IndexChunk)]
+    if not len(index_chunks):
+        return None
+    index_chunk = latest_index_chunk(index_chunks)
+    d = get_chunk_fields_index(index_chunk)
+    d['data_bytes'] = data_bytes
+    d['manifest'] = any(isinstance(c, ManifestChunk) for c in chunks)
+    # How much data there is before compressing and encrypting, if a
+    # fingerprint that's still current says
+    d['plaintext_bytes'] = None
+    for c in chunks:
+        if isinstance(c, FingerprintChunk) and \
+                c.num_data_chunks == index_chunk.num_data_chunks:
+            d['plaintext_bytes'] = c.size
+    return d
+
+
+def inspect_layout(fd, buf, layout):
+    ''' Build the per-chunk part of an image's record, and the summary of its
+    pngrecon data. Everything is read from buf (the whole file) except our
+    small chunks, which are read from fd. '''
+    chunk_records = []
+    errors = []
+    our_chunks = []
+    data_bytes = 0
+    for h in layout:
+        valid = chunk_crc_matches(buf, h)
+        if not valid:
+            errors.append('Bad crc for {} chunk at offset {}'.format(
+                h.type, h.offset))
+        r = {'type': h.type, 'offset': h.offset, 'length': h.length,
+             'valid': valid}
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type == ChunkType.Data:
+            # Avoid reading the whole payload just to describe it
+            if h.length >= 4:
+                r['index'] = int.from_bytes(
+                    buf[h.data_offset:h.data_offset + 4], 'big')
+            r['data_bytes'] = max(0, h.length - 4)
+            data_bytes += r['data_bytes']
+        elif chunk_type is not None:
+            try:
+                c = read_chunk(fd, h)
+                r['valid'] = valid and c.is_valid
+                r.update(get_chunk_fields(c))
+                our_chunks.append(c)
+            except Exception as e:
+                r['valid'] = False
+                errors.append('Unable to parse {} chunk at offset {}: '
+                              '{}'.format(h.type, h.offset, e))
+        chunk_records.append(r)
+    pngrecon = get_pngrecon_fields(our_chunks, data_bytes)
+    if pngrecon is not None or any(
+            ChunkType.from_string(h.type) is not None for h in layout):
+        try:
+            set_errors, _ = check_chunk_set(fd, layout, buf)
+            errors.extend(set_errors)
+        except Exception as e:
+            errors.append('Unable to check chunks: {}'.format(e))
+    return chunk_records, pngrecon, errors
+
+
+def inspect_image(image):
+    ''' Return a dict describing the given image: its chunks, what pngrecon
+    data it holds (if any), and anything wrong with it. Never fails hard, so
+    that one bad image doesn't stop others from being inspected. '''
+    record = {'image': image, 'chunks': [], 'pngrecon': None, 'errors': []}
+    try:
+        st = os.stat(image)
+        if stat.S_ISDIR(st.st_mode):
+            record['errors'].append('is a directory')
+            return record
+        with open(image, 'rb') as fd:
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Pipes and such can't be mapped or seeked in, so hold on to
+                # the whole thing
+                buf = fd.read()
+                fd = BytesIO(buf)
+            try:
+                layout = scan_image_stream(fd)
+                if layout is None:
+                    record['errors'].append('does not appear to be a PNG')
+                    return record
+                record['chunks'], record['pngrecon'], errors = \
+                    inspect_layout(fd, buf, layout)
+                record['errors'].extend(errors)
+            finally:
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
+    except FileNotFoundError:
+        record['errors'].append('doesn\'t exist')
+    except OSError as e:
+        record['errors'].append(str(e))
+    return record
+
+
+def get_chunk_extra_info(r):
+    ''' Given the record of one chunk, return a list of things that should be
+    printed to the user about it, past its type and length '''
+    chunk_type = ChunkType.from_string(r['type'])
+    if 'encoding' in r:
+        return [EncodingType[r['encoding']], EncryptionType[r['encryption']],
+                CompressMethod[r['compression']],
+                'Claiming {} data chunks'.format(r['num_data_chunks']),
+                'Generation {}'.format(r['generation'])]
+    elif chunk_type == ChunkType.Data and 'index' in r:
+        return ['Index {}'.format(r['index']),
+                '{} bytes of data'.format(r['data_bytes'])]
+    elif 'digest_type' in r:
+        return [DigestType[r['digest_type']],
+                '{} data chunk digests'.format(r['num_digests'])]
+    elif 'parity_row' in r:
+        return ['Row {} of parity for {} data chunks, indexes {} to '
+                '{}'.format(r['parity_row'], r['num_members'],
+                            r['first_index'], r['last_index'])]
+    elif 'zdict_digest' in r:
+        return ['Compressed with the dictionary with {} {}'.format(
+            DigestType[r['zdict_digest_type']], r['zdict_digest'])]
+    elif 'fingerprint_digest' in r:
+        return ['{} bytes of data with {} {}, in the first {} data '
+                'chunks'.format(r['fingerprint_bytes'],
+                                DigestType[r['fingerprint_digest_type']],
+                                r['fingerprint_digest'],
+                                r['fingerprint_num_data_chunks'])]
+    return []
+
+
+def log_text_record(record):
+    image = record['image']
+    if not len(record['chunks']):
+        for e in record['errors']:
+            log(image, e)
+        return
+    log(image, 'contains', len(record['chunks']), 'chunks')
+    for r in record['chunks']:
+        chunk_type = ChunkType.from_string(r['type'])
+        if chunk_type is None:
+            chunk_type = 'Chunk {}'.format(r['type'])
+        valid = '' if r['valid'] else '(INVALID)'
+        log(chunk_type, 'with len', r['length'], valid)
+        for line in get_chunk_extra_info(r):
+            log('   ', line)
+    for e in record['errors']:
+        log('Problem:', e)
 
 
 def main(args):
     if not isinstance(args.image, list):
         args.image = [args.image]
-    for image in args.image:
-        if not os.path.exists(image):
-            log(image, 'doesn\'t exist, so skipping.')
-            continue
-        if os.path.isdir(image):
-            log(image, 'is a directory, so skipping.')
-            continue
-        with open(image, 'rb') as fd:
-            chunks = read_image_stream(fd)
-        if chunks is None:
-            fail_hard(image, 'does not appear to be a PNG')
-        log(image, 'contains', len(chunks), 'chunks')
-        for c in chunks:
-            try:
-                chunk_type = ChunkType(c.type)
-                if chunk_type == ChunkType.Index:
-                    c = IndexChunk.from_chunk(c)
-                elif chunk_type == ChunkType.CryptInfo:
-                    c = CryptInfoChunk.from_chunk(c)
-                elif chunk_type == ChunkType.Data:
-                    c = DataChunk.from_chunk(c)
-            except ValueError:
-                chunk_type = None
-            if chunk_type is None:
-                chunk_type = 'Chunk {}'.format(c.type)
-            valid = '' if c.is_valid else '(INVALID)'
-            log(chunk_type, 'with len', c.length, valid)
-            for line in get_chunk_extra_info(c):
-                log('   ', line)
+    cached = lookup_records(args.catalog, args.image)
+    misses = [image for image, r in zip(args.image, cached) if r is None]
+    if args.jobs > 1 and len(misses) > 1:
+        # only imported when needed, to keep startup fast
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        inspected = executor.map(
+            inspect_image, misses,
+            chunksize=max(1, min(64, len(misses) // (args.jobs * 4))))
+    else:
+        executor = None
+        inspected = map(inspect_image, misses)
+    # Back in the order the images were given
+    records = (r if r is not None else next(inspected) for r in cached)
+    all_ok = True
+    try:
+        for record in records:
+            if len(record['errors']):
+                all_ok = False
+            if args.format == 'jsonl':
+                log(json.dumps(record))
+            else:
+                log_text_record(record)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return 0 if all_ok else 1
@@ -0,0 +1,476 @@
+from ..lib.catalog import (default_catalog_path, lookup_records)
+from ..lib.layout import carrier_layout_cache_info
+from ..util.crypto import KeyCache
+from ..util.log import log_stderr as log
+from ..util.log import (fail_hard, FailHard)
+from .decode import (SPILL_MAX_BYTES, stream_decode)
+from .encode import (get_compress_method, get_basic_source_image_chunks)
+from .encode import (get_provided_source_image_layout, write_image)
+from .encode import (check_zdict_args, completely_encode_stream)
+from .info import inspect_image
+from argparse import (ArgumentDefaultsHelpFormatter, Namespace)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import (BaseHTTPRequestHandler, HTTPServer)
+from socketserver import UnixStreamServer
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from urllib.parse import (urlsplit, parse_qs)
+import json
+import os
+import shutil
+import signal
+import stat
+import time
+
+# How many of the most recent requests to each endpoint latency percentiles
+# are computed over
+LATENCY_WINDOW = 1024
+# Size of the pieces request bodies are read in
+BODY_READ_BYTES = 1024 * 1024  # 1 MiB
+# Default for how much data goes in each data chunk. Much smaller than the
+# command line tool's default, since many requests may be going at once.
+BUFFER_MAX_BYTES = 4 * 1024 * 1024  # 4 MiB
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'serve', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        '--listen', type=str, default='127.0.0.1:8089',
+        help='HOST:PORT to accept HTTP requests on')
+    p.add_argument(
+        '--unix', type=str, default=None,
+        help='Accept HTTP requests on this Unix socket instead of --listen')
+    p.add_argument(
+        '-j', '--workers', type=int, default=8,
+        help='Number of requests handled at the same time. Others wait.')
+    p.add_argument(
+        '--key-cache-size', type=int, default=128,
+        help='Number of derived keys to remember')
+    p.add_argument(
+        '--spill-max-bytes', type=int, default=SPILL_MAX_BYTES,
+        help='Like `decode --spill-max-bytes`, per request')
+    p.add_argument(
+        '--catalog', type=str, default=default_catalog_path(),
+        help='Like `info --catalog`, for /info requests')
+    p.add_argument(
+        '--root', type=str, default=None,
+        help='Directory that paths given in requests (key_file, source, '
+        'zdict, image) are looked up in. They can\'t name anything outside '
+        'it. Without this, requests can\'t name paths on the server at all.')
+    p.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Don\'t log every request')
+
+
+class Metrics():
+    ''' Counts of requests, bytes, and time spent for each endpoint. Thread
+    safe. '''
+    def __init__(self):
+        self.started = time.time()
+        self._endpoints = {}
+        self._lock = Lock()
+
+    def record(self, endpoint, ok, bytes_in, bytes_out, seconds):
+        with self._lock:
+            e = self._endpoints.setdefault(endpoint, {
+                'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+                'seconds': 0.0,
+                'latencies': deque(maxlen=LATENCY_WINDOW),
+            })
+            e['requests'] += 1
+            e['errors'] += 0 if ok else 1
+            e['bytes_in'] += bytes_in
+            e['bytes_out'] += bytes_out
+            e['seconds'] += seconds
+            e['latencies'].append(seconds)
+
+    def snapshot(self):
+        ''' Return a dict of everything recorded, with latency percentiles
+        (in seconds) and throughput (in bytes per second spent handling
+        requests) worked out '''
+        d = {'uptime_seconds': time.time() - self.started, 'endpoints': {}}
+        with self._lock:
+            for name, e in self._endpoints.items():
+                latencies = sorted(e['latencies'])
+                out = {k: v for k, v in e.items() if k != 'latencies'}
+                for p in (50, 90, 99):
+                    out['latency_p{}'.format(p)] = latencies[
+                        min(len(latencies) - 1, len(latencies) * p // 100)]
+                out['latency_max'] = latencies[-1]
+                out['throughput_bytes_per_second'] = \
+                    (e['bytes_in'] + e['bytes_out']) / e['seconds'] \
+                    if e['seconds'] else 0.0
+                d['endpoints'][name] = out
+        return d
+
+
+class BodyReader():
+    ''' Read a request's body like a (non-seekable) file, whether it has a
+    Content-Length or is sent chunked '''
+    def __init__(self, rfile, headers):
+        self.rfile = rfile
+        self.chunked = \
+            headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        # Bytes left in the body, or in the current chunk if chunked
+        self.remaining = 0 if self.chunked else \
+            int(headers.get('Content-Length', 0))
+        self.done = False
+        self.bytes_read = 0
+
+    def seekable(self):
+        return False
+
+    def _next_chunk(self):
+        line = self.rfile.readline(1024)
+        try:
+            size = int(line.split(b';')[0], 16)
+        except ValueError:
+            fail_hard('Bad chunk size in request body')
+        if size == 0:
+            # Skip any trailers
+            while self.rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                pass
+            self.done = True
+        self.remaining = size
+
+    def _read_some(self, n):
+        if self.chunked and not self.remaining and not self.done:
+            self._next_chunk()
+        if not self.remaining:
+            return b''
+        b = self.rfile.read(min(n, self.remaining))
+        if not len(b):
+            fail_hard('Request body ended early')
+        self.remaining -= len(b)
+        self.bytes_read += len(b)
+        if self.chunked and not self.remaining:
+            self.rfile.readline(1024)
+        return b
+
+    def read(self, n=-1):
+        ''' Read n bytes, or fewer only if the body ends first. Read the rest
+        of it if n is negative. '''
+        parts = []
+        while n != 0:
+            b = self._read_some(BODY_READ_BYTES if n < 0 else n)
+            if not len(b):
+                break
+            parts.append(b)
+            if n > 0:
+                n -= len(b)
+        return b''.join(parts)
+
+
+class ChunkedWriter():
+    ''' Write a response body with chunked transfer encoding, so a response
+    can be streamed without knowing its length, and a client can tell if it
+    was cut short by an error. start() is called before the first write. '''
+    def __init__(self, wfile, start):
+        self.wfile = wfile
+        self.start = start
+        self.started = False
+        self.bytes_written = 0
+
+    def write(self, b):
+        if not len(b):
+            return
+        if not self.started:
+            self.start()
+            self.started = True
+        self.wfile.write(b'%x\r\n' % len(b))
+        self.wfile.write(b)
+        self.wfile.write(b'\r\n')
+        self.bytes_written += len(b)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        if not self.started:
+            self.start()
+            self.started = True
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def get_bool(query, name, default=False):
+    if name not in query:
+        return default
+    return query[name][-1].lower() in ('1', 'true', 'yes', 'on', '')
+
+
+def get_server_path(root, path):
+    ''' Return where the path a request gave is on the server, which must be
+    inside root. Relative paths are relative to root. '''
+    if root is None:
+        fail_hard('This server doesn\'t take paths. Start it with --root.')
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        fail_hard(path, 'is outside --root')
+    return full
+
+
+def get_path_arg(query, name, root):
+    ''' Return the server-side path the request gave for name, if any '''
+    path = query.get(name, [None])[-1]
+    if not path:
+        return None
+    return get_server_path(root, path)
+
+
+def get_password(query, root):
+    ''' Read the key from the server-side file the request says to use, if
+    any '''
+    key_file = get_path_arg(query, 'key_file', root)
+    if key_file is None:
+        return None
+    if not os.path.isfile(key_file):
+        fail_hard(key_file, 'must be a file')
+    with open(key_file, 'rb') as fd:
+        return fd.read()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    ''' Encode, decode, and describe images sent in request bodies, streaming
+    the results back.
+
+    POST /encode?compress=gzip&encrypt=1&key_file=PATH&source=PATH&...
+    POST /decode?key_file=PATH&zdict=PATH
+    POST /info
+    GET /info?image=PATH&image=PATH...
+    GET /metrics
+
+    Paths are on the server's side, inside its --root. '''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pngrecon'
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'unix'
+
+    def log_request(self, *a):
+        if not self.server.args.quiet:
+            super().log_request(*a)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def start_response(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def send_failure(self, code, message):
+        body = bytes(message + '\n', 'utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def drain(self, body):
+        ''' Read and throw away the rest of the request's body, so the client
+        isn't still sending it when it gets an error response '''
+        try:
+            while len(body.read(BODY_READ_BYTES)):
+                pass
+        except (FailHard, OSError):
+            pass
+
+    def handle_request(self, method):
+        # Every response is the last one on its connection, which keeps
+        # clients from waiting on a body we didn't read all of
+        self.close_connection = True
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        routes = {
+            ('POST', '/encode'): ('application/octet-stream', self.encode),
+            ('POST', '/decode'): ('application/octet-stream', self.decode),
+            ('POST', '/info'): ('application/x-ndjson', self.info_body),
+            ('GET', '/info'): ('application/x-ndjson', self.info_paths),
+            ('GET', '/metrics'): ('application/json', self.metrics),
+        }
+        if (method, url.path) not in routes:
+            self.send_failure(404, 'No such endpoint')
+            return
+        content_type, func = routes[(method, url.path)]
+        body = BodyReader(self.rfile, self.headers)
+        out = ChunkedWriter(
+            self.wfile, lambda: self.start_response(content_type))
+        begin = time.monotonic()
+        ok = False
+        try:
+            func(query, body, out)
+            out.close()
+            ok = True
+        except FailHard as e:
+            if not out.started:
+                self.drain(body)
+                self.send_failure(400, e.message)
+        except Exception as e:
+            self.log_error('%s failed: %r', url.path, e)
+            if not out.started:
+                self.drain(body)
+                self.send_failure(500, 'Internal error')
+        # If the response was already started, leaving off the final chunk
+        # tells the client it didn't get all of it
+        self.server.metrics.record(
+            url.path, ok, body.bytes_read, out.bytes_written,
+            time.monotonic() - begin)
+
+    def encode(self, query, body, out):
+        root = self.server.args.root
+        args = Namespace(
+            input='request body',
+            source=get_path_arg(query, 'source', root),
+            encrypt=get_bool(query, 'encrypt'),
+            key_file=get_path_arg(query, 'key_file', root),
+            key_check=get_bool(query, 'key_check'),
+            buffer_max_bytes=int(query.get(
+                'buffer_max_bytes', [BUFFER_MAX_BYTES])[-1]),
+            pipeline=False,
+            index_first=get_bool(query, 'index_first'),
+            manifest=get_bool(query, 'manifest'),
+            parity=query.get('parity', [None])[-1] or None,
+            zdict=get_path_arg(query, 'zdict', root), pool=None,
+            compress_level=None,
+            fingerprint=get_bool(query, 'fingerprint', default=True))
+        compress_method = get_compress_method(
+            query.get('compress', ['no'])[-1] or None)
+        if args.buffer_max_bytes < 1:
+            fail_hard('buffer_max_bytes must be positive')
+        if args.key_file and not args.encrypt:
+            fail_hard('Don\'t give key_file when not doing encryption')
+        if args.key_check and not args.encrypt:
+            fail_hard('Don\'t give key_check when not doing encryption')
+        if args.key_file and not os.path.isfile(args.key_file):
+            fail_hard(args.key_file, 'must be a file')
+        if args.zdict:
+            check_zdict_args(args, compress_method)
+        if args.source:
+            if not os.path.isfile(args.source):
+                fail_hard(args.source, 'must exist')
+            source = get_provided_source_image_layout(args)
+        else:
+            source = get_basic_source_image_chunks()
+        chunks = completely_encode_stream(
+            body, args, compress_method, gen_key=self.server.keys.gen_key)
+        write_image(out, args.source, source, chunks)
+
+    def decode(self, query, body, out):
+        root = self.server.args.root
+        args = Namespace(
+            input='request body', pipeline=False,
+            buffer_max_bytes=BUFFER_MAX_BYTES,
+            spill_max_bytes=self.server.args.spill_max_bytes, pool=None,
+            zdict=get_path_arg(query, 'zdict', root))
+        for data in stream_decode(
+                body, get_password(query, root), args,
+                gen_key=self.server.keys.gen_key):
+            out.write(data)
+
+    def info_body(self, query, body, out):
+        with NamedTemporaryFile(prefix='pngrecon-serve-') as fd:
+            shutil.copyfileobj(body, fd, BODY_READ_BYTES)
+            fd.flush()
+            record = inspect_image(fd.name)
+        record['image'] = query.get('name', ['-'])[-1]
+        out.write(bytes(json.dumps(record) + '\n', 'utf-8'))
+
+    def info_paths(self, query, body, out):
+        images = [get_server_path(self.server.args.root, image)
+                  for image in query.get('image', [])]
+        cached = lookup_records(self.server.args.catalog, images)
+        for image, record in zip(images, cached):
+            if record is None:
+                record = inspect_image(image)
+            out.write(bytes(json.dumps(record) + '\n', 'utf-8'))
+
+    def metrics(self, query, body, out):
+        d = self.server.metrics.snapshot()
+        keys = self.server.keys
+        d['key_cache'] = {'hits': keys.hits, 'misses': keys.misses}
+        carriers = carrier_layout_cache_info()
+        d['carrier_cache'] = {
+            'hits': carriers.hits, 'misses': carriers.misses,
+            'size': carriers.currsize}
+        d['workers'] = self.server.args.workers
+        out.write(bytes(json.dumps(d) + '\n', 'utf-8'))
+
+
+class PooledServerMixIn():
+    ''' Like socketserver.ThreadingMixIn, but requests are handled by a
+    fixed number of threads that stay around between requests '''
+    def setup_pool(self, args):
+        self.args = args
+        self.metrics = Metrics()
+        self.keys = KeyCache(maxsize=args.key_cache_size)
+        self.pool = ThreadPoolExecutor(
+            max_workers=args.workers, thread_name_prefix='pngrecon-serve')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+class PooledHTTPServer(PooledServerMixIn, HTTPServer):
+    pass
+
+
+class PooledUnixHTTPServer(PooledServerMixIn, UnixStreamServer):
+    pass
+
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def main(args):
+    if args.workers < 1:
+        fail_hard('--workers must be at least 1')
+    if args.root is not None:
+        if not os.path.isdir(args.root):
+            fail_hard('--root must be a directory')
+        args.root = os.path.realpath(args.root)
+    if args.unix:
+        if os.path.exists(args.unix):
+            if not stat.S_ISSOCK(os.stat(args.unix).st_mode):
+                fail_hard(args.unix, 'exists and isn\'t a socket')
+            os.unlink(args.unix)
+        server = PooledUnixHTTPServer(args.unix, RequestHandler)
+        where = args.unix
+    else:
+        host, _, port = args.listen.rpartition(':')
+        if not host or not port.isdigit():
+            fail_hard('--listen must be HOST:PORT')
+        server = PooledHTTPServer((host, int(port)), RequestHandler)
+        where = '{}:{}'.format(*server.server_address[:2])
+    server.setup_pool(args)
+    # Shut down cleanly (removing the --unix socket) when asked to stop
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    log('Listening on', where)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if args.unix:
+            os.unlink(args.unix)
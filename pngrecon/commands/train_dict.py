@@ -0,0 +1,62 @@
+from ..lib.zdict import (ZDICT_MAX_BYTES, train_zdict, zdict_digest)
+from ..util.log import log_stderr as log
+from ..util.log import fail_hard
+from .index import iter_files
+from argparse import ArgumentDefaultsHelpFormatter
+import os
+
+# Default for how much of the samples to train on
+SAMPLE_MAX_BYTES = 16 * 1024 * 1024  # 16 MiB
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'train-dict', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument(
+        'sample', nargs='+', help='Files like the ones the dictionary is for, '
+        'or directories to search for them.')
+    p.add_argument('-o', '--output', type=str, default='/dev/stdout',
+                   help='Where to write the dictionary')
+    p.add_argument(
+        '--size', type=int, default=ZDICT_MAX_BYTES,
+        help='Most bytes the dictionary can have. zlib can\'t use more than '
+        'the default.')
+    p.add_argument(
+        '--sample-max-bytes', type=int, default=SAMPLE_MAX_BYTES,
+        help='Stop reading samples after this many bytes')
+
+
+def read_samples(paths, max_bytes):
+    ''' Return the contents of the files in the given paths, in order, until
+    there are max_bytes of them '''
+    samples = []
+    total = 0
+    for fname in iter_files(paths):
+        if total >= max_bytes:
+            break
+        with open(fname, 'rb') as fd:
+            b = fd.read(max_bytes - total)
+        if len(b):
+            samples.append(b)
+            total += len(b)
+    return samples
+
+
+def main(args):
+    for path in args.sample:
+        if not os.path.exists(path):
+            fail_hard(path, 'must exist')
+    if args.size < 1 or args.size > ZDICT_MAX_BYTES:
+        fail_hard('--size must be from 1 to', ZDICT_MAX_BYTES)
+    samples = read_samples(args.sample, args.sample_max_bytes)
+    if len(samples) < 2:
+        fail_hard('Need at least 2 samples to find what they have in common')
+    zdict = train_zdict(samples, args.size)
+    if not len(zdict):
+        fail_hard('The samples have nothing in common to put in a '
+                  'dictionary')
+    log('Trained a {} byte dictionary with SHA-256 {} from {} samples ({} '
+        'bytes)'.format(len(zdict), zdict_digest(zdict).hex(), len(samples),
+                        sum(len(s) for s in samples)))
+    with open(args.output, 'wb') as fd:
+        fd.write(zdict)
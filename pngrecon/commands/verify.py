@@ -0,0 +1,89 @@
+from ..lib.chunk import DigestType
+from ..lib.layout import scan_image_stream
+from ..lib.layout import (chunk_crc_matches, check_chunk_set)
+from ..util.log import log_stdout as log
+from argparse import ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
+
+
+def gen_parser(sub_p):
+    p = sub_p.add_parser(
+        'verify', formatter_class=ArgumentDefaultsHelpFormatter)
+    p.add_argument('image', nargs='+')
+    p.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='Number of threads checking chunks at the same time')
+    p.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Only print something for images that fail verification')
+
+
+def digest_matches(buf, header, digest_type, digest):
+    ''' Return whether the digest of the data field of the chunk with the
+    given header in buf matches the given digest '''
+    assert digest_type == DigestType.Sha256
+    with memoryview(buf) as view:
+        d = hashlib.sha256(view[header.data_offset:header.crc_offset])
+    return d.digest() == digest
+
+
+def verify_image(fname, executor):
+    ''' Check the given image without decrypting or decompressing anything.
+    Every chunk's crc is checked, and every data chunk listed in a manifest
+    has its digest checked, with the checks spread over executor. Return the
+    number of chunks, the number of digests checked, and a list of problems
+    found. '''
+    with open(fname, 'rb') as fd:
+        layout = scan_image_stream(fd)
+        if layout is None:
+            return 0, 0, ['Not a PNG, or truncated']
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            errors, expected_digests = check_chunk_set(fd, layout, buf)
+            crc_checks = [
+                (h, executor.submit(chunk_crc_matches, buf, h))
+                for h in layout]
+            digest_checks = [
+                (h, executor.submit(digest_matches, buf, h, t, d))
+                for h, (t, d) in expected_digests.items()]
+            for h, f in crc_checks:
+                if not f.result():
+                    errors.append('Bad crc for {} chunk at offset {}'.format(
+                        h.type, h.offset))
+            for h, f in digest_checks:
+                if not f.result():
+                    errors.append('Digest mismatch for data chunk at offset '
+                                  '{}'.format(h.offset))
+    return len(layout), len(digest_checks), errors
+
+
+def main(args):
+    if args.jobs < 1:
+        args.jobs = 1
+    all_ok = True
+    # Images are verified a few at a time so that many small images keep the
+    # chunk pool busy just as well as one big image does.
+    with ThreadPoolExecutor(max_workers=args.jobs) as chunk_executor, \
+            ThreadPoolExecutor(max_workers=args.jobs) as image_executor:
+        def verify(fname):
+            if not os.path.isfile(fname):
+                return 0, 0, ['Doesn\'t exist or isn\'t a file']
+            if os.path.getsize(fname) == 0:
+                return 0, 0, ['Empty file']
+            try:
+                return verify_image(fname, chunk_executor)
+            except OSError as e:
+                return 0, 0, [str(e)]
+        for fname, (num_chunks, num_digests, errors) in zip(
+                args.image, image_executor.map(verify, args.image)):
+            if len(errors):
+                all_ok = False
+                log(fname, 'FAILED')
+                for e in errors:
+                    log('   ', e)
+            elif not args.quiet:
+                log(fname, 'OK', '({} chunks, {} digests)'.format(
+                    num_chunks, num_digests))
+    return 0 if all_ok else 1
@@ -0,0 +1,163 @@
+''' Content-defined chunking, and the pool of images that blocks cut that way
+are stored in, each one only once.
+
+Input is cut where a rolling hash of the last HASH_WINDOW bytes has its top
+bits all zero, so a boundary only depends on the bytes right before it.
+Inserting or removing bytes only changes the blocks around the change, and
+everything after it is cut the same way it was before. The hash is a gear
+hash, h = (h << 1) + GEAR[byte], over a window of 32 bytes (it's 32 bits, so
+older bytes are shifted out), computed for a whole buffer at once with NumPy;
+NumPy is only needed when using this.
+
+A pool is a directory. Each block is stored in a pngrecon image of its own,
+named by the SHA-256 of the block, and an SQLite index of which blocks are
+there lets encoders skip ones they don't have to store without touching the
+images. All the blocks in a pool are compressed and encrypted the same way.
+'''
+from ..util.log import fail_hard
+import hashlib
+import os
+import struct
+
+# A reference to a block in a block list: its SHA-256 and its length
+BLOCK_REF = struct.Struct('>32sQ')
+# Default average size of a block. Blocks are between a quarter of and four
+# times the average.
+BLOCK_AVG_BYTES = 1024 * 1024  # 1 MiB
+HASH_WINDOW = 32
+# One random 32 bit number for each byte value. Derived rather than listed,
+# but it must never change or blocks would stop being found in pools.
+GEAR = tuple(
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+    for i in range(256))
+POOL_INDEX = 'index.sqlite3'
+POOL_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (
+    compression TEXT NOT NULL,
+    encryption TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    digest BLOB PRIMARY KEY,
+    length INTEGER NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        fail_hard('NumPy is needed to cut data into blocks. Install it with '
+                  '`pip install numpy`.')
+    return numpy
+
+
+def block_sizes(avg_size):
+    ''' Return the minimum and maximum block size, and how many top bits of
+    the hash must be zero to cut, for the given average block size '''
+    if avg_size < 4 * HASH_WINDOW:
+        fail_hard('The average block size must be at least', 4 * HASH_WINDOW)
+    bits = min(max(avg_size.bit_length() - 1, 1), 31)
+    return avg_size // 4, avg_size * 4, bits
+
+
+def find_cuts(np, data, min_size, max_size, bits):
+    ''' Return the offsets in data to cut it at, each one the end of a block.
+    Whatever is after the last one isn't a whole block yet. '''
+    gear = np.array(GEAR, dtype=np.uint32)
+    h = gear[np.frombuffer(data, dtype=np.uint8)]
+    # After the pass with shift s, h[i] is the hash of the 2s bytes ending at
+    # i, so five passes make it the hash of the last 32
+    shift = 1
+    while shift < HASH_WINDOW:
+        h[shift:] += h[:-shift] << np.uint32(shift)
+        shift <<= 1
+    candidates = np.flatnonzero((h >> np.uint32(32 - bits)) == 0) + 1
+    cuts = []
+    last = 0
+    while True:
+        i = np.searchsorted(candidates, last + min_size)
+        if i < len(candidates) and candidates[i] <= last + max_size:
+            cut = int(candidates[i])
+        elif last + max_size <= len(data):
+            cut = last + max_size
+        else:
+            return cuts
+        cuts.append(cut)
+        last = cut
+
+
+def iter_blocks(stream, avg_size=BLOCK_AVG_BYTES):
+    ''' Read the rest of the stream and yield it cut into content-defined
+    blocks. At most two of the biggest blocks are held at once. '''
+    np = import_numpy()
+    min_size, max_size, bits = block_sizes(avg_size)
+    pending = b''
+    while True:
+        b = stream.read(max_size)
+        pending += b
+        last = 0
+        for cut in find_cuts(np, pending, min_size, max_size, bits):
+            yield pending[last:cut]
+            last = cut
+        pending = pending[last:]
+        if not len(b):
+            if len(pending):
+                yield pending
+            return
+
+
+def pack_block_ref(digest, length):
+    return BLOCK_REF.pack(digest, length)
+
+
+def block_path(pool, digest):
+    ''' Where the image holding the block with the given digest is in the
+    pool, whether or not it's there '''
+    h = digest.hex()
+    return os.path.join(pool, h[:2], h + '.png')
+
+
+def open_pool(pool):
+    ''' Return a connection to the index of the pool in the given directory,
+    creating both if needed '''
+    # only imported when needed, to keep startup fast
+    import sqlite3
+    os.makedirs(pool, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(pool, POOL_INDEX))
+    with conn:
+        conn.executescript(POOL_SCHEMA)
+    return conn
+
+
+def pool_settings(conn, compress_method, encryption_type):
+    ''' Make sure the pool's blocks are compressed and encrypted the given
+    way, recording that if this is the first time it's used '''
+    row = conn.execute(
+        'SELECT compression, encryption FROM settings').fetchone()
+    if row is None:
+        with conn:
+            conn.execute('INSERT INTO settings VALUES (?, ?)', (
+                compress_method.name, encryption_type.name))
+    elif row != (compress_method.name, encryption_type.name):
+        fail_hard('The pool\'s blocks are stored with compression', row[0],
+                  'and encryption', row[1], 'so those must be used with it')
+
+
+def has_block(conn, digest):
+    return conn.execute(
+        'SELECT 1 FROM blocks WHERE digest = ?', (digest,)).fetchone() \
+        is not None
+
+
+def add_block(conn, digest, length):
+    conn.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?)',
+                 (digest, length))
+
+
+def smallest_block(conn):
+    ''' Return the digest and length of the smallest block in the pool, or
+    None if it's empty '''
+    return conn.execute(
+        'SELECT digest, length FROM blocks ORDER BY length LIMIT 1'
+    ).fetchone()
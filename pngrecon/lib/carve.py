@@ -0,0 +1,155 @@
+''' Finding images stored inside larger files, like disk images, tar archives,
+or dumps that several images were concatenated into (see `pngrecon carve`).
+
+The file is mapped into memory and split into regions that can be searched
+at the same time. Each region is searched for PNG signatures, and a
+signature is only taken to start an image if chunks with matching CRCs
+follow it all the way to IEND. Each region is also searched for the types of
+our most common chunks, so that chunks whose image lost its signature or
+some other chunk can still be salvaged: starting from such a chunk, as many
+chunks as follow it intact make up a run, which is enough for decode if it
+has all of our chunks. '''
+from .chunk import (ChunkType, PNG_SIG)
+from .layout import (ChunkHeader, chunk_crc_matches)
+from bisect import bisect_right
+from collections import namedtuple
+import mmap
+import struct
+
+# How much of the file each worker searches at a time
+CARVE_REGION_BYTES = 64 * 1024 * 1024  # 64 MiB
+# Chunks of these types are searched for to salvage. Every image has an index
+# chunk and most of its chunks are data chunks, so a damaged image almost
+# certainly still has one of them in each intact run.
+CARVE_TAGS = tuple(bytes(t.value, 'utf-8') for t in (
+    ChunkType.Index, ChunkType.Data, ChunkType.CryptInfo))
+
+# A whole PNG found in a larger file: the bytes [start, end), from its
+# signature to the end of its IEND chunk, and whether it has an index chunk
+CarvedImage = namedtuple('CarvedImage', ['start', 'end', 'ours'])
+# The bytes [start, end) of a larger file, which hold intact chunks starting
+# with one of ours, outside of any whole PNG
+ChunkRun = namedtuple('ChunkRun', ['start', 'end'])
+
+
+def chunk_header_at(buf, offset, size):
+    ''' Return the ChunkHeader of the chunk that would be at offset in buf,
+    the first size bytes of which are valid, or None if there can't be one
+    there: its type isn't four letters or it doesn't fit. Nothing is CRC
+    checked. '''
+    if offset + 12 > size:
+        return None
+    chunk_len, chunk_type = struct.unpack_from('>I4s', buf, offset)
+    if not chunk_type.isalpha():
+        return None
+    h = ChunkHeader(offset, chunk_len, str(chunk_type, 'ascii'))
+    if h.end > size:
+        return None
+    return h
+
+
+def walk_chunks(buf, offset, size):
+    ''' Return the ChunkHeaders of the chunks that follow one another from
+    offset in buf, for as long as they fit and their CRCs match, up to and
+    including IEND '''
+    headers = []
+    while True:
+        h = chunk_header_at(buf, offset, size)
+        if h is None or not chunk_crc_matches(buf, h):
+            return headers
+        headers.append(h)
+        if h.type == 'IEND':
+            return headers
+        offset = h.end
+
+
+def image_at(buf, offset, size):
+    ''' Return the CarvedImage of the PNG whose signature is at offset in
+    buf, or None if it isn't whole '''
+    headers = walk_chunks(buf, offset + len(PNG_SIG), size)
+    if not len(headers) or headers[-1].type != 'IEND':
+        return None
+    ours = any(h.type == ChunkType.Index.value for h in headers)
+    return CarvedImage(offset, headers[-1].end, ours)
+
+
+def find_all(buf, needle, start, end):
+    ''' Yield every offset in [start, end) where needle starts in buf. It may
+    run past end. '''
+    stop = min(len(buf), end + len(needle) - 1)
+    i = buf.find(needle, start, stop)
+    while i != -1:
+        yield i
+        i = buf.find(needle, i + 1, stop)
+
+
+def scan_region(fname, start, end):
+    ''' Search the bytes [start, end) of the file for images and our chunks.
+    Return the CarvedImages whose signatures are there, and the offsets of
+    the chunks whose types (in CARVE_TAGS) are there and that could be
+    chunks (see chunk_header_at), in order. Takes a file name so that it can
+    be run on a process pool, one region per call.
+
+    Images are followed past end. The search carries on after the end of
+    each image found, since anything inside it is its data, and it's only
+    there that chunks are searched for. '''
+    images = []
+    tags = []
+    with open(fname, 'rb') as fd:
+        size = fd.seek(0, 2)
+        with mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ) as buf:
+            # The parts of the region outside of images, as [start, end)
+            # ranges that chunks' types may start in
+            gaps = []
+            gap_start = max(start, 4)
+            stop = min(size, end + len(PNG_SIG) - 1)
+            i = buf.find(PNG_SIG, start, stop)
+            while i != -1:
+                image = image_at(buf, i, size)
+                if image is None:
+                    i = buf.find(PNG_SIG, i + 1, stop)
+                    continue
+                images.append(image)
+                gaps.append((gap_start, i))
+                # Chunks start four bytes before their types
+                gap_start = image.end + 4
+                i = buf.find(PNG_SIG, image.end, stop) \
+                    if image.end < end else -1
+            gaps.append((gap_start, end))
+            for tag in CARVE_TAGS:
+                for gap_start, gap_end in gaps:
+                    if gap_start >= gap_end:
+                        continue
+                    for i in find_all(buf, tag, gap_start, gap_end):
+                        if chunk_header_at(buf, i - 4, size) is not None:
+                            tags.append(i - 4)
+    return images, sorted(tags)
+
+
+def outermost_images(images):
+    ''' Given CarvedImages in order, return the ones that aren't inside
+    another one, like PNGs stored in an image without compression '''
+    kept = []
+    for image in images:
+        if len(kept) and image.start < kept[-1].end:
+            continue
+        kept.append(image)
+    return kept
+
+
+def salvage_runs(buf, size, images, tags):
+    ''' Return the ChunkRuns that start at the given chunk offsets (in order)
+    that aren't inside any of the outermost images. Each is as many intact
+    chunks as follow one another from there. '''
+    starts = [image.start for image in images]
+    runs = []
+    for offset in tags:
+        if len(runs) and offset < runs[-1].end:
+            continue
+        i = bisect_right(starts, offset) - 1
+        if i >= 0 and offset < images[i].end:
+            continue
+        headers = walk_chunks(buf, offset, size)
+        if len(headers):
+            runs.append(ChunkRun(offset, headers[-1].end))
+    return runs
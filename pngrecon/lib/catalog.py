@@ -0,0 +1,216 @@
+from .layout import ChunkHeader
+import json
+import os
+
+# Environment variable that, if set, is the default path to the catalog
+CATALOG_ENV = 'PNGRECON_CATALOG'
+# Bump whenever the tables change. Catalogs with a different version are
+# rebuilt from scratch: they are only a cache of what's in the images.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE images (
+    path TEXT PRIMARY KEY,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    encoding TEXT,
+    encryption TEXT,
+    compression TEXT,
+    num_data_chunks INTEGER,
+    generation INTEGER,
+    data_bytes INTEGER,
+    manifest INTEGER,
+    plaintext_bytes INTEGER,
+    errors TEXT NOT NULL
+);
+CREATE INDEX images_data_bytes ON images (data_bytes);
+CREATE TABLE chunks (
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    valid INTEGER NOT NULL,
+    data_index INTEGER,
+    data_bytes INTEGER,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (path, seq)
+) WITHOUT ROWID;
+'''
+
+# Columns of the images table that come straight from the 'pngrecon' part of
+# a record made by `info`
+PNGRECON_COLUMNS = (
+    'encoding', 'encryption', 'compression', 'num_data_chunks', 'generation',
+    'data_bytes', 'manifest', 'plaintext_bytes')
+
+
+def default_catalog_path():
+    ''' Where the catalog is if not told otherwise '''
+    if os.environ.get(CATALOG_ENV) is not None:
+        return os.environ[CATALOG_ENV]
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'pngrecon', 'catalog.sqlite3')
+
+
+def open_catalog(catalog, create=False):
+    ''' Return a connection to the catalog at the given path, or None if
+    there isn't one there (or the path is empty) and create is False '''
+    if not catalog or (not create and not os.path.exists(catalog)):
+        return None
+    # only imported when needed, to keep startup fast
+    import sqlite3
+    if create:
+        os.makedirs(os.path.dirname(os.path.abspath(catalog)), exist_ok=True)
+    conn = sqlite3.connect(catalog)
+    version, = conn.execute('PRAGMA user_version').fetchone()
+    if version != SCHEMA_VERSION:
+        if not create:
+            conn.close()
+            return None
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS chunks')
+            conn.execute('DROP TABLE IF EXISTS images')
+            conn.executescript(SCHEMA)
+            conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    return conn
+
+
+def catalog_key(fname):
+    ''' Return the path an image is stored under in the catalog and the
+    result of stat()ing it, or None if it's not something that can be
+    cataloged (doesn't exist, isn't a regular file) '''
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    if not os.path.isfile(fname):
+        return None
+    return os.path.realpath(fname), st
+
+
+def is_current(conn, path, st):
+    ''' Return whether the catalog has an entry for the image at path and the
+    file hasn't changed since the entry was made '''
+    row = conn.execute(
+        'SELECT dev, ino, size, mtime_ns FROM images WHERE path = ?',
+        (path,)).fetchone()
+    return row == (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def store_record(conn, path, st, record):
+    ''' Replace whatever the catalog has for the image at path with the given
+    record, as made by `info`. st is the result of stat()ing the image before
+    it was inspected. '''
+    delete_image(conn, path)
+    pngrecon = record['pngrecon'] or {}
+    conn.execute(
+        'INSERT INTO images VALUES (?, ?, ?, ?, ?, {})'.format(
+            ', '.join('?' * (len(PNGRECON_COLUMNS) + 1))),
+        (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) +
+        tuple(pngrecon.get(c) for c in PNGRECON_COLUMNS) +
+        (json.dumps(record['errors']),))
+    rows = []
+    for seq, c in enumerate(record['chunks']):
+        fields = {k: v for k, v in c.items() if k not in (
+            'type', 'offset', 'length', 'valid', 'index', 'data_bytes')}
+        rows.append((
+            path, seq, c['type'], c['offset'], c['length'], c['valid'],
+            c.get('index'), c.get('data_bytes'), json.dumps(fields)))
+    conn.executemany(
+        'INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def delete_image(conn, path):
+    conn.execute('DELETE FROM chunks WHERE path = ?', (path,))
+    conn.execute('DELETE FROM images WHERE path = ?', (path,))
+
+
+def cataloged_paths(conn, directory):
+    ''' Return the set of cataloged paths that are somewhere under the given
+    (real) directory '''
+    prefix = os.path.join(directory, '')
+    return set(path for path, in conn.execute(
+        'SELECT path FROM images WHERE substr(path, 1, ?) = ?',
+        (len(prefix), prefix)))
+
+
+def _load_record(conn, fname):
+    key = catalog_key(fname)
+    if key is None or not is_current(conn, *key):
+        return None
+    path, _ = key
+    row = conn.execute(
+        'SELECT {}, errors FROM images WHERE path = ?'.format(
+            ', '.join(PNGRECON_COLUMNS)), (path,)).fetchone()
+    pngrecon = None
+    if row[0] is not None:
+        pngrecon = dict(zip(PNGRECON_COLUMNS, row))
+        pngrecon['manifest'] = bool(pngrecon['manifest'])
+    chunks = []
+    for type_, offset, length, valid, data_index, data_bytes, fields in \
+            conn.execute(
+                'SELECT type, offset, length, valid, data_index, data_bytes, '
+                'fields FROM chunks WHERE path = ? ORDER BY seq', (path,)):
+        c = {'type': type_, 'offset': offset, 'length': length,
+             'valid': bool(valid)}
+        if data_index is not None:
+            c['index'] = data_index
+        if data_bytes is not None:
+            c['data_bytes'] = data_bytes
+        c.update(json.loads(fields))
+        chunks.append(c)
+    return {'image': fname, 'chunks': chunks, 'pngrecon': pngrecon,
+            'errors': json.loads(row[-1])}
+
+
+def lookup_records(catalog, fnames):
+    ''' Return a list with the cataloged record (like `info` makes) for each
+    of the given images, or None for ones the catalog doesn't have an up to
+    date entry for. Images are stat()ed but not read. '''
+    conn = open_catalog(catalog)
+    if conn is None:
+        return [None] * len(fnames)
+    try:
+        return [_load_record(conn, fname) for fname in fnames]
+    finally:
+        conn.close()
+
+
+def lookup_layout(catalog, fname):
+    ''' Return the ChunkHeaders of the given image, like scan_image_stream
+    would, if the catalog has an up to date entry for it. Otherwise return
+    None. '''
+    record, = lookup_records(catalog, [fname])
+    if record is None or not len(record['chunks']):
+        return None
+    return tuple(
+        ChunkHeader(c['offset'], c['length'], c['type'])
+        for c in record['chunks'])
+
+
+def find_images(conn, encrypted=None, compression=None, min_data_bytes=None,
+                max_data_bytes=None):
+    ''' Yield the paths of cataloged images holding pngrecon data that match
+    all the given criteria. Only the catalog is consulted. '''
+    where = ['encoding IS NOT NULL']
+    params = []
+    if encrypted is not None:
+        where.append('encryption {} ?'.format('!=' if encrypted else '='))
+        params.append('No')
+    if compression is not None:
+        where.append('compression = ?')
+        params.append(compression)
+    if min_data_bytes is not None:
+        where.append('data_bytes >= ?')
+        params.append(min_data_bytes)
+    if max_data_bytes is not None:
+        where.append('data_bytes <= ?')
+        params.append(max_data_bytes)
+    for path, in conn.execute(
+            'SELECT path FROM images WHERE {} ORDER BY path'.format(
+                ' AND '.join(where)), params):
+        yield path
@@ -0,0 +1,118 @@
+''' Checkpoints that let `encode --resume` carry on with an encode that was
+interrupted instead of starting over.
+
+A resumable encode cuts the input into frames, each compressed on its own
+(decode already handles one compressed stream after another, like appends
+make) and each with its own parity stripes, so that nothing carries over
+from one frame to the next. After each frame the output is synced to disk,
+and then a small JSON file next to it (see checkpoint_path) records how far
+into the input and the output it got, how many data chunks there are, the
+salt, and the settings used. Only those settings can resume it. Anything in
+the output past the last checkpoint is thrown away. '''
+from ..util.fastcopy import crc32_range
+from ..util.log import fail_hard
+from .chunk import (ChunkType, CryptInfoChunk, PNG_SIG)
+from .layout import (ChunkHeader, read_chunk)
+from collections import namedtuple
+import json
+import os
+import struct
+
+CHECKPOINT_VERSION = 1
+# How much input goes between checkpoints by default, which is at most how
+# much work an interrupted encode loses
+CHECKPOINT_BYTES = 1024 * 1024 * 1024  # 1 GiB
+
+# settings is a dict of what the encode was told to do, which must match to
+# resume it. The bytes [0, input_offset) of the input are stored in the
+# first num_data_chunks data chunks, in the bytes [0, output_offset) of the
+# output, and the last frame's chunks start at frame_offset. salt is None if
+# not encrypting.
+Checkpoint = namedtuple('Checkpoint', [
+    'settings', 'salt', 'input_offset', 'num_data_chunks', 'output_offset',
+    'frame_offset'])
+
+
+def checkpoint_path(output):
+    ''' Where the checkpoint of an encode to output is kept '''
+    return output + '.resume'
+
+
+def read_checkpoint(fname):
+    ''' Return the Checkpoint in the given file, or None if there isn't one
+    '''
+    try:
+        with open(fname, 'r') as fd:
+            d = json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        fail_hard('Can\'t read the checkpoint in', fname + ':', e)
+    if d.get('version') != CHECKPOINT_VERSION:
+        fail_hard(fname, 'is a checkpoint from an unknown version')
+    salt = bytes.fromhex(d['salt']) if d['salt'] is not None else None
+    return Checkpoint(d['settings'], salt, d['input_offset'],
+                      d['num_data_chunks'], d['output_offset'],
+                      d['frame_offset'])
+
+
+def write_checkpoint(fname, checkpoint):
+    ''' Replace the checkpoint in the given file, which is never left half
+    written '''
+    d = checkpoint._asdict()
+    d['version'] = CHECKPOINT_VERSION
+    d['salt'] = checkpoint.salt.hex() if checkpoint.salt is not None else None
+    tmp = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'w') as fd:
+        json.dump(d, fd, sort_keys=True)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp, fname)
+
+
+def check_partial_output(fname, fd, checkpoint):
+    ''' Make sure the output open as fd (for reading) is how the checkpoint
+    left it: whole chunks up to output_offset, the right number of data
+    chunks, CRCs that match in the last frame, and the same salt. Whatever is
+    after output_offset isn't looked at. Return the ChunkHeaders of its data
+    chunks, and its crypt info chunk (or None). '''
+    def cant(*a):
+        fail_hard('Can\'t resume:', fname, *a)
+    size = fd.seek(0, 2)
+    if size < checkpoint.output_offset:
+        cant('is shorter than when it was checkpointed')
+    fd.seek(0, 0)
+    if fd.read(len(PNG_SIG)) != PNG_SIG:
+        cant('doesn\'t start with a PNG signature')
+    data_headers = []
+    crypt_info_chunk = None
+    offset = len(PNG_SIG)
+    while offset < checkpoint.output_offset:
+        if offset + 12 > checkpoint.output_offset:
+            cant('has a partial chunk at offset', offset)
+        fd.seek(offset, 0)
+        chunk_len, chunk_type = struct.unpack('>I4s', fd.read(8))
+        h = ChunkHeader(
+            offset, chunk_len, str(chunk_type, 'utf-8', 'replace'))
+        if h.end > checkpoint.output_offset:
+            cant('has a chunk at offset', offset, 'that runs past the last '
+                 'checkpoint')
+        if h.offset >= checkpoint.frame_offset:
+            fd.seek(h.crc_offset, 0)
+            stored, = struct.unpack('>I', fd.read(4))
+            if crc32_range(fd.fileno(), h.offset + 4, h.length + 4) != stored:
+                cant('has a damaged chunk at offset', offset)
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type == ChunkType.Data:
+            data_headers.append(h)
+        elif chunk_type == ChunkType.CryptInfo:
+            crypt_info_chunk = read_chunk(fd, h)
+        offset = h.end
+    if len(data_headers) != checkpoint.num_data_chunks:
+        cant('has', len(data_headers), 'data chunks, not',
+             checkpoint.num_data_chunks)
+    salt = crypt_info_chunk.salt \
+        if isinstance(crypt_info_chunk, CryptInfoChunk) else None
+    if salt != checkpoint.salt:
+        cant('doesn\'t have the salt that was checkpointed')
+    return data_headers, crypt_info_chunk
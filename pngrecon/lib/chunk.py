@@ -23,24 +23,45 @@ def read_image_stream(stream):
     return chunks
 
 
+def iter_image_stream(stream):
+    ''' Yield the chunks of a PNG from the given stream one at a time as they
+    are read. Unlike read_image_stream, this never seeks or peeks, so it works
+    on pipes, and it doesn't hold on to chunks. Assumes we're just past the
+    PNG signature, and stops at the end of the stream. '''
+    while True:
+        c = Chunk.from_byte_stream(stream)
+        if c is None:
+            return
+        yield c
+
+
 class Chunk():
     def __init__(self, chunk_type, data):
         chunk_type = bytes(chunk_type, 'utf-8')
-        self._data = struct.pack('>I', len(data)) + chunk_type + data +\
-            struct.pack('>I', zlib.crc32(chunk_type + data))
+        # Data may be large, so avoid making more copies of it than needed
+        self._data = b''.join((
+            struct.pack('>I', len(data)), chunk_type, data,
+            struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)))))
         assert self.is_valid
 
     @classmethod
     def from_byte_stream(cls, stream):
         ''' If you have some bytes that are supposed to represent a Chunk
         (with its headers and everything), use this function to create a Chunk
-        instance. '''
-        chunk_len, = struct.unpack('>I', stream.read(4))
-        chunk_type, = struct.unpack('>4s', stream.read(4))
+        instance. Returns None if the stream is already at its end. '''
+        b = stream.read(8)
+        if not len(b):
+            return None
+        if len(b) < 8:
+            fail_hard('Truncated chunk header')
+        chunk_len, chunk_type = struct.unpack('>I4s', b)
         chunk_type_str = str(chunk_type, 'utf-8')
         chunk_type = ChunkType.from_string(chunk_type_str)
         chunk_data = stream.read(chunk_len)
-        chunk_crc, = struct.unpack('>I', stream.read(4))
+        b = stream.read(4)
+        if len(chunk_data) != chunk_len or len(b) != 4:
+            fail_hard('Truncated chunk of type', chunk_type_str)
+        chunk_crc, = struct.unpack('>I', b)
         chunk = Chunk(chunk_type_str, chunk_data)
         if chunk_type is None:
             pass
@@ -50,6 +71,14 @@ class Chunk():
             chunk = CryptInfoChunk.from_chunk(chunk)
         elif chunk_type == ChunkType.Data:
             chunk = DataChunk.from_chunk(chunk)
+        elif chunk_type == ChunkType.Manifest:
+            chunk = ManifestChunk.from_chunk(chunk)
+        elif chunk_type == ChunkType.Parity:
+            chunk = ParityChunk.from_chunk(chunk)
+        elif chunk_type == ChunkType.ZDict:
+            chunk = ZDictChunk.from_chunk(chunk)
+        elif chunk_type == ChunkType.Fingerprint:
+            chunk = FingerprintChunk.from_chunk(chunk)
         else:
             fail_hard('Can\'t parse chunk', chunk_type, 'from byte stream')
         # it should be valid ... because we just calculated the crc ourselves
@@ -95,7 +124,8 @@ class Chunk():
         ''' calculates the crc and checks that it matches the crc that we were
         given '''
         crc1 = self.crc
-        crc2 = zlib.crc32(bytes(self.type, 'utf-8') + self.chunk_payload)
+        with memoryview(self._data) as view:
+            crc2 = zlib.crc32(view[4:8+self.length])
         return crc1 == crc2
 
     @property
@@ -117,6 +147,10 @@ class ChunkType(Enum):
     Index = 'deQm'
     Data = 'maTt'
     CryptInfo = 'yyBo'
+    Manifest = 'maNf'
+    Parity = 'paRi'
+    ZDict = 'zdIc'
+    Fingerprint = 'fiNg'
 
     @lru_cache(maxsize=8)
     def from_string(s):
@@ -130,8 +164,14 @@ class ChunkType(Enum):
         return t
 
 
+class DigestType(Enum):
+    Sha256 = 1
+    HmacSha256 = 2
+
+
 class EncodingType(Enum):
     SingleFile = 1
+    Blocks = 2
 
 
 class EncryptionType(Enum):
@@ -147,33 +187,43 @@ class CompressMethod(Enum):
 
 class IndexChunk(Chunk):
     def __init__(self, encoding_type, encryption_type, compress_method,
-                 num_data_chunks):
+                 num_data_chunks, generation=0):
         assert isinstance(encoding_type, EncodingType)
         assert isinstance(encryption_type, EncryptionType)
         assert isinstance(compress_method, CompressMethod)
         assert num_data_chunks >= 0
+        assert generation >= 0
         chunk_type = ChunkType.Index
         data = struct.pack(
             '>IIII', encoding_type.value, encryption_type.value,
             compress_method.value, num_data_chunks)
+        # Generation 0 omits the field, so images that are never appended to
+        # look exactly like they did before generations existed
+        if generation > 0:
+            data += struct.pack('>I', generation)
         super().__init__(chunk_type.value, data)
 
     @classmethod
     def from_chunk(cls, chunk):
         assert isinstance(chunk, Chunk)
         encoding_type, encryption_type, compress_method, num_data_chunks = \
-            struct.unpack('>IIII', chunk.chunk_payload)
+            struct.unpack_from('>IIII', chunk.chunk_payload, 0)
+        generation = 0
+        if chunk.length == 20:
+            generation, = struct.unpack_from('>I', chunk.chunk_payload, 16)
         encoding_type = EncodingType(encoding_type)
         encryption_type = EncryptionType(encryption_type)
         compress_method = CompressMethod(compress_method)
         c = IndexChunk(encoding_type, encryption_type, compress_method,
-                       num_data_chunks)
+                       num_data_chunks, generation)
         return c
 
     @property
     def is_valid(self):
         if not super().is_valid:
             return False
+        if self.length not in (16, 20):
+            return False
         try:
             self.encoding_type
             self.encryption_type
@@ -207,6 +257,23 @@ class IndexChunk(Chunk):
         n, = struct.unpack_from('>I', self.chunk_payload, 12)
         return n
 
+    @property
+    def generation(self):
+        ''' Each append to an image adds an index chunk with a generation one
+        higher than the previous one. The one with the highest generation is
+        the one that describes the image. '''
+        if self.length < 20:
+            return 0
+        g, = struct.unpack_from('>I', self.chunk_payload, 16)
+        return g
+
+
+def latest_index_chunk(index_chunks):
+    ''' Given a list of index chunks from the same image, return the one that
+    describes the image: the one with the highest generation '''
+    assert len(index_chunks)
+    return max(index_chunks, key=lambda c: c.generation)
+
 
 class DataChunk(Chunk):
     def __init__(self, index, data):
@@ -214,26 +281,25 @@ class DataChunk(Chunk):
         assert index >= 0
         assert isinstance(data, bytes)
         chunk_type = ChunkType.Data
-        data_len = len(data)
-        d = struct.pack('>I{}s'.format(data_len), index, data)
+        d = struct.pack('>I', index) + data
         super().__init__(chunk_type.value, d)
 
     @classmethod
     def from_chunk(cls, chunk):
         assert isinstance(chunk, Chunk)
-        index, = struct.unpack_from('>I', chunk.chunk_payload, 0)
-        data = chunk.chunk_payload[4:]
+        index, = struct.unpack_from('>I', chunk._data, 8)
+        data = chunk._data[12:8+chunk.length]
         c = DataChunk(index, data)
         return c
 
     @property
     def index(self):
-        i, = struct.unpack_from('>I', self.chunk_payload, 0)
+        i, = struct.unpack_from('>I', self._data, 8)
         return i
 
     @property
     def data(self):
-        return self.chunk_payload[4:]
+        return self._data[12:8+self.length]
 
     @property
     def is_valid(self):
@@ -243,18 +309,28 @@ class DataChunk(Chunk):
 
 
 class CryptInfoChunk(Chunk):
-    def __init__(self, salt):
+    def __init__(self, salt, key_check=None):
+        ''' key_check, if given, is the key check value (see
+        util.crypto.key_check_value) of the key derived from the password and
+        salt, so a wrong password can be told apart without decrypting
+        anything '''
         assert isinstance(salt, bytes)
         assert len(salt) == 16
+        assert key_check is None or len(key_check) == 32
         chunk_type = ChunkType.CryptInfo
         data = struct.pack('>16s', salt)
+        if key_check is not None:
+            data += struct.pack('>32s', key_check)
         super().__init__(chunk_type.value, data)
 
     @classmethod
     def from_chunk(cls, chunk):
         assert isinstance(chunk, Chunk)
-        s, = struct.unpack('>16s', chunk.chunk_payload)
-        c = CryptInfoChunk(s)
+        s, = struct.unpack_from('>16s', chunk.chunk_payload, 0)
+        key_check = None
+        if chunk.length == 48:
+            key_check, = struct.unpack_from('>32s', chunk.chunk_payload, 16)
+        c = CryptInfoChunk(s, key_check)
         return c
 
     @property
@@ -262,11 +338,221 @@ class CryptInfoChunk(Chunk):
         s, = struct.unpack_from('>16s', self.chunk_payload, 0)
         return s
 
+    @property
+    def key_check(self):
+        ''' The key check value, or None if the chunk doesn't have one '''
+        if self.length != 48:
+            return None
+        k, = struct.unpack_from('>32s', self.chunk_payload, 16)
+        return k
+
     @property
     def is_valid(self):
         if not super().is_valid:
             return False
-        return self.length == 16
+        return self.length in (16, 48)
+
+
+class ManifestChunk(Chunk):
+    def __init__(self, digests, digest_type=DigestType.Sha256):
+        ''' digests maps data chunk indexes to the digests of those data
+        chunks' entire data field (index included) '''
+        assert isinstance(digest_type, DigestType)
+        assert all(len(d) == 32 for d in digests.values())
+        chunk_type = ChunkType.Manifest
+        data = struct.pack('>I', digest_type.value) + b''.join(
+            struct.pack('>I32s', i, digests[i]) for i in sorted(digests))
+        super().__init__(chunk_type.value, data)
+
+    @classmethod
+    def from_chunk(cls, chunk):
+        assert isinstance(chunk, Chunk)
+        t, = struct.unpack_from('>I', chunk.chunk_payload, 0)
+        digests = {}
+        for i, d in struct.iter_unpack('>I32s', chunk.chunk_payload[4:]):
+            digests[i] = d
+        c = ManifestChunk(digests, DigestType(t))
+        return c
+
+    @property
+    def digest_type(self):
+        t, = struct.unpack_from('>I', self.chunk_payload, 0)
+        # throws ValueError if not valid
+        return DigestType(t)
+
+    @property
+    def digests(self):
+        ''' dict mapping data chunk indexes to their digests '''
+        return {i: d for i, d in struct.iter_unpack(
+            '>I32s', self.chunk_payload[4:])}
+
+    @property
+    def is_valid(self):
+        if not super().is_valid:
+            return False
+        if self.length < 4 or (self.length - 4) % 36 != 0:
+            return False
+        try:
+            self.digest_type
+        except ValueError:
+            return False
+        return True
+
+
+class ParityChunk(Chunk):
+    def __init__(self, row, members, parity):
+        ''' members is a list of (index, length) of the data chunks in the
+        stripe this is parity for, in order, where length is that of their
+        entire data field. row says which of the stripe's parity chunks this
+        is. '''
+        assert row >= 0
+        assert len(members)
+        assert isinstance(parity, bytes)
+        assert len(parity) == max(length for _, length in members)
+        chunk_type = ChunkType.Parity
+        data = struct.pack('>II', row, len(members)) + b''.join(
+            struct.pack('>II', i, length) for i, length in members) + parity
+        super().__init__(chunk_type.value, data)
+
+    @classmethod
+    def from_chunk(cls, chunk):
+        assert isinstance(chunk, Chunk)
+        row, n = struct.unpack_from('>II', chunk._data, 8)
+        members = list(struct.iter_unpack(
+            '>II', chunk._data[16:16+8*n]))
+        parity = chunk._data[16+8*n:8+chunk.length]
+        c = ParityChunk(row, members, parity)
+        return c
+
+    @property
+    def row(self):
+        r, = struct.unpack_from('>I', self._data, 8)
+        return r
+
+    @property
+    def members(self):
+        ''' tuple of (index, length) of the data chunks in the stripe '''
+        n, = struct.unpack_from('>I', self._data, 12)
+        return tuple(struct.iter_unpack('>II', self._data[16:16+8*n]))
+
+    @property
+    def parity(self):
+        n, = struct.unpack_from('>I', self._data, 12)
+        return self._data[16+8*n:8+self.length]
+
+    @property
+    def is_valid(self):
+        if not super().is_valid:
+            return False
+        if self.length < 8:
+            return False
+        n, = struct.unpack_from('>I', self._data, 12)
+        if n < 1 or self.length < 8 + 8 * n:
+            return False
+        return len(self.parity) == max(
+            length for _, length in self.members)
+
+
+class ZDictChunk(Chunk):
+    def __init__(self, digest, digest_type=DigestType.Sha256):
+        ''' digest is that of the preset dictionary the data was compressed
+        with. The dictionary itself isn't stored. '''
+        assert isinstance(digest_type, DigestType)
+        assert isinstance(digest, bytes)
+        assert len(digest) == 32
+        chunk_type = ChunkType.ZDict
+        data = struct.pack('>I32s', digest_type.value, digest)
+        super().__init__(chunk_type.value, data)
+
+    @classmethod
+    def from_chunk(cls, chunk):
+        assert isinstance(chunk, Chunk)
+        t, d = struct.unpack_from('>I32s', chunk.chunk_payload, 0)
+        c = ZDictChunk(d, DigestType(t))
+        return c
+
+    @property
+    def digest_type(self):
+        t, = struct.unpack_from('>I', self.chunk_payload, 0)
+        # throws ValueError if not valid
+        return DigestType(t)
+
+    @property
+    def digest(self):
+        d, = struct.unpack_from('>32s', self.chunk_payload, 4)
+        return d
+
+    @property
+    def is_valid(self):
+        if not super().is_valid:
+            return False
+        if self.length != 36:
+            return False
+        try:
+            self.digest_type
+        except ValueError:
+            return False
+        return True
+
+
+class FingerprintChunk(Chunk):
+    def __init__(self, digest, size, num_data_chunks,
+                 digest_type=DigestType.Sha256):
+        ''' digest is that of the data stored in the first num_data_chunks
+        data chunks, as it was before being compressed and encrypted, and
+        size is how many bytes of it there are. If the data is encrypted, the
+        digest is an HMAC (see lib.fingerprint). '''
+        assert isinstance(digest_type, DigestType)
+        assert isinstance(digest, bytes)
+        assert len(digest) == 32
+        assert size >= 0
+        assert num_data_chunks >= 0
+        chunk_type = ChunkType.Fingerprint
+        data = struct.pack('>IQI32s', digest_type.value, size,
+                           num_data_chunks, digest)
+        super().__init__(chunk_type.value, data)
+
+    @classmethod
+    def from_chunk(cls, chunk):
+        assert isinstance(chunk, Chunk)
+        t, size, n, d = struct.unpack_from('>IQI32s', chunk.chunk_payload, 0)
+        c = FingerprintChunk(d, size, n, DigestType(t))
+        return c
+
+    @property
+    def digest_type(self):
+        t, = struct.unpack_from('>I', self.chunk_payload, 0)
+        # throws ValueError if not valid
+        return DigestType(t)
+
+    @property
+    def size(self):
+        s, = struct.unpack_from('>Q', self.chunk_payload, 4)
+        return s
+
+    @property
+    def num_data_chunks(self):
+        ''' Appending to an image adds data chunks that the fingerprint
+        doesn't cover, after which it's stale '''
+        n, = struct.unpack_from('>I', self.chunk_payload, 12)
+        return n
+
+    @property
+    def digest(self):
+        d, = struct.unpack_from('>32s', self.chunk_payload, 16)
+        return d
+
+    @property
+    def is_valid(self):
+        if not super().is_valid:
+            return False
+        if self.length != 48:
+            return False
+        try:
+            self.digest_type
+        except ValueError:
+            return False
+        return True
 
 
 # The rough maximum internal buffer size to use during encoding, which will
@@ -0,0 +1,88 @@
+''' Fingerprints of the data stored in images, so a local file can be checked
+against an image without decoding it (see `pngrecon compare`).
+
+A fingerprint is the size of the data, as it was before being compressed and
+encrypted, and its SHA-256, the same as sha256sum would say. For encrypted
+data it's an HMAC-SHA256 instead, keyed with a key derived from the
+encryption key, or else anyone could check guesses of what the data is
+against it without the password. The size isn't hidden, but the size of the
+encrypted data gives it away roughly anyway. '''
+from ..util.crypto import derive_subkey
+from ..util.fastcopy import hash_range
+from .chunk import (DigestType, FingerprintChunk)
+import hashlib
+import hmac
+import io
+import os
+import stat
+
+# How much of a file that can't be mapped into memory to hash at once
+FINGERPRINT_READ_BYTES = 1024 * 1024  # 1 MiB
+
+
+def fingerprint_key(fernet):
+    ''' Return the key for the HMAC of data encrypted with fernet (from
+    gen_key), or None if it isn't encrypted '''
+    if fernet is None:
+        return None
+    return derive_subkey(fernet, b'pngrecon fingerprint')
+
+
+def fingerprint_digest_type(key):
+    return DigestType.Sha256 if key is None else DigestType.HmacSha256
+
+
+class Fingerprinter():
+    ''' Accumulates the fingerprint of data given to it a piece at a time,
+    with update() or, for regular files, update_range(), which doesn't copy
+    the data into Python. key is from fingerprint_key. '''
+    def __init__(self, key=None):
+        if key is None:
+            self.hash = hashlib.sha256()
+        else:
+            self.hash = hmac.new(key, digestmod='sha256')
+        self.digest_type = fingerprint_digest_type(key)
+        self.size = 0
+
+    def update(self, b):
+        self.hash.update(b)
+        self.size += len(b)
+
+    def update_range(self, fileno, offset, count):
+        ''' Add count bytes starting at offset in the file descriptor fileno,
+        a regular file '''
+        hash_range(fileno, offset, count, self.hash)
+        self.size += count
+
+    def chunk(self, num_data_chunks):
+        ''' Return the FingerprintChunk for the data so far, which is stored
+        in the first num_data_chunks data chunks '''
+        return FingerprintChunk(self.hash.digest(), self.size,
+                                num_data_chunks, self.digest_type)
+
+
+def fingerprint_bites(bites, fingerprinter):
+    ''' Pass through the given iterable of bytes, adding each to the
+    fingerprint '''
+    for b in bites:
+        fingerprinter.update(b)
+        yield b
+
+
+def fingerprint_stream(fd, key=None):
+    ''' Return the Fingerprinter of everything left in the file open as fd,
+    which is mapped into memory rather than read if it's a regular file '''
+    fingerprinter = Fingerprinter(key)
+    try:
+        fileno = fd.fileno()
+        st = os.fstat(fileno)
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        st = None
+    if st is not None and stat.S_ISREG(st.st_mode):
+        offset = fd.tell()
+        fingerprinter.update_range(
+            fileno, offset, max(0, st.st_size - offset))
+        return fingerprinter
+    for b in iter(lambda: fd.read(FINGERPRINT_READ_BYTES), b''):
+        fingerprinter.update(b)
+    return fingerprinter
@@ -0,0 +1,249 @@
+from ..util.log import log_stderr as log
+from .chunk import PNG_SIG
+from .chunk import (ChunkType, EncryptionType)
+from .chunk import (Chunk, DataChunk, latest_index_chunk)
+from collections import namedtuple
+from functools import lru_cache
+import os
+import struct
+import zlib
+
+
+class ChunkHeader(namedtuple('ChunkHeader', ['offset', 'length', 'type'])):
+    ''' Where a chunk lives in a PNG file, without any of its payload. offset
+    is the position of the chunk's length field, length is the number of bytes
+    in its data field, and type is its 4-character type string. '''
+
+    @property
+    def data_offset(self):
+        ''' position of the first byte of the chunk's data field '''
+        return self.offset + 8
+
+    @property
+    def crc_offset(self):
+        ''' position of the chunk's 4-byte crc '''
+        return self.data_offset + self.length
+
+    @property
+    def end(self):
+        ''' position of the first byte after this chunk '''
+        return self.crc_offset + 4
+
+    @property
+    def size(self):
+        ''' number of bytes the whole chunk takes in the file '''
+        return self.end - self.offset
+
+
+def scan_image_stream(stream):
+    ''' Like read_image_stream, but only read the header of each chunk and
+    seek over its data and crc. The stream must be seekable. Return a tuple of
+    ChunkHeaders in file order, or None if the stream doesn't look like a PNG
+    or is truncated. Nothing is CRC checked. '''
+    stream.seek(0, 2)
+    file_len = stream.tell()
+    stream.seek(0, 0)
+    if stream.read(len(PNG_SIG)) != PNG_SIG:
+        log('Could not find PNG file signature')
+        return None
+    headers = []
+    offset = len(PNG_SIG)
+    while offset < file_len:
+        b = stream.read(8)
+        if len(b) != 8:
+            log('Truncated chunk header at offset', offset)
+            return None
+        chunk_len, chunk_type = struct.unpack('>I4s', b)
+        h = ChunkHeader(offset, chunk_len, str(chunk_type, 'utf-8', 'replace'))
+        if h.end > file_len:
+            log('Chunk of type', h.type, 'at offset', offset, 'runs past the '
+                'end of the file')
+            return None
+        headers.append(h)
+        offset = h.end
+        stream.seek(offset, 0)
+    return tuple(headers)
+
+
+def chunk_crc_matches(buf, header):
+    ''' Given the bytes of a whole PNG file (e.g. an mmap of it) and the
+    header of a chunk in it, return whether the chunk's stored crc matches its
+    type and data. Nothing is copied, so this is cheap to call on a thread
+    pool: zlib releases the GIL while it works on big buffers. '''
+    with memoryview(buf) as view:
+        crc = zlib.crc32(view[header.offset+4:header.crc_offset])
+    stored, = struct.unpack_from('>I', buf, header.crc_offset)
+    return crc == stored
+
+
+def read_chunk(stream, header):
+    ''' Seek to and read the whole chunk described by the given ChunkHeader,
+    returning it parsed into the most specific type of Chunk it is '''
+    stream.seek(header.offset, 0)
+    return Chunk.from_byte_stream(stream)
+
+
+class DataChunkRef(DataChunk):
+    ''' Stands in for the DataChunk described by header in the image open as
+    stream, without holding on to its payload. Only its index is read up
+    front. The rest of it is read (and its CRC checked, like any other chunk)
+    each time its data is asked for. '''
+    def __init__(self, stream, header):
+        self.stream = stream
+        self.header = header
+        self._index = read_data_chunk_index(stream, header)
+
+    def read(self):
+        ''' Read and return the whole DataChunk '''
+        return read_chunk(self.stream, self.header)
+
+    @property
+    def length(self):
+        return self.header.length
+
+    @property
+    def type(self):
+        return self.header.type
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def data(self):
+        return self.read().data
+
+    @property
+    def raw_data(self):
+        return self.read().raw_data
+
+    @property
+    def is_valid(self):
+        return self.length > 4
+
+
+def read_our_chunks(stream, layout, data_refs=False):
+    ''' Seek to and read only the chunks in the layout that are ours, skipping
+    over all the others. If data_refs, data chunks are returned as
+    DataChunkRefs, so that memory use doesn't grow with the size of the data.
+    '''
+    chunks = []
+    for h in layout:
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type is None:
+            continue
+        elif chunk_type == ChunkType.Data and data_refs and h.length >= 4:
+            chunks.append(DataChunkRef(stream, h))
+        else:
+            chunks.append(read_chunk(stream, h))
+    return chunks
+
+
+def read_data_chunk_index(stream, header):
+    ''' Read only the index field of the data chunk described by the given
+    ChunkHeader, without reading its (possibly very large) payload '''
+    stream.seek(header.data_offset, 0)
+    i, = struct.unpack('>I', stream.read(4))
+    return i
+
+
+def check_chunk_set(fd, layout, buf):
+    ''' Check that our chunks in the image (open as fd, and all of it in buf)
+    form a complete set, like decode would, but without reading the payloads
+    of data chunks. Return a list of problems and a dict mapping the headers
+    of data chunks to the digests the manifest(s) say they should have. '''
+    errors = []
+    index_chunks = []
+    crypt_info_chunks = []
+    manifest_chunks = []
+    zdict_chunks = []
+    fingerprint_chunks = []
+    data_chunks = {}
+    for h in layout:
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type == ChunkType.Data:
+            if h.length < 5:
+                errors.append('Data chunk at offset {} is too short'.format(
+                    h.offset))
+                continue
+            i, = struct.unpack_from('>I', buf, h.data_offset)
+            if i in data_chunks:
+                errors.append('Data chunk index {} is used more than '
+                              'once'.format(i))
+            data_chunks[i] = h
+        elif chunk_type is not None:
+            try:
+                c = read_chunk(fd, h)
+            except (ValueError, struct.error) as e:
+                errors.append('Can\'t parse {} at offset {}: {}'.format(
+                    chunk_type, h.offset, e))
+                continue
+            if not c.is_valid:
+                errors.append('Invalid {} at offset {}'.format(
+                    chunk_type, h.offset))
+            elif chunk_type == ChunkType.Index:
+                index_chunks.append(c)
+            elif chunk_type == ChunkType.CryptInfo:
+                crypt_info_chunks.append(c)
+            elif chunk_type == ChunkType.Manifest:
+                manifest_chunks.append(c)
+            elif chunk_type == ChunkType.ZDict:
+                zdict_chunks.append(c)
+            elif chunk_type == ChunkType.Fingerprint:
+                fingerprint_chunks.append(c)
+    if len(zdict_chunks) > 1:
+        errors.append('Expected at most 1 dictionary chunk but got {}'.format(
+            len(zdict_chunks)))
+    if len(fingerprint_chunks) > 1:
+        errors.append('Expected at most 1 fingerprint chunk but got '
+                      '{}'.format(len(fingerprint_chunks)))
+    if not len(index_chunks):
+        errors.append('There is no index chunk')
+    else:
+        index_chunk = latest_index_chunk(index_chunks)
+        generations = [c.generation for c in index_chunks]
+        if len(generations) != len(set(generations)):
+            errors.append('There is more than one index chunk with the same '
+                          'generation')
+        if len(data_chunks) != index_chunk.num_data_chunks:
+            errors.append('Expected {} data chunks but there are {}'.format(
+                index_chunk.num_data_chunks, len(data_chunks)))
+        if index_chunk.encryption_type != EncryptionType.No and \
+                len(crypt_info_chunks) != 1:
+            errors.append('Data is encrypted. Expected 1 crypt info chunk '
+                          'but got {}'.format(len(crypt_info_chunks)))
+    expected_digests = {}
+    for manifest_chunk in manifest_chunks:
+        for i, digest in manifest_chunk.digests.items():
+            if i not in data_chunks:
+                errors.append('Manifest has a digest for missing data chunk '
+                              'index {}'.format(i))
+                continue
+            h = data_chunks[i]
+            expected = (manifest_chunk.digest_type, digest)
+            if expected_digests.get(h, expected) != expected:
+                errors.append('Manifests disagree on the digest of data '
+                              'chunk index {}'.format(i))
+            expected_digests[h] = expected
+    return errors, expected_digests
+
+
+def get_carrier_layout(fname):
+    ''' Return the result of scan_image_stream for the given file. Results are
+    cached for as long as the file's identity, size, and mtime don't change,
+    so reusing the same carrier image for many encodes only scans it once. '''
+    st = os.stat(fname)
+    return _get_carrier_layout(
+        os.path.realpath(fname), st.st_dev, st.st_ino, st.st_size,
+        st.st_mtime_ns)
+
+
+@lru_cache(maxsize=64)
+def _get_carrier_layout(fname, dev, ino, size, mtime_ns):
+    with open(fname, 'rb') as fd:
+        return scan_image_stream(fd)
+
+
+def carrier_layout_cache_info():
+    ''' Hits, misses, and size of get_carrier_layout's cache '''
+    return _get_carrier_layout.cache_info()
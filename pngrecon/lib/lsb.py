@@ -0,0 +1,235 @@
+''' Hiding bytes in the least significant bits of an image's pixels, as an
+alternative to storing them in our own ancillary chunks (which many image
+pipelines drop).
+
+The bytes hidden are a short header (LSB_MAGIC and the length of what
+follows) and then our chunks, serialized just like they would be in the image
+itself. One bit is stored in each sample byte (the low byte of each sample for
+16-bit images). Everything is done with NumPy array operations; NumPy is only
+needed when using this. '''
+from ..util.log import fail_hard
+from .chunk import Chunk
+from .chunk import PNG_SIG
+import struct
+import zlib
+
+LSB_MAGIC = b'pRlS'
+LSB_HEADER_LEN = len(LSB_MAGIC) + 8
+# Number of samples per pixel for each supported PNG color type
+CHANNELS = {
+    0: 1,  # grayscale
+    2: 3,  # RGB
+    4: 2,  # grayscale with alpha
+    6: 4,  # RGB with alpha
+}
+# Biggest IDAT chunk we write
+MAX_IDAT_LEN = 1024 * 1024
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        fail_hard('NumPy is needed to hide data in pixels. Install it with '
+                  '`pip install numpy`.')
+    return numpy
+
+
+class PixelImage():
+    ''' The decoded pixels of a PNG, plus everything needed to write it back
+    out. pixels is a uint8 array with one row per scanline (without the filter
+    type byte). '''
+    def __init__(self, chunks, width, height, bit_depth, color_type, pixels):
+        self.chunks = chunks
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.pixels = pixels
+
+    @property
+    def bytes_per_pixel(self):
+        return CHANNELS[self.color_type] * self.bit_depth // 8
+
+    def carrier_bytes(self):
+        ''' A flat view of the bytes whose LSBs hold data. Changing it changes
+        pixels. '''
+        flat = self.pixels.reshape(-1)
+        if self.bit_depth == 16:
+            # big endian, so every other byte is a sample's low byte
+            return flat[1::2]
+        return flat
+
+    @property
+    def capacity(self):
+        ''' The number of bytes of chunks that can be hidden in this image '''
+        return max(0, self.carrier_bytes().size // 8 - LSB_HEADER_LEN)
+
+
+def parse_ihdr(chunk):
+    ''' Return the width, height, bit depth, and color type in the given IHDR
+    chunk, making sure it's an image we know how to hide data in '''
+    width, height, bit_depth, color_type, compression, filter_method, \
+        interlace = struct.unpack('>IIBBBBB', chunk.chunk_payload)
+    if color_type not in CHANNELS:
+        fail_hard('Can\'t hide data in the pixels of an image with color '
+                  'type', color_type, '(only grayscale and RGB, with or '
+                  'without alpha)')
+    if bit_depth not in (8, 16):
+        fail_hard('Can\'t hide data in the pixels of an image with bit '
+                  'depth', bit_depth, '(only 8 and 16)')
+    if interlace != 0:
+        fail_hard('Can\'t hide data in the pixels of an interlaced image')
+    if compression != 0 or filter_method != 0:
+        fail_hard('Unknown PNG compression or filter method')
+    return width, height, bit_depth, color_type
+
+
+def paeth(np, a, b, c):
+    ''' The PNG Paeth predictor, elementwise on int16 arrays '''
+    p = a + b - c
+    pa = np.abs(p - a)
+    pb = np.abs(p - b)
+    pc = np.abs(p - c)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+
+def unfilter_rows(np, filters, data, bpp):
+    ''' Undo the per-scanline filters. Sub and Up (and None) only depend on
+    data from the same row or the row above, so each row is a few vector
+    operations. '''
+    height, stride = data.shape
+    out = np.empty_like(data)
+    prev = np.zeros(stride, dtype=np.uint8)
+    for r in range(height):
+        line = data[r]
+        f = filters[r]
+        if f == 0:
+            out[r] = line
+        elif f == 1:
+            out[r] = np.cumsum(
+                line.reshape(-1, bpp), axis=0, dtype=np.uint8).reshape(-1)
+        elif f == 2:
+            out[r] = line + prev
+        else:
+            assert False
+        prev = out[r]
+    return out
+
+
+def unfilter_wavefront(np, filters, data, bpp):
+    ''' Undo the per-scanline filters, for any filter types. Average and Paeth
+    make each pixel depend on the one to its left, so a row can't be done all
+    at once. A pixel only depends on the pixels to its left, above, and above
+    left, though, so every pixel on an anti-diagonal can be done at once,
+    given the two anti-diagonals before it. '''
+    height, stride = data.shape
+    width = stride // bpp
+    f = data.reshape(height, width, bpp).astype(np.int16)
+    # Padded with a row of zeros above and a column of zeros to the left, so
+    # that the image's edges need no special cases
+    x = np.zeros((height + 1, width + 1, bpp), dtype=np.int16)
+    row_filters = filters.astype(np.int16)
+    for d in range(height + width - 1):
+        r = np.arange(max(0, d - width + 1), min(height - 1, d) + 1)
+        c = d - r
+        a = x[r + 1, c]
+        b = x[r, c + 1]
+        cc = x[r, c]
+        ft = row_filters[r][:, None]
+        pred = np.where(
+            ft == 1, a, np.where(
+                ft == 2, b, np.where(
+                    ft == 3, (a + b) >> 1, np.where(
+                        ft == 4, paeth(np, a, b, cc), 0))))
+        x[r + 1, c + 1] = (f[r, c] + pred) & 0xff
+    return x[1:, 1:].astype(np.uint8).reshape(height, stride)
+
+
+def filter_paeth(np, pixels, bpp):
+    ''' Filter every scanline with the Paeth filter. Unlike unfiltering, this
+    only uses unfiltered values, so it is all done at once. Returns the
+    filtered scanlines, each starting with its filter type byte. '''
+    x = pixels.astype(np.int16)
+    a = np.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    b = np.zeros_like(x)
+    b[1:] = x[:-1]
+    c = np.zeros_like(x)
+    c[1:, bpp:] = x[:-1, :-bpp]
+    filtered = ((x - paeth(np, a, b, c)) & 0xff).astype(np.uint8)
+    types = np.full((pixels.shape[0], 1), 4, dtype=np.uint8)
+    return np.hstack((types, filtered))
+
+
+def read_pixel_image(chunks):
+    ''' Given all the chunks of a PNG, in order, decode its pixels '''
+    np = import_numpy()
+    if not len(chunks) or chunks[0].type != 'IHDR':
+        fail_hard('Image doesn\'t start with an IHDR chunk')
+    width, height, bit_depth, color_type = parse_ihdr(chunks[0])
+    idat = b''.join(c.chunk_payload for c in chunks if c.type == 'IDAT')
+    bpp = CHANNELS[color_type] * bit_depth // 8
+    stride = width * bpp
+    raw = zlib.decompress(idat)
+    if len(raw) != height * (stride + 1):
+        fail_hard('Image has the wrong amount of pixel data')
+    raw = np.frombuffer(raw, dtype=np.uint8).reshape(height, stride + 1)
+    filters = raw[:, 0]
+    data = raw[:, 1:]
+    if filters.max(initial=0) > 4:
+        fail_hard('Image has an unknown scanline filter type')
+    if filters.max(initial=0) <= 2:
+        pixels = unfilter_rows(np, filters, data, bpp)
+    else:
+        pixels = unfilter_wavefront(np, filters, data, bpp)
+    return PixelImage(chunks, width, height, bit_depth, color_type, pixels)
+
+
+def embed(image, payload):
+    ''' Hide payload in the pixels of image, changing them in place '''
+    np = import_numpy()
+    if len(payload) > image.capacity:
+        fail_hard('Need to hide {} bytes, but the image can only hold '
+                  '{}'.format(len(payload), image.capacity))
+    framed = LSB_MAGIC + struct.pack('>Q', len(payload)) + payload
+    bits = np.unpackbits(np.frombuffer(framed, dtype=np.uint8))
+    carrier = image.carrier_bytes()
+    carrier[:bits.size] = (carrier[:bits.size] & 0xfe) | bits
+
+
+def extract(image):
+    ''' Return the bytes hidden in the pixels of image, or None if there don't
+    seem to be any '''
+    np = import_numpy()
+    carrier = image.carrier_bytes()
+    if carrier.size < LSB_HEADER_LEN * 8:
+        return None
+    header = np.packbits(carrier[:LSB_HEADER_LEN * 8] & 1).tobytes()
+    if header[:len(LSB_MAGIC)] != LSB_MAGIC:
+        return None
+    length, = struct.unpack_from('>Q', header, len(LSB_MAGIC))
+    if length > image.capacity:
+        return None
+    start = LSB_HEADER_LEN * 8
+    return np.packbits(carrier[start:start + length * 8] & 1).tobytes()
+
+
+def write_pixel_image(image, fd):
+    ''' Write image out as a PNG. Its chunks are written as they were, except
+    the IDAT chunks, which are replaced with ones holding the current pixels
+    where the first one was. '''
+    np = import_numpy()
+    filtered = filter_paeth(np, image.pixels, image.bytes_per_pixel)
+    idat = zlib.compress(filtered.tobytes())
+    fd.write(PNG_SIG)
+    wrote_idat = False
+    for c in image.chunks:
+        if c.type != 'IDAT':
+            fd.write(c.raw_data)
+            continue
+        if wrote_idat:
+            continue
+        for i in range(0, len(idat), MAX_IDAT_LEN):
+            fd.write(Chunk('IDAT', idat[i:i + MAX_IDAT_LEN]).raw_data)
+        wrote_idat = True
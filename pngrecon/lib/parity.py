@@ -0,0 +1,268 @@
+''' Reed-Solomon erasure coding of data chunks, so that damaged or missing
+ones can be rebuilt from parity chunks instead of fetching the image again.
+
+Data chunks are grouped into stripes of up to k consecutive ones. Each stripe
+gets m parity chunks, and any m of its data chunks can be rebuilt from the
+rest of the stripe plus that many of its parity chunks. The "shards" coded are
+the data chunks' entire data fields (index included), zero padded to the
+length of the longest one in the stripe.
+
+Parity chunk row r holds the sum over the stripe's data chunks at positions p
+of C(r, p) * shard_p, where C(r, p) = 1 / ((255 - r) + p) in GF(2^8) (so
+addition is XOR). That is a Cauchy matrix, every square submatrix of which is
+invertible, which is what makes any m losses recoverable. Multiplying a whole
+shard by a constant is one lookup into a 256 entry row of a multiplication
+table, done with NumPy; NumPy is only needed when using this. '''
+from ..util.log import log_stderr as log
+from ..util.log import fail_hard
+from .chunk import (ChunkType, DataChunk, ParityChunk)
+from .layout import (read_chunk, read_our_chunks)
+from functools import lru_cache
+import struct
+import zlib
+
+# The polynomial GF(2^8) is built with, x^8 + x^4 + x^3 + x^2 + 1
+GF_POLY = 0x11d
+# A stripe's data chunks and parity chunks each need their own field element
+MAX_STRIPE_CHUNKS = 256
+# How much of a chunk to CRC at once when checking it
+CRC_PIECE_BYTES = 1024 * 1024  # 1 MiB
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        fail_hard('NumPy is needed for parity chunks. Install it with '
+                  '`pip install numpy`.')
+    return numpy
+
+
+@lru_cache(maxsize=1)
+def gf_tables():
+    ''' Return the exp and log tables of GF(2^8) as lists, and its full
+    multiplication table as a 256x256 uint8 array '''
+    np = import_numpy()
+    exp = [0] * 510
+    log_ = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log_[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLY
+    exp[255:] = exp[:255]
+    exp_a = np.array(exp, dtype=np.uint8)
+    log_a = np.array(log_, dtype=np.int32)
+    mul = exp_a[log_a[:, None] + log_a[None, :]]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    return exp, log_, mul
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    exp, log_, _ = gf_tables()
+    return exp[log_[a] + log_[b]]
+
+
+def gf_inv(a):
+    assert a != 0
+    exp, log_, _ = gf_tables()
+    return exp[255 - log_[a]]
+
+
+def coefficient(row, position):
+    ''' The Cauchy matrix entry for the given parity row and data position '''
+    assert row + position < MAX_STRIPE_CHUNKS
+    return gf_inv((255 - row) ^ position)
+
+
+def gf_invert_matrix(a):
+    ''' Invert the square matrix a (a list of lists of ints) over GF(2^8) by
+    Gauss-Jordan elimination. It is small: at most m by m. '''
+    n = len(a)
+    a = [list(r) + [int(i == j) for j in range(n)] for i, r in enumerate(a)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if a[r][col])
+        a[col], a[pivot] = a[pivot], a[col]
+        inv = gf_inv(a[col][col])
+        a[col] = [gf_mul(inv, v) for v in a[col]]
+        for r in range(n):
+            if r != col and a[r][col]:
+                f = a[r][col]
+                a[r] = [v ^ gf_mul(f, p) for v, p in zip(a[r], a[col])]
+    return [r[n:] for r in a]
+
+
+def mul_add(acc, coef, shard):
+    ''' acc ^= coef * shard, elementwise, where shard may be shorter than acc
+    (it's implicitly zero padded) '''
+    _, _, mul = gf_tables()
+    acc[:len(shard)] ^= mul[coef][shard]
+
+
+def accumulate(np, acc, position, field, m):
+    ''' Add the data field of the data chunk at the given position in its
+    stripe to acc, the stripe's m parity rows so far (None to start a stripe).
+    Return acc, which is grown if the field is longer than any before it. '''
+    shard = np.frombuffer(field, dtype=np.uint8)
+    if acc is None:
+        acc = np.zeros((m, len(shard)), dtype=np.uint8)
+    elif len(shard) > acc.shape[1]:
+        acc = np.hstack((acc, np.zeros(
+            (m, len(shard) - acc.shape[1]), dtype=np.uint8)))
+    for row in range(m):
+        mul_add(acc[row], coefficient(row, position), shard)
+    return acc
+
+
+def add_parity_chunks(data_chunks, k, m):
+    ''' Pass through the given data chunks, and after every k of them (and
+    after the last) yield the m parity chunks for that stripe. Only the parity
+    being built is held on to, not the stripe's data chunks. '''
+    np = import_numpy()
+    assert k >= 1 and m >= 1 and k + m <= MAX_STRIPE_CHUNKS
+    members = []
+    acc = None
+    for c in data_chunks:
+        yield c
+        with memoryview(c.raw_data) as view:
+            acc = accumulate(np, acc, len(members), view[8:8+c.length], m)
+        members.append((c.index, c.length))
+        if len(members) == k:
+            for row in range(m):
+                yield ParityChunk(row, members, acc[row].tobytes())
+            members = []
+            acc = None
+    if len(members):
+        for row in range(m):
+            yield ParityChunk(row, members, acc[row].tobytes())
+
+
+def rebuild(np, present, parities, missing):
+    ''' Rebuild the shards at the positions in missing. present yields
+    (position, data field) for the rest of the stripe, one at a time, and
+    parities maps parity rows to their payloads. There must be at least as
+    many parities as missing shards. Return the rebuilt shards, zero padded to
+    the length of the parity, in the order of missing. '''
+    rows = sorted(parities)[:len(missing)]
+    assert len(rows) == len(missing)
+    # What's left of each parity row once the shards we have are taken out of
+    # it only depends on the missing shards
+    syndromes = [np.frombuffer(parities[r], dtype=np.uint8).copy()
+                 for r in rows]
+    for position, field in present:
+        shard = np.frombuffer(field, dtype=np.uint8)
+        for r, syndrome in zip(rows, syndromes):
+            mul_add(syndrome, coefficient(r, position), shard)
+    inv = gf_invert_matrix(
+        [[coefficient(r, p) for p in missing] for r in rows])
+    rebuilt = []
+    for inv_row in inv:
+        shard = np.zeros_like(syndromes[0])
+        for coef, syndrome in zip(inv_row, syndromes):
+            mul_add(shard, coef, syndrome)
+        rebuilt.append(shard)
+    return rebuilt
+
+
+def chunk_crc_matches_in_stream(stream, header):
+    ''' Like layout.chunk_crc_matches, but read the chunk from the stream a
+    piece at a time instead of needing the whole file in memory '''
+    stream.seek(header.offset + 4, 0)
+    crc = 0
+    remaining = header.length + 4
+    while remaining > 0:
+        b = stream.read(min(remaining, CRC_PIECE_BYTES))
+        if not len(b):
+            return False
+        crc = zlib.crc32(b, crc)
+        remaining -= len(b)
+    b = stream.read(4)
+    return len(b) == 4 and struct.unpack('>I', b)[0] == crc
+
+
+def read_parity_members(stream, header):
+    ''' Read only the row and member list of the parity chunk described by
+    the given ChunkHeader, without reading its parity '''
+    stream.seek(header.data_offset, 0)
+    row, n = struct.unpack('>II', stream.read(8))
+    return row, tuple(struct.iter_unpack('>II', stream.read(8 * n)))
+
+
+def rebuild_stripe(np, stream, data_chunks, members, parity_headers):
+    ''' Rebuild the data chunks listed in members that aren't in data_chunks
+    (a dict mapping indexes to the data chunks that are intact), using the
+    stripe's parity chunks, whose headers are given mapped to their rows.
+    Return the rebuilt DataChunks, or None if too much of the stripe is
+    gone. '''
+    missing = [p for p, (i, _) in enumerate(members) if i not in data_chunks]
+    if len(missing) > len(parity_headers):
+        return None
+    parities = {}
+    for row in sorted(parity_headers)[:len(missing)]:
+        parities[row] = read_chunk(stream, parity_headers[row]).parity
+
+    def present():
+        for p, (i, _) in enumerate(members):
+            if i in data_chunks:
+                c = data_chunks[i]
+                with memoryview(c.raw_data) as view:
+                    yield p, view[8:8+c.length]
+
+    rebuilt = []
+    for p, shard in zip(missing, rebuild(np, present(), parities, missing)):
+        i, length = members[p]
+        field = shard[:length].tobytes()
+        index, = struct.unpack_from('>I', field, 0)
+        if index != i:
+            return None
+        rebuilt.append(DataChunk(index, field[4:]))
+    return rebuilt
+
+
+def read_repaired_chunks(stream, layout):
+    ''' Like read_our_chunks(stream, layout, data_refs=True), but first check
+    the CRC of every data and parity chunk, leave out the ones that don't
+    match, and rebuild those data chunks (and any that are missing entirely)
+    in memory from parity chunks. Parity chunks themselves are left out of
+    what's returned. Data chunks that can't be rebuilt are simply missing, for
+    the caller to notice. '''
+    keep = []
+    parity_layout = []
+    for h in layout:
+        chunk_type = ChunkType.from_string(h.type)
+        if chunk_type in (ChunkType.Data, ChunkType.Parity) and \
+                not chunk_crc_matches_in_stream(stream, h):
+            log('Ignoring', chunk_type.name.lower(), 'chunk at offset',
+                h.offset, 'because its CRC doesn\'t match')
+        elif chunk_type == ChunkType.Parity:
+            parity_layout.append(h)
+        else:
+            keep.append(h)
+    chunks = read_our_chunks(stream, keep, data_refs=True)
+    data_chunks = {c.index: c for c in chunks if isinstance(c, DataChunk)}
+    stripes = {}
+    for h in parity_layout:
+        row, members = read_parity_members(stream, h)
+        stripes.setdefault(members, {})[row] = h
+    np = None
+    for members, parity_headers in stripes.items():
+        if all(i in data_chunks for i, _ in members):
+            continue
+        if np is None:
+            np = import_numpy()
+        rebuilt = rebuild_stripe(
+            np, stream, data_chunks, members, parity_headers)
+        if rebuilt is None:
+            log('Too many data chunks from index', members[0][0], 'to',
+                members[-1][0], 'are damaged to rebuild them')
+            continue
+        for c in rebuilt:
+            log('Rebuilt data chunk', c.index, 'from parity')
+            data_chunks[c.index] = c
+            chunks.append(c)
+    return chunks
@@ -0,0 +1,132 @@
+''' Preset dictionaries for zlib, which make compressing lots of small inputs
+worthwhile: a few KB on their own compress poorly, because the compressor
+starts out knowing nothing, but with a dictionary of what such inputs usually
+contain it can refer back to that from the first byte.
+
+Images only store the SHA-256 of the dictionary their data was compressed
+with (see ZDictChunk), since the dictionary is about as big as what it helps
+compress. It's kept alongside the key file and given to decode.
+
+Dictionaries are trained from sample inputs roughly like zstd's "fast cover"
+trainer does. Every 8 byte substring (d-mer) of the samples is hashed, and
+each hash is scored by how many samples it appears in. The samples are split
+into as many equal epochs as the dictionary has room for segments, and from
+each epoch the segment whose d-mers score highest is added to the dictionary,
+after which its d-mers no longer score anything, so that later segments have
+to bring something new. The best segments go at the end of the dictionary,
+where they are cheapest for zlib to refer to. NumPy is only needed for
+training. '''
+from ..util.log import fail_hard
+from .chunk import ZDictChunk
+import hashlib
+import os
+
+# zlib only ever looks back this far, so any more of a dictionary is unused
+ZDICT_MAX_BYTES = 32 * 1024  # 32 KiB
+DMER_BYTES = 8
+SEGMENT_BYTES = 128
+# d-mers are counted in a table of this many bits' worth of entries, so
+# different ones sometimes share a count
+DMER_HASH_BITS = 20
+# An odd constant with no pattern to its bits, for Fibonacci hashing
+DMER_HASH_MULTIPLIER = 0x9e3779b97f4a7c15
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        fail_hard('NumPy is needed to train a dictionary. Install it with '
+                  '`pip install numpy`.')
+    return numpy
+
+
+def zdict_digest(zdict):
+    return hashlib.sha256(zdict).digest()
+
+
+def read_zdict(fname):
+    ''' Read the preset dictionary in the given file '''
+    if not os.path.isfile(fname):
+        fail_hard(fname, 'must be a file')
+    with open(fname, 'rb') as fd:
+        zdict = fd.read()
+    if not len(zdict):
+        fail_hard('The dictionary in', fname, 'is empty')
+    return zdict
+
+
+def check_zdict(chunk, zdict):
+    ''' Make sure zdict (None if none was given) is the dictionary that the
+    ZDictChunk says the data was compressed with '''
+    assert isinstance(chunk, ZDictChunk)
+    if zdict is None:
+        fail_hard('The data was compressed with the dictionary with SHA-256',
+                  chunk.digest.hex() + '. Give --zdict.')
+    if zdict_digest(zdict) != chunk.digest:
+        fail_hard('--zdict isn\'t the dictionary the data was compressed '
+                  'with, which has SHA-256', chunk.digest.hex())
+
+
+def dmer_hashes(np, data):
+    ''' Return the hash of the d-mer starting at each offset in data that
+    one fits at '''
+    n = len(data) - DMER_BYTES + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    a = np.frombuffer(data, dtype=np.uint8).astype(np.uint64)
+    h = np.zeros(n, dtype=np.uint64)
+    for i in range(DMER_BYTES):
+        h |= a[i:i + n] << np.uint64(8 * i)
+    h *= np.uint64(DMER_HASH_MULTIPLIER)
+    return h >> np.uint64(64 - DMER_HASH_BITS)
+
+
+def train_zdict(samples, size=ZDICT_MAX_BYTES):
+    ''' Return a dictionary of at most size bytes for compressing inputs like
+    the given samples (a list of bytes). It may be shorter, if the samples
+    don't have that much in common. '''
+    np = import_numpy()
+    data = b''.join(samples)
+    h = dmer_hashes(np, data)
+    lengths = [len(s) for s in samples]
+    sample_of = np.repeat(np.arange(len(samples), dtype=np.uint64), lengths)
+    # Only d-mers entirely within one sample count
+    valid = sample_of[:len(h)] == sample_of[DMER_BYTES - 1:]
+    # How many samples each d-mer appears in. Ones in just one sample are
+    # of no use to the others.
+    seen = np.sort(
+        (sample_of[:len(h)][valid] << np.uint64(DMER_HASH_BITS)) | h[valid])
+    seen = seen[np.concatenate(([True], seen[1:] != seen[:-1]))]
+    freq = np.bincount(
+        (seen & np.uint64((1 << DMER_HASH_BITS) - 1)).astype(np.intp),
+        minlength=1 << DMER_HASH_BITS)
+    freq[freq < 2] = 0
+    h = h.astype(np.intp)
+    # One segment is chosen from each epoch, an equal share of the samples
+    dmers_per_segment = SEGMENT_BYTES - DMER_BYTES + 1
+    epochs = max(1, min(size // SEGMENT_BYTES, len(h) // SEGMENT_BYTES))
+    epoch_len = len(h) // epochs
+    chosen = []
+    for lo in range(0, epochs * epoch_len, epoch_len):
+        hi = min(lo + epoch_len, len(h))
+        # A segment's score is the sum of the scores of the d-mers starting
+        # in it, so with a running total every segment is scored at once
+        totals = np.concatenate(([0], np.cumsum(
+            np.where(valid[lo:hi], freq[h[lo:hi]], 0))))
+        starts = np.arange(0, hi - lo - dmers_per_segment + 1)
+        if not len(starts):
+            continue
+        scores = totals[starts + dmers_per_segment] - totals[starts]
+        # Segments can't straddle samples
+        scores[sample_of[lo + starts] !=
+               sample_of[lo + starts + SEGMENT_BYTES - 1]] = 0
+        best = int(np.argmax(scores))
+        if not scores[best]:
+            continue
+        start = lo + best
+        chosen.append((int(scores[best]), data[start:start + SEGMENT_BYTES]))
+        # What this segment has is no use in any other
+        freq[h[start:start + dmers_per_segment]] = 0
+    chosen.sort(key=lambda c: c[0])
+    return b''.join(segment for _, segment in chosen)[-size:]
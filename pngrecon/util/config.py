@@ -0,0 +1,84 @@
+''' A settings file that changes the defaults of some commands' options, such
+as the ones `pngrecon bench` recommends. It's an INI file with a section for
+each command, named after it, whose keys are the destinations of its options
+(buffer_max_bytes for --buffer-max-bytes):
+
+    [encode]
+    compress = gzip
+    buffer_max_bytes = 4194304
+    pipeline = True
+
+Options given on the command line still win, except that ones that can be
+given more than once (like decode's --key-file) are added to the setting. '''
+from .log import fail_hard
+import argparse
+import os
+
+CONFIG_ENV = 'PNGRECON_CONFIG'
+
+
+def default_config_path():
+    ''' Where the settings file is if not told otherwise '''
+    if os.environ.get(CONFIG_ENV) is not None:
+        return os.environ[CONFIG_ENV]
+    config_dir = os.environ.get('XDG_CONFIG_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(config_dir, 'pngrecon', 'config.ini')
+
+
+def read_config(fname):
+    ''' Return a ConfigParser with the settings in the given file, which is
+    empty if there isn't one there (or fname is empty) '''
+    # only imported when needed, to keep startup fast
+    import configparser
+    conf = configparser.ConfigParser()
+    if fname and os.path.isfile(fname):
+        try:
+            conf.read(fname)
+        except configparser.Error as e:
+            fail_hard('Can\'t read the settings in', fname + ':', e)
+    return conf
+
+
+def parse_setting(conf, fname, command, action, key):
+    ''' Return the value of the setting for the given argparse action '''
+    where = '{} in [{}] of {}'.format(key, command, fname)
+    if action.nargs == 0:
+        try:
+            return conf.getboolean(command, key)
+        except ValueError:
+            fail_hard(where, 'must be True or False')
+    value = conf.get(command, key)
+    if action.type is not None:
+        try:
+            value = action.type(value)
+        except ValueError:
+            fail_hard(where, 'can\'t be', repr(value))
+    if action.choices is not None and value not in action.choices:
+        fail_hard(where, 'must be one of', ', '.join(action.choices))
+    if isinstance(action, argparse._AppendAction):
+        return [value]
+    return value
+
+
+def set_config_defaults(p, command, fname=None):
+    ''' Make the settings in the command's section of the settings file (at
+    default_config_path() unless given) the defaults of the options of p,
+    the command's parser. Does nothing if there's no such file, which is
+    checked without importing anything. '''
+    if fname is None:
+        fname = default_config_path()
+    if not fname or not os.path.isfile(fname):
+        return
+    conf = read_config(fname)
+    if not conf.has_section(command):
+        return
+    actions = {a.dest: a for a in p._actions if a.option_strings}
+    defaults = {}
+    for key in conf.options(command):
+        if key not in actions:
+            fail_hard(key, 'in [{}] of {} isn\'t an option of {}'.format(
+                command, fname, command))
+        defaults[key] = parse_setting(
+            conf, fname, command, actions[key], key)
+    p.set_defaults(**defaults)
@@ -1,12 +1,15 @@
+# The cryptography imports are done inside the functions that need them.
+# Loading its backends is a noticeable share of our startup time, and most
+# invocations (info, unencrypted encode/decode) never touch them.
 from ..util.log import log_stderr as log
-from cryptography.fernet import Fernet
-from cryptography.fernet import InvalidToken
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from ..util.log import fail_hard
+from collections import OrderedDict
+from getpass import getpass
+from threading import Lock
 import base64
+import hashlib
+import hmac
 import os
-from getpass import getpass
 
 
 def gen_salt():
@@ -37,10 +40,32 @@ def prompt_password(for_encryption=True, empty_okay=False):
     return bytes(pw1, 'utf-8')
 
 
+class DerivedKey():
+    ''' A key derived from a password by gen_key. encrypt and decrypt use it
+    through fernet, and derive_subkey makes keys for other purposes from the
+    key derivation's output. '''
+    def __init__(self, secret):
+        from cryptography.fernet import Fernet
+        self.secret = secret
+        # Fernet wants it in base 64
+        self.fernet = Fernet(base64.urlsafe_b64encode(secret))
+
+
+def derive_subkey(key, label):
+    ''' Return a key for the purpose named by label (bytes) derived one way
+    from the DerivedKey key, so it's just as secret but can't be used to
+    decrypt anything or to find the key '''
+    return hmac.digest(key.secret, label, 'sha256')
+
+
 def gen_key(password=None, salt=None, for_encryption=True):
     ''' If no password given, prompt the user. If no salt, generate a random
     one. if we need to prompt for a password, tell promp_password whether or
-    not it is for encryption so it can change its prompt string. '''
+    not it is for encryption so it can change its prompt string. Return the
+    salt and the DerivedKey. '''
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
     password = prompt_password(for_encryption=for_encryption) \
         if password is None else password
     salt = gen_salt() if salt is None else salt
@@ -51,22 +76,76 @@ def gen_key(password=None, salt=None, for_encryption=True):
         iterations=100000,
         backend=default_backend()
     )
-    # Fernet wants it in base 64
-    key = base64.urlsafe_b64encode(kdf.derive(password))
-    f = Fernet(key)
-    return salt, f
+    return salt, DerivedKey(kdf.derive(password))
+
+
+class KeyCache():
+    ''' Remember keys derived by gen_key so that deriving the same one again
+    is free, for long-lived processes handling many requests. Keys for
+    encrypting are derived once per password and reused, salt and all, so
+    everything encrypted with the same password through the cache shares a
+    salt. The maxsize most recently used keys are kept. Thread safe.
+
+    Unlike gen_key, there is no prompting for a password. '''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # (password digest, salt) -> fernet
+        self._keys = OrderedDict()
+        # password digest -> salt to use when encrypting
+        self._encrypt_salts = {}
+        self._lock = Lock()
+
+    def gen_key(self, password=None, salt=None, for_encryption=True):
+        ''' Same as gen_key '''
+        if password is None:
+            fail_hard('Data is encrypted but no key was given')
+        pw_id = hashlib.sha256(password).digest()
+        with self._lock:
+            if salt is None:
+                salt = self._encrypt_salts.setdefault(pw_id, gen_salt())
+            fernet = self._keys.get((pw_id, salt))
+            if fernet is not None:
+                self._keys.move_to_end((pw_id, salt))
+                self.hits += 1
+                return salt, fernet
+            self.misses += 1
+        # Deriving is slow on purpose, so don't hold up other threads
+        salt, fernet = gen_key(password=password, salt=salt)
+        with self._lock:
+            self._keys[(pw_id, salt)] = fernet
+            while len(self._keys) > self.maxsize:
+                (old_pw_id, old_salt), _ = self._keys.popitem(last=False)
+                if self._encrypt_salts.get(old_pw_id) == old_salt:
+                    del self._encrypt_salts[old_pw_id]
+        return salt, fernet
+
+
+def key_check_value(fernet):
+    ''' Return a value that's stored next to the salt to tell whether a key
+    derived from a password is the right one before decrypting anything: an
+    HMAC of a constant keyed with the key. It gives away nothing the
+    encrypted data doesn't; checking a guess still costs a key derivation. '''
+    return derive_subkey(fernet, b'pngrecon key check')
+
+
+def key_check_matches(fernet, key_check):
+    ''' Whether fernet is the key the given key check value was made with '''
+    return hmac.compare_digest(key_check_value(fernet), key_check)
 
 
 def encrypt(fernet, data):
-    return base64.urlsafe_b64decode(fernet.encrypt(data))
+    return base64.urlsafe_b64decode(fernet.fernet.encrypt(data))
 
 
 def decrypt(fernet, data):
     ''' Try decrypting data with the given fernet structure. If all goes well,
     return True and the decrypted data. Else return False and an error
     message '''
+    from cryptography.fernet import InvalidToken
     try:
-        d = fernet.decrypt(base64.urlsafe_b64encode(data))
+        d = fernet.fernet.decrypt(base64.urlsafe_b64encode(data))
     except InvalidToken as e:
         return False, 'Passphrase appears to be incorrect'
     return True, d
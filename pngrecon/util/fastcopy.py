@@ -0,0 +1,136 @@
+import errno
+import io
+import mmap
+import os
+import zlib
+
+# errnos that mean "this kernel/file combination can't do that kind of copy,
+# try something else" as opposed to a real I/O error
+_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+                errno.EOPNOTSUPP, errno.ENOTSUP}
+# Largest amount to ask the kernel to move in one call
+_MAX_STEP = 1024 * 1024 * 1024  # 1 GiB
+_FALLBACK_STEP = 1024 * 1024  # 1 MiB
+# How much to hold at once when copying to something the kernel can't copy to
+COPY_BUFFER_BYTES = 1024 * 1024  # 1 MiB
+# How much of a file to map at once to CRC or hash it
+MAP_WINDOW_BYTES = 16 * 1024 * 1024  # 16 MiB
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+def _read_write(in_fd, out_fd, offset, count):
+    b = os.pread(in_fd, min(count, _FALLBACK_STEP), offset)
+    view = memoryview(b)
+    while len(view):
+        view = view[os.write(out_fd, view):]
+    return len(b)
+
+
+def _copy_methods():
+    if hasattr(os, 'copy_file_range'):
+        yield _copy_file_range
+    if hasattr(os, 'sendfile'):
+        yield _sendfile
+    yield _read_write
+
+
+def copy_range(in_fd, out_fd, offset, count):
+    ''' Copy count bytes starting at offset in the file descriptor in_fd to
+    the current position of the file descriptor out_fd. The position of in_fd
+    is not used or changed. When possible, the bytes never leave the kernel:
+    copy_file_range is tried first (file to file), then sendfile (file to
+    anything, including pipes), then plain reads and writes.
+
+    If the caller has a buffered file object wrapping out_fd, it must flush it
+    first. Raises EOFError if in_fd ends before count bytes are copied. Only
+    plain reads are trusted to say so: some filesystems (procfs, sysfs, some
+    FUSE and network ones) have the kernel copy nothing from files with data
+    left, so that just means trying the next way. '''
+    methods = _copy_methods()
+    method = next(methods)
+    while count > 0:
+        try:
+            n = method(in_fd, out_fd, offset, min(count, _MAX_STEP))
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or method is _read_write:
+                raise
+            method = next(methods)
+            continue
+        if n == 0:
+            if method is _read_write:
+                raise EOFError('Input ended {} bytes early'.format(count))
+            method = next(methods)
+            continue
+        offset += n
+        count -= n
+
+
+def copy_file_object_range(in_fd, out_fd, start, end):
+    ''' Copy the bytes [start, end) of the file open as in_fd to out_fd, a
+    buffered file object, without bringing them into Python if the kernel can
+    help it (see copy_range). out_fd is flushed first. If it isn't backed by a
+    real file, the bytes are read and written a piece at a time, which moves
+    the position of in_fd. '''
+    out_fd.flush()
+    try:
+        out_fileno = out_fd.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        # Not backed by a real file, so it can only be written to
+        out_fileno = None
+    if out_fileno is not None:
+        copy_range(in_fd.fileno(), out_fileno, start, end - start)
+        return
+    in_fd.seek(start, 0)
+    remaining = end - start
+    while remaining > 0:
+        b = in_fd.read(min(remaining, COPY_BUFFER_BYTES))
+        if not len(b):
+            raise EOFError('Input ended {} bytes early'.format(remaining))
+        out_fd.write(b)
+        remaining -= len(b)
+
+
+def mapped_range(fileno, offset, count):
+    ''' Yield memoryviews of count bytes starting at offset in the file
+    descriptor fileno (a regular file), in order, mapped into memory a window
+    at a time instead of being copied into Python. Each view is only valid
+    until the next one is asked for. Raises EOFError if the file ends before
+    count bytes. '''
+    if count > 0 and os.fstat(fileno).st_size < offset + count:
+        raise EOFError('Input ended before {} bytes'.format(count))
+    end = offset + count
+    while offset < end:
+        # Mappings must start on a multiple of the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        length = min(end, offset + MAP_WINDOW_BYTES) - start
+        with mmap.mmap(fileno, length, access=mmap.ACCESS_READ,
+                       offset=start) as buf:
+            with memoryview(buf) as view:
+                with view[offset - start:] as window:
+                    yield window
+        offset = start + length
+
+
+def crc32_range(fileno, offset, count, crc=0):
+    ''' Return the CRC-32 of count bytes starting at offset in the file
+    descriptor fileno (a regular file), continuing from crc. The bytes are
+    mapped into memory (see mapped_range), and zlib releases the GIL while it
+    works on them. '''
+    for window in mapped_range(fileno, offset, count):
+        crc = zlib.crc32(window, crc)
+    return crc
+
+
+def hash_range(fileno, offset, count, h):
+    ''' Update the hashlib object h with count bytes starting at offset in
+    the file descriptor fileno (a regular file), mapped into memory like
+    crc32_range does '''
+    for window in mapped_range(fileno, offset, count):
+        h.update(window)
@@ -1,6 +1,15 @@
 import sys
 
 
+class FailHard(SystemExit):
+    ''' Raised by fail_hard. It is a SystemExit, so the command line tool
+    exits with status 1 as always, but code using pngrecon as a library (see
+    pngrecon.aio) can catch it and carry on. message is what was logged. '''
+    def __init__(self, message):
+        super().__init__(1)
+        self.message = message
+
+
 def log_stderr(*a, **kw):
     print(*a, file=sys.stderr, **kw)
 
@@ -12,4 +21,4 @@ def log_stdout(*a, **kw):
 def fail_hard(*a, **kw):
     if a:
         log_stderr(*a, **kw)
-    exit(1)
+    raise FailHard(kw.get('sep', ' ').join(str(i) for i in a))
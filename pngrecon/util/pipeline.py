@@ -0,0 +1,94 @@
+import queue
+import threading
+
+# How many items may wait between two pipeline stages. Each item is at most
+# roughly --buffer-max-bytes, so this bounds the memory a pipeline can use.
+DEFAULT_QUEUE_DEPTH = 2
+
+# Marks the end of the items coming through a queue
+_DONE = object()
+
+
+class _Raised():
+    ''' Carries an exception raised in a worker thread over to the thread
+    consuming its items, where it is raised again '''
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class ThreadedIterator():
+    ''' Iterate over the given iterable on a background thread, handing over
+    the items through a queue that holds at most maxsize of them. The
+    background thread blocks when the queue is full, so a slow consumer slows
+    down the producer instead of letting items pile up in memory.
+
+    Exceptions raised while producing items (including SystemExit from
+    fail_hard) are raised again in the consuming thread. Closing the iterator
+    makes the background thread stop at the next item, and closes upstream,
+    the ThreadedIterator feeding this one (if any), too. '''
+    def __init__(self, iterable, maxsize=DEFAULT_QUEUE_DEPTH, name=None,
+                 upstream=None):
+        self._upstream = upstream
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(
+            target=self._produce, args=(iterable,), name=name, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        ''' Put item in the queue, giving up if we're told to stop. Return
+        whether the item was put. '''
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self._put(_Raised(e))
+            return
+        self._put(_DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item = self._queue.get()
+        if item is _DONE:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _Raised):
+            self.close()
+            raise item.exc
+        return item
+
+    def close(self):
+        self._finished = True
+        self._stop.set()
+        if self._upstream is not None:
+            self._upstream.close()
+
+
+def pipeline(items, stages, maxsize=DEFAULT_QUEUE_DEPTH):
+    ''' Chain the given stages together, each running on its own thread.
+    items is an iterable (typically a generator reading input) and each stage
+    is a function taking an iterable and returning a new one, like a
+    generator function. Return an iterable over the output of the last stage,
+    which is to be consumed on the calling thread. Close it to stop all the
+    stages early. '''
+    it = ThreadedIterator(items, maxsize=maxsize, name='pipeline-0')
+    for i, stage in enumerate(stages):
+        it = ThreadedIterator(
+            stage(it), maxsize=maxsize, name='pipeline-{}'.format(i + 1),
+            upstream=it)
+    return it
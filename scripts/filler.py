@@ -10,7 +10,28 @@
 ##
 ##     python3 filler.py filler.conf
 ##
+## Each run and each job it did are recorded in the catalog, with how long
+## tarring and encoding took and how much went in and came out. To see how
+## fast it's been going, which jobs were slowest, how busy the workers were,
+## and how well each root compresses:
+##
+##     python3 filler.py stats filler.conf
+##
+## Small leaves are packed together: each job tars one or more leaves, one
+## after another, each as a whole tar archive of its own, and cuts that
+## stream into pieces of split_file_size_limit_mb that become 001.png,
+## 002.png, and so on. encoded_location says, for each leaf, which PNG its
+## archive starts in, how far into that PNG's data it starts, and how long it
+## is, which may run on into the next PNGs. So to get one leaf back:
+##
+##     for f in 003.png 004.png; do pngrecon decode --key-file filler.key -i $f; done \
+##         | tail -c +$((member_offset + 1)) | head -c $member_bytes | tar x
+##
+import argparse
 import configparser
+import fnmatch
+import http.client
+import socket
 import sqlite3
 import subprocess
 import os
@@ -18,14 +39,27 @@ import sys
 import glob
 import time
 import pathlib
+import queue
 from dataclasses import dataclass
 from typing import List, Union
 from copy import deepcopy
 from tempfile import TemporaryDirectory
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlencode
 
 BUNDLE_LEAF_DIR = 1
 SPLIT_FILE = 2
+# Directories listed at the same time while cataloging
+WALK_THREADS = 16
+# Most directory entries sent from the walker to the catalog at once
+WALK_BATCH_SIZE = 1000
+# Leaves are packed into the same job until they add up to this much, by
+# default
+PACK_SIZE_LIMIT = 64 * 1024 * 1024 # 64 MiB
+# Most leaves packed into one job, however small they are
+PACK_MAX_LEAVES = 1000
+# How much of tar's output is copied into a piece at a time
+COPY_BYTES = 1024 * 1024
 
 def log(*a, **kw):
     print(*a, file=sys.stderr, **kw)
@@ -72,6 +106,13 @@ class Root:
     out_p: Path
     opts: dict
 
+@dataclass
+class Leaf:
+    # Relative to its root
+    subpath: Path
+    id_path: List[int]
+    work_rowid: int
+
 def get_dir_size(d: Path):
     dname = str(d)
     if not os.path.exists(dname):
@@ -90,10 +131,17 @@ def get_roots(conf) -> List[Root]:
             'split_file_size_limit': int(float(opts1['split_file_size_limit_mb']) * 1024 * 1024) \
                 if 'split_file_size_limit_mb' in opts1 \
                 else 1 * 1024 * 1024 * 1024, # 1 GiB
+            # 0 gives every leaf a job of its own
+            'pack_size_limit': int(float(opts1['pack_size_limit_mb']) * 1024 * 1024) \
+                if 'pack_size_limit_mb' in opts1 \
+                else PACK_SIZE_LIMIT,
             'style': {
                 'bundle_leaf_dir': BUNDLE_LEAF_DIR,
                 'split_file': SPLIT_FILE,
             }[opts1['style']],
+            # Entries matching any of these (one per line) aren't cataloged,
+            # and excluded directories aren't even looked in
+            'exclude': [l.strip() for l in opts1.get('exclude', '').splitlines() if l.strip()],
         }
         a.append(Root(
             Path.from_str(os.path.abspath(conf['roots'][key])),
@@ -119,32 +167,75 @@ def get_root_rowid(db_con, root: Root):
     assert res is not None
     return res[0]
 
-def walk_roots(db_con, roots: List[Root]):
+def is_excluded(rel: str, name: str, excludes: List[str]):
+    # Patterns match either the entry's name or its path relative to its root
+    return any(fnmatch.fnmatchcase(name, pat) or fnmatch.fnmatchcase(rel, pat)
+               for pat in excludes)
+
+def list_dir(q: queue.Queue, dname: str, rel: str, rowid: int, opts: dict):
+    # Runs on the walker's thread pool. Puts batches of (name, is_dir) for the
+    # entries of the directory that should be cataloged on the queue, the
+    # last one marked final. Uses the type info from the directory entries
+    # themselves, so only symlinks need a stat.
+    batch = []
+    try:
+        with os.scandir(dname) as it:
+            for entry in it:
+                sub_rel = rel + '/' + entry.name if rel else entry.name
+                if is_excluded(sub_rel, entry.name, opts['exclude']):
+                    continue
+                try:
+                    if entry.is_dir():
+                        batch.append((entry.name, True))
+                    elif opts['style'] == SPLIT_FILE and entry.is_file():
+                        batch.append((entry.name, False))
+                except OSError:
+                    continue
+                if len(batch) >= WALK_BATCH_SIZE:
+                    q.put((rowid, dname, rel, opts, batch, False))
+                    batch = []
+    except OSError as e:
+        log('Could not list', dname, e)
+    finally:
+        # Always, so the catalog writer isn't left waiting for it
+        q.put((rowid, dname, rel, opts, batch, True))
+
+def walk_roots(db_con, roots: List[Root], threads: int = WALK_THREADS):
+    # Directories are listed on a thread pool, and the listings come back
+    # here through a queue to be cataloged, since only this thread may use
+    # db_con. A directory's subdirectories are only listed once it has been
+    # cataloged and they have rowids.
     cur = db_con.cursor()
-    # subpath (without parentdir), parentdir,      rowid, options
-    # Path,                        Optional<Path>, int,   dict
-    todo = [(r.in_p, None, get_root_rowid(db_con, r), r.opts) for r in roots]
-    while len(todo):
-        current, parent, cur_rowid, opts = todo.pop()
-        if parent:
-            p = pathlib.Path(str(parent), str(current))
-        else:
-            p = pathlib.Path(str(current))
-        for sub in p.glob('*'):
-            if not (sub.is_dir() or (sub.is_file() and opts['style'] == SPLIT_FILE)):
-                continue
-            sub_relative = str(sub).removeprefix(str(p) + '/')
-            res = cur.execute(
-                'SELECT rowid FROM name_map WHERE name = ? AND parent = ?',
-                (sub_relative, cur_rowid)).fetchone()
-            if res is None:
-                res = cur.execute(
-                    'INSERT INTO name_map VALUES (?, ?)',
-                    (sub_relative, cur_rowid))
-                new_rowid = cur.lastrowid
-            else:
-                new_rowid = res[0]
-            todo.append((Path.from_str(sub_relative), Path.from_str(str(p)), new_rowid, opts))
+    q = queue.Queue()
+    pending = 0
+    # rowid -> {name: rowid} of what was already cataloged under that
+    # directory, while its batches are still coming in
+    known = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for r in roots:
+            executor.submit(list_dir, q, str(r.in_p), '', get_root_rowid(db_con, r), r.opts)
+            pending += 1
+        while pending:
+            rowid, dname, rel, opts, batch, final = q.get()
+            if rowid not in known:
+                known[rowid] = dict(cur.execute(
+                    'SELECT name, rowid FROM name_map WHERE parent = ?',
+                    (rowid,)).fetchall())
+            children = known[rowid]
+            for name, is_dir in batch:
+                sub_rowid = children.get(name)
+                if sub_rowid is None:
+                    cur.execute('INSERT INTO name_map VALUES (?, ?)',
+                                (name, rowid))
+                    sub_rowid = cur.lastrowid
+                if is_dir:
+                    executor.submit(
+                        list_dir, q, os.path.join(dname, name),
+                        rel + '/' + name if rel else name, sub_rowid, opts)
+                    pending += 1
+            if final:
+                del known[rowid]
+                pending -= 1
     db_con.commit()
 
 
@@ -179,51 +270,242 @@ def next_n_work(db_con, n):
     cur.execute('SELECT rowid, * FROM work WHERE is_done = FALSE LIMIT ?', (n,))
     return cur.fetchall()
 
-def encode_and_mark_done(root: Root, in_name: Path, id_path: List[int], out_dname: Path, rowid: int, pngrecon, keyfile, max_file_size: int, style: int, db_fname: str):
+def get_leaf_size(p: Path):
+    # Roughly how much tar will write for the leaf: the sizes of the files in
+    # it (or of it, if it's a file). Symlinks aren't followed, like tar.
+    fname = str(p)
+    if not os.path.isdir(fname) or os.path.islink(fname):
+        try:
+            return os.lstat(fname).st_size
+        except OSError:
+            return 0
+    size = 0
+    for dname, _, fnames in os.walk(fname):
+        for f in fnames:
+            try:
+                size += os.lstat(os.path.join(dname, f)).st_size
+            except OSError:
+                pass
+    return size
+
+def next_n_jobs(db_con, roots: List[Root], n):
+    # Up to n jobs, each a root and the leaves of it to encode together. Leaves
+    # of the same root are packed into a job until they'd add up to more than
+    # its pack_size_limit, so that tiny leaves share a tar stream, a pngrecon
+    # run (and its key derivation), and an output directory instead of each
+    # paying for their own. Work that doesn't fit is left for next time.
+    jobs = []
+    # in_p of the root -> (root, leaves, size) of the job being packed for it
+    packing = {}
+    for row in next_n_work(db_con, n * PACK_MAX_LEAVES):
+        root_path, subpath, id_path = get_path(db_con, row['obj_id'])
+        root = [r for r in roots if r.in_p == root_path][0]
+        limit = root.opts['pack_size_limit']
+        p = deepcopy(root.in_p)
+        p.append(subpath)
+        size = get_leaf_size(p) if limit else 0
+        _, leaves, total = packing.pop(str(root_path), (root, [], 0))
+        if len(leaves) and (not limit or total + size > limit or len(leaves) >= PACK_MAX_LEAVES):
+            jobs.append((root, leaves))
+            leaves, total = [], 0
+        if not len(leaves) and len(jobs) + len(packing) >= n:
+            break
+        leaves.append(Leaf(subpath, id_path, row['rowid']))
+        packing[str(root_path)] = (root, leaves, total + size)
+    jobs.extend((root, leaves) for root, leaves, _ in packing.values())
+    return jobs
+
+def leaf_out_dname(root: Root, leaf: Leaf):
+    # Where a job whose first leaf is this one puts its PNGs
+    out_dname = deepcopy(root.out_p)
+    out_dname.append(Path([str(_) for _ in leaf.id_path], False))
+    return out_dname
+
+def remove_stale_volumes(root: Root, leaves: List[Leaf]):
+    # Remove the PNGs an earlier job left behind for these leaves if it died
+    # before marking them done. Jobs are packed anew each run, so its
+    # directory may be named after any of them, not just the first one this
+    # time. None of them are done, so nothing in there is wanted.
+    for leaf in leaves:
+        out_dname = str(leaf_out_dname(root, leaf))
+        stale = glob.glob(out_dname + '/[0-9][0-9][0-9]*.png')
+        if not len(stale):
+            continue
+        log('Removing', len(stale), 'PNGs left behind in', out_dname)
+        for f in stale:
+            os.unlink(f)
+        try:
+            os.rmdir(out_dname)
+        except OSError:
+            # Something else is in there too
+            pass
+
+def describe_leaves(leaves: List[Leaf]):
+    if len(leaves) == 1:
+        return str(leaves[0].subpath)
+    return f'{leaves[0].subpath} and {len(leaves) - 1} more'
+
+def encode_and_mark_done(run_id: int, root: Root, leaves: List[Leaf], out_dname: Path, pngrecon, keyfile, max_file_size: int, style: int, db_fname: str, server=None):
+    start = time.time()
     db_con = sqlite3.connect(db_fname)
-    if not encode(root, in_name, out_dname, pngrecon, keyfile, max_file_size, style):
+    phases = {}
+    spans = encode(root, leaves, out_dname, pngrecon, keyfile, max_file_size, style, phases, server)
+    if spans is None:
         return False
-    log('Done', in_name)
-    mark_done(root, in_name, db_con, rowid, id_path)
+    log('Done', describe_leaves(leaves))
+    in_bytes = sum(size for _, size in spans)
+    # The pieces that became 001.png, 002.png, and so on
+    volumes = [f'{out_dname}/{n:03}.png' for n in range(1, -(-in_bytes // max_file_size) + 1)]
+    job = {
+        'run_id': run_id,
+        'root': str(root.in_p),
+        'obj_id': leaves[0].id_path[-1],
+        'leaves': len(leaves),
+        'start_time': start,
+        'in_bytes': in_bytes,
+        'out_bytes': sum(os.path.getsize(f) for f in volumes),
+        'volumes': len(volumes),
+        'tar_s': phases['tar_s'],
+        'encode_s': phases['encode_s'],
+    }
+    mark_done(root, leaves, spans, out_dname, max_file_size, db_con, job)
     return True
 
-def mark_done(root: Root, in_name: Path, db_con, rowid, id_path: List[int]):
+def mark_done(root: Root, leaves: List[Leaf], spans, out_dname: Path, max_file_size: int, db_con, job: dict):
+    # job is the row for the job table, but for how long this takes and when
+    # it ended, which are filled in here
+    start = time.monotonic()
     cur = db_con.cursor()
     cur.execute('BEGIN')
-    cur.execute('UPDATE work SET is_done = TRUE WHERE rowid = ?', (rowid,))
     cmds = []
-    if root.opts['style'] == BUNDLE_LEAF_DIR:
-        p = deepcopy(root.in_p)
-        p.append(in_name)
-        for fname in pathlib.Path(str(p)).glob('*'):
-            cmds.append((os.path.basename(fname), id_path[-1], root.opts['style']))
-    elif root.opts['style'] == SPLIT_FILE:
-        cmds.append((os.path.basename(str(in_name)), id_path[-1], root.opts['style']))
-    else:
-        assert False
-    cur.executemany('INSERT INTO encoded_location VALUES(?, ?, ?)', cmds)
+    for leaf, (offset, size) in zip(leaves, spans):
+        cur.execute('UPDATE work SET is_done = TRUE WHERE rowid = ?', (leaf.work_rowid,))
+        # The PNG the leaf's archive starts in, and where in its data
+        png = deepcopy(out_dname)
+        png.append(PathComponent(f'{offset // max_file_size + 1:03}.png'))
+        loc = (leaf.id_path[-1], root.opts['style'], str(png), offset % max_file_size, size)
+        if root.opts['style'] == BUNDLE_LEAF_DIR:
+            p = deepcopy(root.in_p)
+            p.append(leaf.subpath)
+            for fname in pathlib.Path(str(p)).glob('*'):
+                cmds.append((os.path.basename(fname),) + loc)
+        elif root.opts['style'] == SPLIT_FILE:
+            cmds.append((os.path.basename(str(leaf.subpath)),) + loc)
+        else:
+            assert False
+    cur.executemany(
+        'INSERT INTO encoded_location (fname, obj_id, backup_style, png, '
+        'member_offset, member_bytes) VALUES(?, ?, ?, ?, ?, ?)', cmds)
+    job = dict(job, end_time=time.time(), mark_done_s=time.monotonic() - start)
+    cur.execute('INSERT INTO job ({}) VALUES ({})'.format(
+        ', '.join(job.keys()), ', '.join('?' * len(job))), tuple(job.values()))
     cur.execute('COMMIT')
 
-def encode(root: Root, in_name: Path, out_dname: Path, pngrecon, keyfile, max_file_size: int, style: int):
-    with TemporaryDirectory() as temp_d:
-        tar_args = ['tar', '-c', '-C', str(root.in_p), str(in_name)]
-        tar = subprocess.Popen(tar_args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        split_args = ['split', '--bytes', str(int(max_file_size)), '-', temp_d + '/pngrecon-']
-        split = subprocess.Popen(split_args, stdin=tar.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if tar.wait() != 0:
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def encode_with_server(server: str, keyfile, in_fname: str, out_fname: str):
+    # server is either the path to a `pngrecon serve --unix` socket, or the
+    # HOST:PORT of a `pngrecon serve --listen`. The server only reads files
+    # inside its --root, so keyfile must be in there.
+    if server.startswith('/'):
+        conn = UnixHTTPConnection(server)
+    else:
+        conn = http.client.HTTPConnection(server)
+    query = urlencode({'encrypt': 1, 'key_file': os.path.abspath(keyfile)})
+    with open(in_fname, 'rb') as in_fd:
+        try:
+            conn.request('POST', '/encode?' + query, body=in_fd,
+                headers={'Content-Length': str(os.path.getsize(in_fname))})
+            resp = conn.getresponse()
+        except OSError as e:
+            log('Could not talk to pngrecon server:', e)
             return False
-        if split.wait() != 0:
+        if resp.status != 200:
+            log('pngrecon server failed:', resp.read().decode(errors='replace').strip())
             return False
+        try:
+            with open(out_fname, 'wb') as out_fd:
+                while True:
+                    b = resp.read(1024 * 1024)
+                    if not b:
+                        break
+                    out_fd.write(b)
+        except http.client.IncompleteRead:
+            log('pngrecon server failed partway through', in_fname)
+            return False
+    return True
+
+def tar_leaves(root: Root, leaves: List[Leaf], temp_d: str, max_file_size: int):
+    # Write a tar archive of each leaf, one after another, cut into pieces of
+    # max_file_size bytes in temp_d, the way split would. Each archive is
+    # whole, so a leaf can be extracted without the ones before it, and is
+    # made of one block records so that tiny ones aren't padded out to 10 KiB.
+    # Return the (offset, size) of each leaf's archive in the stream, or None
+    # if tar failed.
+    spans = []
+    offset = 0
+    piece = None
+    piece_left = 0
+    n = 0
+    try:
+        for leaf in leaves:
+            tar_args = ['tar', '-c', '-b', '1', '-C', str(root.in_p), str(leaf.subpath)]
+            tar = subprocess.Popen(tar_args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            start = offset
+            for b in iter(lambda: tar.stdout.read(COPY_BYTES), b''):
+                view = memoryview(b)
+                while len(view):
+                    if not piece_left:
+                        if piece is not None:
+                            piece.close()
+                        n += 1
+                        piece = open(f'{temp_d}/pngrecon-{n:06}', 'wb')
+                        piece_left = max_file_size
+                    written = piece.write(view[:piece_left])
+                    view = view[written:]
+                    piece_left -= written
+                    offset += written
+            if tar.wait() != 0:
+                return None
+            spans.append((start, offset - start))
+    finally:
+        if piece is not None:
+            piece.close()
+    return spans
+
+def encode(root: Root, leaves: List[Leaf], out_dname: Path, pngrecon, keyfile, max_file_size: int, style: int, phases: dict, server=None):
+    # Return what tar_leaves does, or None if anything failed. How long
+    # tarring and encoding took go in phases as tar_s and encode_s.
+    with TemporaryDirectory() as temp_d:
+        start = time.monotonic()
+        spans = tar_leaves(root, leaves, temp_d, max_file_size)
+        phases['tar_s'] = time.monotonic() - start
+        if spans is None:
+            return None
+        start = time.monotonic()
         n = 1
         for temp_fname in sorted(glob.glob(temp_d + '/pngrecon-*')):
             out_f = deepcopy(out_dname)
             out_f.append(PathComponent(f'{n:03}.png'))
+            if server:
+                if not encode_with_server(server, keyfile, temp_fname, str(out_f)):
+                    return None
+                n += 1
+                continue
             png_args = [pngrecon, 'encode', '-e', '--key-file', keyfile, '-i', temp_fname, '-o', str(out_f)]
             png = subprocess.run(png_args)
             if png.returncode != 0:
-                return False
+                return None
             n += 1
-    return True
+        phases['encode_s'] = time.monotonic() - start
+    return spans
 
 
 def wait_for_done_jobs(jobs):
@@ -246,9 +528,26 @@ def wait_for_done_jobs(jobs):
     return True, jobs
 
 
-def main(conf):
-    db_con = sqlite3.connect(conf['db']['fname'])
-    db_con.row_factory = sqlite3.Row
+# Columns added to encoded_location since it was first made, which catalogs
+# made before then are given (as NULL for what was already in them)
+ENCODED_LOCATION_COLUMNS = (
+    # The PNG the leaf's archive starts in
+    ('png', 'TEXT'),
+    # Where in the data of that PNG it starts
+    ('member_offset', 'INTEGER'),
+    # How long it is, running on into the next PNGs if need be
+    ('member_bytes', 'INTEGER'),
+)
+
+def add_missing_columns(db_con, table: str, columns):
+    cur = db_con.cursor()
+    have = set(row[1] for row in cur.execute(f'PRAGMA table_info({table})'))
+    for name, decl in columns:
+        if name not in have:
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+    db_con.commit()
+
+def create_tables(db_con):
     cur = db_con.cursor()
     cur.executescript('''
         BEGIN;
@@ -257,6 +556,7 @@ def main(conf):
             parent INTEGER,
             FOREIGN KEY (parent) REFERENCES name_map (rowid)
         );
+        CREATE INDEX IF NOT EXISTS name_map_parent ON name_map (parent, name);
         CREATE TABLE IF NOT EXISTS work(
             obj_id INTEGER NOT NULL,
             is_done BOOLEAN NOT NULL,
@@ -268,20 +568,58 @@ def main(conf):
             backup_style INTEGER NOT NULL,
             FOREIGN KEY (obj_id) REFERENCES name_map (rowid)
         );
+        -- Each time filler is run. end_time is NULL if it didn't finish.
+        -- walk_s is how long cataloging took before any jobs started.
+        CREATE TABLE IF NOT EXISTS run(
+            start_time REAL NOT NULL,
+            end_time REAL,
+            max_jobs INTEGER NOT NULL,
+            walk_s REAL
+        );
+        -- Each job that was done, with obj_id its first leaf. Times are
+        -- seconds since the epoch, in_bytes is the size of its tar stream,
+        -- and out_bytes that of its volumes (PNGs).
+        CREATE TABLE IF NOT EXISTS job(
+            run_id INTEGER NOT NULL,
+            root NOT NULL,
+            obj_id INTEGER NOT NULL,
+            leaves INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            end_time REAL NOT NULL,
+            in_bytes INTEGER NOT NULL,
+            out_bytes INTEGER NOT NULL,
+            volumes INTEGER NOT NULL,
+            tar_s REAL NOT NULL,
+            encode_s REAL NOT NULL,
+            mark_done_s REAL NOT NULL,
+            FOREIGN KEY (run_id) REFERENCES run (rowid),
+            FOREIGN KEY (obj_id) REFERENCES name_map (rowid)
+        );
         COMMIT;
     ''')
+    add_missing_columns(db_con, 'encoded_location', ENCODED_LOCATION_COLUMNS)
+
+def main(conf):
+    db_con = sqlite3.connect(conf['db']['fname'])
+    db_con.row_factory = sqlite3.Row
+    create_tables(db_con)
+    max_jobs = int(conf['general']['max_jobs'])
+    cur = db_con.cursor()
+    start = time.time()
+    cur.execute('INSERT INTO run (start_time, max_jobs) VALUES (?, ?)', (start, max_jobs))
+    run_id = cur.lastrowid
+    db_con.commit()
     roots = get_roots(conf)
     insert_roots(db_con, roots)
-    walk_roots(db_con, roots)
+    walk_roots(db_con, roots, int(conf['general'].get('walk_threads', WALK_THREADS)))
     insert_work(db_con)
-    max_jobs = int(conf['general']['max_jobs'])
-    rows = next_n_work(db_con, max_jobs)
-    while len(rows):
+    cur.execute('UPDATE run SET walk_s = ? WHERE rowid = ?', (time.time() - start, run_id))
+    db_con.commit()
+    jobs = next_n_jobs(db_con, roots, max_jobs)
+    while len(jobs):
         futures = []
         with ProcessPoolExecutor(max_workers=max_jobs) as executor:
-            for row in rows:
-                root_path, subpath, id_path = get_path(db_con, row['obj_id'])
-                root = [r for r in roots if r.in_p == root_path][0]
+            for root, leaves in jobs:
                 block_fname = deepcopy(root.out_p)
                 block_fname.append(PathComponent('filler.waiting'))
                 while os.path.exists(str(block_fname)) or get_dir_size(root.out_p) > root.opts['outdir_size_limit']:
@@ -291,27 +629,154 @@ def main(conf):
                             fd.write('hi\n')
                     log(str(root.out_p), 'too big')
                     time.sleep(60)
-                out_dname = deepcopy(root.out_p)
-                out_dname.append(Path([str(_) for _ in id_path], False))
+                remove_stale_volumes(root, leaves)
+                # Named after the first leaf, which is in no other job
+                out_dname = leaf_out_dname(root, leaves[0])
                 os.makedirs(str(out_dname), exist_ok=True)
-                log('Doing', subpath, 'into', out_dname)
+                log('Doing', describe_leaves(leaves), 'into', out_dname)
                 futures.append(executor.submit(encode_and_mark_done,
-                    root, subpath, id_path, out_dname, row['rowid'],
+                    run_id, root, leaves, out_dname,
                     conf['pngrecon']['path'],
                     conf['pngrecon']['keyfile'],
                     root.opts['split_file_size_limit'],
                     root.opts['style'],
                     conf['db']['fname'],
+                    conf['pngrecon'].get('server'),
                 ))
             while len(futures):
                 did_ok, futures = wait_for_done_jobs(futures)
                 if not did_ok:
                     log('didnt do ok :(')
                     return 1
-        rows = next_n_work(db_con, max_jobs)
+        jobs = next_n_jobs(db_con, roots, max_jobs)
+    cur.execute('UPDATE run SET end_time = ? WHERE rowid = ?', (time.time(), run_id))
+    db_con.commit()
     return 0
 
+def mb(n):
+    return n / 1e6 if n is not None else 0.0
+
+def run_stats(db_con, run):
+    # What each run did, and how busy its workers were while jobs were being
+    # done: from when cataloging ended until the run (or its last job) ended
+    cur = db_con.cursor()
+    jobs = cur.execute('''
+        SELECT COUNT(*) AS jobs, SUM(leaves) AS leaves, SUM(in_bytes) AS in_bytes,
+            SUM(out_bytes) AS out_bytes, SUM(end_time - start_time) AS busy_s,
+            MAX(end_time) AS last_end
+        FROM job WHERE run_id = ?''', (run['rowid'],)).fetchone()
+    end = run['end_time'] or jobs['last_end'] or run['start_time']
+    took = end - run['start_time']
+    encoding = took - (run['walk_s'] or 0)
+    return {
+        'jobs': jobs['jobs'],
+        'leaves': jobs['leaves'] or 0,
+        'in_bytes': jobs['in_bytes'] or 0,
+        'out_bytes': jobs['out_bytes'] or 0,
+        'took': took,
+        'utilization': (jobs['busy_s'] or 0) / (run['max_jobs'] * encoding)
+            if encoding > 0 else 0.0,
+    }
+
+def stats(conf, interval_s: float, top: int):
+    # Print what the job and run tables say about how filler has been doing
+    db_con = sqlite3.connect(conf['db']['fname'])
+    db_con.row_factory = sqlite3.Row
+    create_tables(db_con)
+    cur = db_con.cursor()
+    runs = cur.execute('SELECT rowid, * FROM run ORDER BY rowid').fetchall()
+    if not len(runs):
+        print('No runs recorded')
+        return 0
+    print('Runs')
+    print('{:>4} {:19} {:>9} {:>7} {:>6} {:>8} {:>9} {:>9} {:>8} {:>6}'.format(
+        'run', 'started', 'took s', 'walk s', 'jobs', 'leaves', 'in MB', 'out MB', 'in MB/s', 'busy'))
+    for run in runs:
+        r = run_stats(db_con, run)
+        print('{:>4} {:19} {:>9.1f} {:>7.1f} {:>6} {:>8} {:>9.1f} {:>9.1f} {:>8.2f} {:>6.0%}{}'.format(
+            run['rowid'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['start_time'])),
+            r['took'], run['walk_s'] or 0, r['jobs'], r['leaves'], mb(r['in_bytes']),
+            mb(r['out_bytes']), mb(r['in_bytes']) / r['took'] if r['took'] > 0 else 0.0,
+            r['utilization'], '' if run['end_time'] else ' (unfinished)'))
+    # Throughput of the latest run that did anything, by when jobs ended
+    run = cur.execute('''
+        SELECT run.rowid, run.start_time FROM run JOIN job ON job.run_id = run.rowid
+        ORDER BY run.rowid DESC LIMIT 1''').fetchone()
+    if run is None:
+        print('No jobs recorded')
+        return 0
+    buckets = {}
+    for job in cur.execute('SELECT * FROM job WHERE run_id = ?', (run['rowid'],)):
+        i = int((job['end_time'] - run['start_time']) // interval_s)
+        jobs, in_bytes, out_bytes = buckets.get(i, (0, 0, 0))
+        buckets[i] = (jobs + 1, in_bytes + job['in_bytes'], out_bytes + job['out_bytes'])
+    print()
+    print(f'Throughput of run {run["rowid"]}, every {interval_s:g}s')
+    print('{:>9} {:>6} {:>9} {:>9}'.format('from s', 'jobs', 'in MB/s', 'out MB/s'))
+    for i in range(min(buckets), max(buckets) + 1):
+        jobs, in_bytes, out_bytes = buckets.get(i, (0, 0, 0))
+        print('{:>9g} {:>6} {:>9.2f} {:>9.2f}'.format(
+            i * interval_s, jobs, mb(in_bytes) / interval_s, mb(out_bytes) / interval_s))
+    # Where the workers' time goes, over every job
+    phases = cur.execute('''
+        SELECT SUM(tar_s) AS tar, SUM(encode_s) AS encode, SUM(mark_done_s) AS mark_done,
+            SUM(end_time - start_time) AS total
+        FROM job''').fetchone()
+    print()
+    print('Time in jobs: {}'.format(', '.join(
+        '{} {:.1f}s ({:.0%})'.format(name, phases[name], phases[name] / phases['total']
+                                     if phases['total'] else 0.0)
+        for name in ('tar', 'encode', 'mark_done'))))
+    print()
+    print('Compression by root')
+    print('{:>6} {:>8} {:>9} {:>9} {:>6} {:>8}  {}'.format(
+        'jobs', 'leaves', 'in MB', 'out MB', 'ratio', 'in MB/s', 'root'))
+    for row in cur.execute('''
+            SELECT root, COUNT(*) AS jobs, SUM(leaves) AS leaves, SUM(in_bytes) AS in_bytes,
+                SUM(out_bytes) AS out_bytes, SUM(end_time - start_time) AS busy_s
+            FROM job GROUP BY root ORDER BY root'''):
+        print('{:>6} {:>8} {:>9.1f} {:>9.1f} {:>6.2f} {:>8.2f}  {}'.format(
+            row['jobs'], row['leaves'], mb(row['in_bytes']), mb(row['out_bytes']),
+            row['out_bytes'] / row['in_bytes'] if row['in_bytes'] else 0.0,
+            # Per worker
+            mb(row['in_bytes']) / row['busy_s'] if row['busy_s'] else 0.0,
+            row['root']))
+    print()
+    print(f'Slowest {top} jobs')
+    print('{:>4} {:>8} {:>7} {:>8} {:>6} {:>9} {:>7}  {}'.format(
+        'run', 'took s', 'tar s', 'encode s', 'leaves', 'in MB', 'volumes', 'first leaf'))
+    for job in cur.execute('''
+            SELECT *, end_time - start_time AS took FROM job
+            ORDER BY took DESC LIMIT ?''', (top,)).fetchall():
+        root, subpath, _ = get_path(db_con, job['obj_id'])
+        root.append(subpath)
+        print('{:>4} {:>8.2f} {:>7.2f} {:>8.2f} {:>6} {:>9.1f} {:>7}  {}'.format(
+            job['run_id'], job['took'], job['tar_s'], job['encode_s'], job['leaves'],
+            mb(job['in_bytes']), job['volumes'], root))
+    return 0
+
+def gen_stats_parser():
+    p = argparse.ArgumentParser(
+        prog='filler.py stats', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Report how fast filler has been, from its catalog')
+    p.add_argument('conf', type=str, help='filler\'s configuration file')
+    p.add_argument('--interval-s', type=float, default=60,
+                   help='Report throughput over this much time at a time')
+    p.add_argument('--top', type=int, default=10,
+                   help='How many of the slowest jobs to list')
+    return p
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'stats':
+        p = gen_stats_parser()
+        args = p.parse_args(sys.argv[2:])
+        if not args.interval_s > 0:
+            p.error('--interval-s must be positive')
+        if args.top < 1:
+            p.error('--top must be at least 1')
+        c = configparser.ConfigParser()
+        c.read(args.conf)
+        exit(stats(c, args.interval_s, args.top))
     c = configparser.ConfigParser()
     c.read(sys.argv[1])
     exit(main(c))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+## Benchmark filler.py end to end on a synthetic directory tree.
+##
+## Generates a tree of the requested shape under a work directory, writes a
+## filler config for it, and runs filler on it in this process (workers are
+## forked from it as usual) with a local pngrecon. Reports how long cataloging
+## took versus encoding, files/s and bytes/s, how many SQLite statements
+## filler ran, and how busy its workers were. For example, many tiny leaf
+## directories:
+##
+##     python3 filler_bench.py --depth 3 --fanout 10 --files-per-dir 50
+##
+## or a few huge files:
+##
+##     python3 filler_bench.py --depth 0 --files-per-dir 0 \
+##         --huge-files 4 --huge-file-size 500000000
+##
+import argparse
+import configparser
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass, asdict
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import filler  # noqa: E402
+
+STYLES = ('bundle_leaf_dir', 'split_file')
+
+# Shared with the forked workers, so everything they do is counted too
+QUERY_COUNTS = {
+    kind: multiprocessing.Value('L', 0)
+    for kind in ('SELECT', 'INSERT', 'UPDATE', 'other')}
+WORKER_BUSY_S = multiprocessing.Value('d', 0.0)
+JOBS = multiprocessing.Value('L', 0)
+orig_connect = sqlite3.connect
+orig_encode_and_mark_done = filler.encode_and_mark_done
+
+
+@dataclass
+class TreeStats:
+    dirs: int = 0
+    leaf_dirs: int = 0
+    files: int = 0
+    bytes: int = 0
+
+
+def count_query(statement):
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() \
+        else 'other'
+    counter = QUERY_COUNTS.get(kind, QUERY_COUNTS['other'])
+    with counter.get_lock():
+        counter.value += 1
+
+
+def counting_connect(*a, **kw):
+    conn = orig_connect(*a, **kw)
+    conn.set_trace_callback(count_query)
+    return conn
+
+
+def timed_encode_and_mark_done(*a, **kw):
+    # Module level, so it can be handed to the ProcessPoolExecutor
+    start = time.monotonic()
+    try:
+        return orig_encode_and_mark_done(*a, **kw)
+    finally:
+        with WORKER_BUSY_S.get_lock():
+            WORKER_BUSY_S.value += time.monotonic() - start
+        with JOBS.get_lock():
+            JOBS.value += 1
+
+
+def write_file(fname, size, rand):
+    # Half random, half zeros, so that compression has something to do but
+    # doesn't make it all go away
+    with open(fname, 'wb') as fd:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 1024 * 1024)
+            half = n // 2
+            fd.write(rand.randbytes(half) + bytes(n - half))
+            remaining -= n
+
+
+def make_tree(d, args, rand, depth=0, stats=None):
+    ''' Make a tree of args.fanout directories per directory, args.depth deep,
+    with args.files-per-dir files in each leaf directory '''
+    if stats is None:
+        stats = TreeStats()
+    os.makedirs(d, exist_ok=True)
+    stats.dirs += 1
+    if depth < args.depth:
+        for i in range(args.fanout):
+            make_tree(os.path.join(d, 'd{}'.format(i)), args, rand, depth + 1,
+                      stats)
+        return stats
+    stats.leaf_dirs += 1
+    for i in range(args.files_per_dir):
+        size = max(0, int(rand.expovariate(1 / args.file_size))) \
+            if args.file_size else 0
+        write_file(os.path.join(d, 'f{}'.format(i)), size, rand)
+        stats.files += 1
+        stats.bytes += size
+    return stats
+
+
+def make_huge_files(d, args, rand, stats):
+    ''' A few huge files, each in a leaf directory of its own '''
+    for i in range(args.huge_files):
+        sub = os.path.join(d, 'huge{}'.format(i))
+        os.makedirs(sub, exist_ok=True)
+        write_file(os.path.join(sub, 'f'), args.huge_file_size, rand)
+        stats.dirs += 1
+        stats.leaf_dirs += 1
+        stats.files += 1
+        stats.bytes += args.huge_file_size
+
+
+def make_conf(work, tree, style, args):
+    conf = configparser.ConfigParser()
+    conf['db'] = {'fname': os.path.join(work, 'filler-{}.db'.format(style))}
+    conf['pngrecon'] = {
+        'path': args.pngrecon,
+        'keyfile': os.path.join(work, 'filler.key'),
+    }
+    if args.server:
+        conf['pngrecon']['server'] = args.server
+    conf['general'] = {'max_jobs': str(args.jobs)}
+    conf['roots'] = {'bench': tree}
+    conf['bench_options'] = {
+        'output': os.path.join(work, 'outputs-{}'.format(style)),
+        # Never wait for the output to be cleared out
+        'outdir_size_limit_mb': str(1024 * 1024 * 1024),
+        'split_file_size_limit_mb': str(args.split_file_size_limit_mb),
+        'style': style,
+    }
+    if args.pack_size_limit_mb is not None:
+        conf['bench_options']['pack_size_limit_mb'] = str(
+            args.pack_size_limit_mb)
+    return conf
+
+
+def reset_counters():
+    for counter in list(QUERY_COUNTS.values()) + [WORKER_BUSY_S, JOBS]:
+        with counter.get_lock():
+            counter.value = 0
+
+
+def timed(phases, name, func):
+    def wrapper(*a, **kw):
+        start = time.monotonic()
+        try:
+            return func(*a, **kw)
+        finally:
+            phases[name] = phases.get(name, 0) + time.monotonic() - start
+    return wrapper
+
+
+def run_filler(conf, args):
+    ''' Run filler with the given config, returning how long each part took
+    and what it did '''
+    reset_counters()
+    phases = {}
+    orig_log = filler.log
+    orig = {name: getattr(filler, name) for name in (
+        'insert_roots', 'walk_roots', 'insert_work')}
+    for name, func in orig.items():
+        setattr(filler, name, timed(phases, name, func))
+    filler.sqlite3.connect = counting_connect
+    filler.encode_and_mark_done = timed_encode_and_mark_done
+    if not args.verbose:
+        filler.log = lambda *a, **kw: None
+    start = time.monotonic()
+    try:
+        ret = filler.main(conf)
+    finally:
+        for name, func in orig.items():
+            setattr(filler, name, func)
+        filler.sqlite3.connect = orig_connect
+        filler.encode_and_mark_done = orig_encode_and_mark_done
+        filler.log = orig_log
+    total = time.monotonic() - start
+    catalog = sum(phases.values())
+    encode = total - catalog
+    return {
+        'ok': ret == 0,
+        'total_s': total,
+        'catalog_s': catalog,
+        'catalog_phases_s': phases,
+        'encode_s': encode,
+        'queries': {k: v.value for k, v in QUERY_COUNTS.items()},
+        'jobs': JOBS.value,
+        'worker_busy_s': WORKER_BUSY_S.value,
+        # How much of the time the workers could have been encoding they
+        # actually were
+        'worker_utilization': WORKER_BUSY_S.value / (encode * args.jobs)
+        if encode > 0 else 0.0,
+    }
+
+
+def log(*a, **kw):
+    print(*a, file=sys.stderr, **kw)
+
+
+def log_result(style, stats, r):
+    log('{}: {} in {:.2f}s'.format(
+        style, 'ok' if r['ok'] else 'FAILED', r['total_s']))
+    log('    {:.1f} files/s, {:.2f} MB/s'.format(
+        stats.files / r['total_s'], stats.bytes / r['total_s'] / 1e6))
+    log('    catalog {:.2f}s ({}), encode {:.2f}s'.format(
+        r['catalog_s'], ', '.join('{} {:.2f}s'.format(k, v) for k, v in
+                                  r['catalog_phases_s'].items()),
+        r['encode_s']))
+    log('    {} SQLite statements ({})'.format(
+        sum(r['queries'].values()), ', '.join(
+            '{} {}'.format(k, v) for k, v in r['queries'].items())))
+    log('    {} jobs, workers busy {:.2f}s, {:.0%} utilized'.format(
+        r['jobs'], r['worker_busy_s'], r['worker_utilization']))
+
+
+def gen_parser():
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--work-dir', type=str, default=None,
+                   help='Where to put the tree and everything filler makes. '
+                   'A temporary directory, removed afterwards, if not given.')
+    p.add_argument('--depth', type=int, default=2,
+                   help='How many levels of directories above the leaves')
+    p.add_argument('--fanout', type=int, default=4,
+                   help='Subdirectories in each non-leaf directory')
+    p.add_argument('--files-per-dir', type=int, default=10,
+                   help='Files in each leaf directory')
+    p.add_argument('--file-size', type=int, default=4096,
+                   help='Average file size. Sizes are exponentially '
+                   'distributed, so most files are smaller.')
+    p.add_argument('--huge-files', type=int, default=0,
+                   help='Also make this many huge files, each in its own '
+                   'leaf directory')
+    p.add_argument('--huge-file-size', type=int, default=100 * 1000 * 1000)
+    p.add_argument('--split-file-size-limit-mb', type=float, default=1024)
+    p.add_argument('--pack-size-limit-mb', type=float, default=None,
+                   help='How much filler packs into one job. filler\'s '
+                   'default if not given, and 0 for a job per leaf.')
+    p.add_argument('--style', type=str, default='both',
+                   choices=STYLES + ('both',))
+    p.add_argument('-j', '--jobs', type=int, default=4,
+                   help='filler\'s max_jobs')
+    p.add_argument('--pngrecon', type=str, default=shutil.which('pngrecon'),
+                   help='The pngrecon command filler runs')
+    p.add_argument('--server', type=str, default=None,
+                   help='Have filler use this `pngrecon serve` instead. '
+                   'Its --root must hold --work-dir, where the key is.')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--json', action='store_true',
+                   help='Print the results as JSON to stdout')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='Let filler log what it\'s doing')
+    return p
+
+
+def main(args):
+    if not args.pngrecon and not args.server:
+        log('Can\'t find pngrecon. Give --pngrecon.')
+        return 1
+    work = args.work_dir or mkdtemp(prefix='filler-bench-')
+    os.makedirs(work, exist_ok=True)
+    try:
+        with open(os.path.join(work, 'filler.key'), 'wb') as fd:
+            fd.write(os.urandom(32))
+        tree = os.path.join(work, 'tree')
+        rand = random.Random(args.seed)
+        start = time.monotonic()
+        stats = make_tree(tree, args, rand)
+        make_huge_files(tree, args, rand, stats)
+        log('Made {} dirs ({} leaves) with {} files, {} bytes in '
+            '{:.2f}s'.format(stats.dirs, stats.leaf_dirs, stats.files,
+                             stats.bytes, time.monotonic() - start))
+        styles = STYLES if args.style == 'both' else (args.style,)
+        results = {'tree': asdict(stats), 'styles': {}}
+        for style in styles:
+            conf = make_conf(work, tree, style, args)
+            # Start from scratch, or filler would find nothing left to do
+            if os.path.exists(conf['db']['fname']):
+                os.unlink(conf['db']['fname'])
+            shutil.rmtree(conf['bench_options']['output'], ignore_errors=True)
+            r = run_filler(conf, args)
+            log_result(style, stats, r)
+            results['styles'][style] = r
+        if args.json:
+            print(json.dumps(results))
+        return 0 if all(r['ok'] for r in results['styles'].values()) else 1
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    exit(main(gen_parser().parse_args()))
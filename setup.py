@@ -54,4 +54,14 @@ setup(
     install_requires=[
         'cryptography',
     ],
+    extras_require={
+        # for hiding data in pixels with `encode --embed lsb`
+        'lsb': ['numpy'],
+        # for parity chunks with `encode --parity`
+        'parity': ['numpy'],
+        # for content-defined blocks with `encode --pool`
+        'dedup': ['numpy'],
+        # for training preset dictionaries with `train-dict`
+        'zdict': ['numpy'],
+    },
 )
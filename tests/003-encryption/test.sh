@@ -16,3 +16,56 @@ s5=$(sha1sum $OUTDIR/o5 | cut -d ' ' -f 1)
 [[ "$s" = "$s3" ]]
 [[ "$s" = "$s4" ]]
 [[ "$s" = "$s5" ]]
+
+# A wrong key is turned away by the crypt info chunk's key check value,
+# whether the image is read from a file or a pipe
+printf 'not it' > $OUTDIR/wrong1.txt
+printf 'not it either' > $OUTDIR/wrong2.txt
+pngrecon encode -e --key-file key.txt --key-check --parity 4:1 -i input.txt \
+    -o $OUTDIR/img.png
+pngrecon info --format jsonl $OUTDIR/img.png | grep '"key_check": true' \
+    > /dev/null
+for stream in '' --stream; do
+    ! pngrecon decode $stream --key-file $OUTDIR/wrong1.txt \
+        -i $OUTDIR/img.png -o $OUTDIR/wrong 2> $OUTDIR/err
+    grep 'Passphrase appears to be incorrect' $OUTDIR/err > /dev/null
+done
+! pngrecon decode --key-file $OUTDIR/wrong1.txt -o $OUTDIR/wrong \
+    < $OUTDIR/img.png 2> $OUTDIR/err
+grep 'Passphrase appears to be incorrect' $OUTDIR/err > /dev/null
+
+# With several key files, the right one is found and used
+for stream in '' --stream; do
+    pngrecon decode $stream --key-file $OUTDIR/wrong1.txt --key-file key.txt \
+        --key-file $OUTDIR/wrong2.txt -i $OUTDIR/img.png -o $OUTDIR/o6 \
+        2> $OUTDIR/err
+    cmp input.txt $OUTDIR/o6
+    grep 'Using the key in key.txt' $OUTDIR/err > /dev/null
+done
+! pngrecon decode --key-file $OUTDIR/wrong1.txt --key-file $OUTDIR/wrong2.txt \
+    -i $OUTDIR/img.png -o $OUTDIR/wrong 2> $OUTDIR/err
+grep 'None of the 2 key files' $OUTDIR/err > /dev/null
+
+# Without --key-check, the crypt info chunk is the 16 bytes older versions
+# read. Those images still decode, and several key files are tried by
+# decrypting with them instead.
+pngrecon encode -e --key-file key.txt --parity 4:1 -i input.txt \
+    -o $OUTDIR/old.png
+pngrecon info --format jsonl $OUTDIR/old.png > $OUTDIR/info
+python3 - $OUTDIR/info <<'PYEOF'
+import json
+import sys
+record = json.load(open(sys.argv[1]))
+crypt_info, = [c for c in record['chunks'] if c['type'] == 'yyBo']
+assert crypt_info['length'] == 16 and not crypt_info['key_check']
+PYEOF
+! pngrecon encode --key-check -i input.txt -o $OUTDIR/wrong 2> $OUTDIR/err
+grep 'Don.t specify --key-check' $OUTDIR/err > /dev/null
+pngrecon decode --key-file key.txt -i $OUTDIR/old.png -o $OUTDIR/o7
+cmp input.txt $OUTDIR/o7
+! pngrecon decode --key-file $OUTDIR/wrong1.txt -i $OUTDIR/old.png \
+    -o $OUTDIR/wrong 2> $OUTDIR/err
+grep 'Passphrase appears to be incorrect' $OUTDIR/err > /dev/null
+pngrecon decode --key-file $OUTDIR/wrong2.txt --key-file key.txt \
+    -i $OUTDIR/old.png -o $OUTDIR/o8 2> /dev/null
+cmp input.txt $OUTDIR/o8
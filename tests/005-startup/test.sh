@@ -0,0 +1,33 @@
+set -eu
+OUTDIR="$1"
+# CPU time budget, in milliseconds, for importing pngrecon and running a trivial
+# command in an already-started interpreter. CPU time rather than wall time,
+# because the runner runs tests in parallel.
+BUDGET_MS="${PNGRECON_STARTUP_BUDGET_MS:-250}"
+
+pngrecon encode -i input.txt -o $OUTDIR/plain.png
+
+# Running a command that doesn't need encryption must not import the crypto
+# library, and the whole thing must fit within the time budget.
+for CMD in "info $OUTDIR/plain.png" \
+        "encode -i input.txt -o $OUTDIR/o.png" \
+        "encode -c gzip -i input.txt -o $OUTDIR/o.png" \
+        "decode -i $OUTDIR/plain.png -o $OUTDIR/o.txt"; do
+    python3 - $BUDGET_MS $CMD <<'PYEOF' >/dev/null
+import sys
+import time
+budget_ms = int(sys.argv[1])
+sys.argv = ['pngrecon'] + sys.argv[2:]
+start = time.process_time()
+from pngrecon.__main__ import main
+try:
+    main()
+except SystemExit as e:
+    assert not e.code, e.code
+elapsed_ms = (time.process_time() - start) * 1000
+assert 'cryptography' not in sys.modules, \
+    'cryptography imported by {}'.format(sys.argv)
+assert elapsed_ms < budget_ms, '{} took {:.1f} ms, budget is {} ms'.format(
+    sys.argv, elapsed_ms, budget_ms)
+PYEOF
+done
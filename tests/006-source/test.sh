@@ -0,0 +1,46 @@
+set -eu
+OUTDIR="$1"
+
+# A carrier with several IDAT chunks and an ancillary chunk in the middle
+python3 - $OUTDIR/carrier.png <<'PYEOF'
+import struct
+import sys
+import zlib
+
+
+def chunk(t, d):
+    return struct.pack('>I', len(d)) + t + d + \
+        struct.pack('>I', zlib.crc32(t + d))
+
+
+w, h = 64, 64
+rows = b''.join(b'\x00' + bytes(
+    v for x in range(w) for v in (x * 4, y * 4, (x * y) % 256))
+    for y in range(h))
+idat = zlib.compress(rows)
+third = len(idat) // 3
+with open(sys.argv[1], 'wb') as fd:
+    fd.write(b'\x89PNG\r\n\x1a\n')
+    fd.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)))
+    fd.write(chunk(b'IDAT', idat[:third]))
+    fd.write(chunk(b'tEXt', b'Comment\x00a carrier'))
+    fd.write(chunk(b'IDAT', idat[third:2 * third]))
+    fd.write(chunk(b'IDAT', idat[2 * third:]))
+    fd.write(chunk(b'IEND', b''))
+PYEOF
+
+s=$(sha1sum input.txt | cut -d ' ' -f 1)
+head_len=$(( $(stat -c %s $OUTDIR/carrier.png) - 12 ))
+for ARGS in "" "-c gzip" "--buffer-max-bytes 100"; do
+    # to a file, and to a pipe
+    pngrecon encode $ARGS -s $OUTDIR/carrier.png -i input.txt -o $OUTDIR/o.png
+    pngrecon encode $ARGS -s $OUTDIR/carrier.png -i input.txt | cat > $OUTDIR/o2.png
+    cmp $OUTDIR/o.png $OUTDIR/o2.png
+    # Everything before the carrier's IEND is copied verbatim, and the image
+    # still ends with IEND
+    cmp -n $head_len $OUTDIR/carrier.png $OUTDIR/o.png
+    [[ "$(tail -c 12 $OUTDIR/o.png | od -An -tx1 | tr -d ' \n')" = \
+        "0000000049454e44ae426082" ]]
+    pngrecon decode -i $OUTDIR/o.png -o $OUTDIR/output.txt
+    [[ "$s" = "$(sha1sum $OUTDIR/output.txt | cut -d ' ' -f 1)" ]]
+done
@@ -0,0 +1,29 @@
+set -eu
+OUTDIR="$1"
+
+# Big enough, with small enough buffers, to need many data chunks
+head -c 300000 /dev/urandom | base64 > $OUTDIR/input
+s=$(sha1sum $OUTDIR/input | cut -d ' ' -f 1)
+for ARGS in "" "-c gzip" "-c xz" "-e --key-file key.txt -c gzip"; do
+    DEC_ARGS=""
+    [[ "$ARGS" == -e* ]] && DEC_ARGS="--key-file key.txt"
+    pngrecon encode --pipeline --buffer-max-bytes 10000 $ARGS \
+        -i $OUTDIR/input -o $OUTDIR/p.png
+    pngrecon encode --buffer-max-bytes 10000 $ARGS \
+        -i $OUTDIR/input -o $OUTDIR/np.png
+    # Same chunks either way (the salt differs when encrypting)
+    if [[ -z "$DEC_ARGS" ]]; then
+        cmp $OUTDIR/p.png $OUTDIR/np.png
+    fi
+    pngrecon decode --pipeline $DEC_ARGS -i $OUTDIR/p.png -o $OUTDIR/o1
+    pngrecon decode $DEC_ARGS -i $OUTDIR/p.png -o $OUTDIR/o2
+    [[ "$s" = "$(sha1sum $OUTDIR/o1 | cut -d ' ' -f 1)" ]]
+    [[ "$s" = "$(sha1sum $OUTDIR/o2 | cut -d ' ' -f 1)" ]]
+done
+
+# Errors in a pipeline stage still fail the command
+pngrecon encode --pipeline -e --key-file key.txt -i $OUTDIR/input \
+    -o $OUTDIR/p.png
+echo -n wrong > $OUTDIR/wrong.txt
+! pngrecon decode --pipeline --key-file $OUTDIR/wrong.txt -i $OUTDIR/p.png \
+    -o $OUTDIR/o1 2>/dev/null
@@ -0,0 +1,27 @@
+set -eu
+OUTDIR="$1"
+
+seq 1 5000 > $OUTDIR/a
+seq 5001 9000 > $OUTDIR/b
+seq 9001 9500 > $OUTDIR/c
+cat $OUTDIR/a $OUTDIR/b $OUTDIR/c > $OUTDIR/all
+s=$(sha1sum $OUTDIR/all | cut -d ' ' -f 1)
+for ARGS in "" "-c gzip" "-c xz" "-e --key-file key.txt -c gzip"; do
+    KEY_ARGS=""
+    [[ "$ARGS" == -e* ]] && KEY_ARGS="--key-file key.txt"
+    pngrecon encode $ARGS --buffer-max-bytes 3000 -i $OUTDIR/a -o $OUTDIR/o.png
+    pngrecon append $KEY_ARGS --buffer-max-bytes 3000 -i $OUTDIR/b $OUTDIR/o.png
+    pngrecon append $KEY_ARGS -i $OUTDIR/c $OUTDIR/o.png
+    pngrecon info $OUTDIR/o.png > $OUTDIR/info
+    grep --quiet "Generation 2" $OUTDIR/info
+    (( $(grep --count 'ChunkType.Index' $OUTDIR/info) == 3 ))
+    pngrecon decode $KEY_ARGS -i $OUTDIR/o.png -o $OUTDIR/out
+    [[ "$s" = "$(sha1sum $OUTDIR/out | cut -d ' ' -f 1)" ]]
+done
+
+# The wrong key is refused before anything is written
+echo -n wrong > $OUTDIR/wrong.txt
+cp $OUTDIR/o.png $OUTDIR/before.png
+! pngrecon append --key-file $OUTDIR/wrong.txt -i $OUTDIR/c $OUTDIR/o.png \
+    2>/dev/null
+cmp $OUTDIR/o.png $OUTDIR/before.png
@@ -0,0 +1,65 @@
+set -eu
+OUTDIR="$1"
+
+seq 1 20000 > $OUTDIR/input
+pngrecon encode --manifest -c gzip -e --key-file key.txt \
+    --buffer-max-bytes 5000 -i $OUTDIR/input -o $OUTDIR/m.png
+pngrecon encode --buffer-max-bytes 5000 -i $OUTDIR/input -o $OUTDIR/nm.png
+pngrecon info $OUTDIR/m.png | grep --quiet 'ChunkType.Manifest'
+
+# Intact images pass, with or without a manifest, and without a key
+pngrecon verify -j 4 $OUTDIR/m.png $OUTDIR/nm.png > $OUTDIR/o
+grep --quiet "m.png OK (.* chunks, [1-9][0-9]* digests)" $OUTDIR/o
+grep --quiet "nm.png OK (.* chunks, 0 digests)" $OUTDIR/o
+
+# Appending keeps the manifest going
+seq 1 100 | pngrecon append --key-file key.txt $OUTDIR/m.png
+pngrecon verify $OUTDIR/m.png > /dev/null
+(( $(pngrecon info $OUTDIR/m.png | grep --count 'ChunkType.Manifest') == 2 ))
+
+# Flip one byte in the middle of the image. The crc catches it, and the bad
+# image doesn't stop the good one from being verified.
+cp $OUTDIR/m.png $OUTDIR/bad.png
+size=$(stat -c %s $OUTDIR/bad.png)
+printf '\xff' | dd of=$OUTDIR/bad.png bs=1 seek=$(( size / 2 )) \
+    conv=notrunc 2>/dev/null
+! pngrecon verify $OUTDIR/bad.png $OUTDIR/nm.png > $OUTDIR/o
+grep --quiet "bad.png FAILED" $OUTDIR/o
+grep --quiet "Bad crc" $OUTDIR/o
+grep --quiet "nm.png OK" $OUTDIR/o
+
+# A chunk that was rewritten with a correct crc but different data is only
+# caught by the manifest
+python3 - $OUTDIR/m.png $OUTDIR/forged.png <<'PYEOF'
+import struct
+import sys
+import zlib
+b = bytearray(open(sys.argv[1], 'rb').read())
+i = b.index(b'maTt')
+length, = struct.unpack_from('>I', b, i - 4)
+b[i + 10] ^= 0xff
+struct.pack_into('>I', b, i + 4 + length, zlib.crc32(b[i:i + 4 + length]))
+open(sys.argv[2], 'wb').write(b)
+PYEOF
+! pngrecon verify $OUTDIR/forged.png > $OUTDIR/o
+grep --quiet "Digest mismatch" $OUTDIR/o
+! grep --quiet "Bad crc" $OUTDIR/o
+
+# An index chunk with a field that can't be parsed (but a good crc) is
+# reported as a problem with its image, and the other images are still
+# verified
+python3 - $OUTDIR/nm.png $OUTDIR/badindex.png <<'PYEOF'
+import struct
+import sys
+import zlib
+b = bytearray(open(sys.argv[1], 'rb').read())
+i = b.index(b'deQm')
+length, = struct.unpack_from('>I', b, i - 4)
+b[i + 7] = 99
+struct.pack_into('>I', b, i + 4 + length, zlib.crc32(b[i:i + 4 + length]))
+open(sys.argv[2], 'wb').write(b)
+PYEOF
+! pngrecon verify $OUTDIR/badindex.png $OUTDIR/nm.png > $OUTDIR/o 2>&1
+grep --quiet "badindex.png FAILED" $OUTDIR/o
+grep --quiet "Can't parse ChunkType.Index" $OUTDIR/o
+grep --quiet "nm.png OK" $OUTDIR/o
@@ -0,0 +1,93 @@
+set -eu
+OUTDIR="$1"
+
+seq 1 30000 > $OUTDIR/input
+s=$(sha1sum $OUTDIR/input | cut -d ' ' -f 1)
+for ARGS in "" "-c gzip" "-c xz" "-e --key-file key.txt -c gzip"; do
+    KEY_ARGS=""
+    [[ "$ARGS" == -e* ]] && KEY_ARGS="--key-file key.txt"
+    for ORDER in "" "--index-first"; do
+        pngrecon encode $ARGS $ORDER --buffer-max-bytes 5000 \
+            -i $OUTDIR/input -o $OUTDIR/o.png
+        # From a pipe, from a file with --stream, and the old way
+        cat $OUTDIR/o.png | pngrecon decode $KEY_ARGS > $OUTDIR/o1
+        pngrecon decode --stream --pipeline $KEY_ARGS -i $OUTDIR/o.png \
+            -o $OUTDIR/o2
+        pngrecon decode $KEY_ARGS -i $OUTDIR/o.png -o $OUTDIR/o3
+        for O in o1 o2 o3; do
+            [[ "$s" = "$(sha1sum $OUTDIR/$O | cut -d ' ' -f 1)" ]]
+        done
+    done
+done
+
+# With the index first, nothing needs to be spilled
+pngrecon encode --index-first --buffer-max-bytes 5000 -i $OUTDIR/input \
+    -o $OUTDIR/o.png
+cat $OUTDIR/o.png | pngrecon decode --spill-max-bytes 0 > $OUTDIR/o1
+[[ "$s" = "$(sha1sum $OUTDIR/o1 | cut -d ' ' -f 1)" ]]
+# Without it, everything is, and the limit is enforced
+pngrecon encode --buffer-max-bytes 5000 -i $OUTDIR/input -o $OUTDIR/o.png
+! cat $OUTDIR/o.png | pngrecon decode --spill-max-bytes 100000 \
+    > $OUTDIR/o1 2>/dev/null
+
+# Data chunks in any order, with gaps between their indexes, still come out
+# in index order
+python3 - $OUTDIR/o.png $OUTDIR/shuffled.png <<'PYEOF'
+import random
+import struct
+import sys
+import zlib
+b = open(sys.argv[1], 'rb').read()
+chunks = []
+i = 8
+while i < len(b):
+    length, = struct.unpack_from('>I', b, i)
+    chunks.append(b[i:i + 12 + length])
+    i += 12 + length
+ours = chunks[2:-1]
+data = [c for c in ours if c[4:8] == b'maTt']
+rest = [c for c in ours if c[4:8] != b'maTt']
+renumbered = []
+for c in data:
+    index, = struct.unpack_from('>I', c, 8)
+    payload = c[4:8] + struct.pack('>I', index * 7 + 3) + c[12:-4]
+    renumbered.append(c[:4] + payload + struct.pack('>I', zlib.crc32(payload)))
+ours = renumbered + rest
+random.shuffle(ours)
+with open(sys.argv[2], 'wb') as fd:
+    fd.write(b[:8] + b''.join(chunks[:2] + ours + chunks[-1:]))
+PYEOF
+cat $OUTDIR/shuffled.png | pngrecon decode > $OUTDIR/o1
+pngrecon decode -i $OUTDIR/shuffled.png -o $OUTDIR/o2
+[[ "$s" = "$(sha1sum $OUTDIR/o1 | cut -d ' ' -f 1)" ]]
+[[ "$s" = "$(sha1sum $OUTDIR/o2 | cut -d ' ' -f 1)" ]]
+
+# The spill limit is on what is waiting at once, not on everything that was
+# ever spilled: with each pair of data chunks swapped, only one chunk waits
+# at a time, so a limit of two chunks is plenty
+pngrecon encode --index-first --buffer-max-bytes 5000 -i $OUTDIR/input \
+    -o $OUTDIR/o.png
+max_len=$(python3 - $OUTDIR/o.png $OUTDIR/swapped.png <<'PYEOF'
+import struct
+import sys
+b = open(sys.argv[1], 'rb').read()
+chunks = []
+i = 8
+while i < len(b):
+    length, = struct.unpack_from('>I', b, i)
+    chunks.append(b[i:i + 12 + length])
+    i += 12 + length
+data = [c for c in chunks if c[4:8] == b'maTt']
+assert len(data) > 10
+first = chunks.index(data[0])
+for j in range(0, len(data) - 1, 2):
+    data[j], data[j + 1] = data[j + 1], data[j]
+chunks[first:first + len(data)] = data
+with open(sys.argv[2], 'wb') as fd:
+    fd.write(b[:8] + b''.join(chunks))
+print(max(len(c) - 12 for c in data))
+PYEOF
+)
+cat $OUTDIR/swapped.png | pngrecon decode --spill-max-bytes $((2 * max_len)) \
+    > $OUTDIR/o1
+[[ "$s" = "$(sha1sum $OUTDIR/o1 | cut -d ' ' -f 1)" ]]
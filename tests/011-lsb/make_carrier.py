@@ -0,0 +1,55 @@
+# Write a PNG with noisy pixels and every scanline filter type, for hiding
+# data in. Usage: make_carrier.py OUT WIDTH HEIGHT BIT_DEPTH COLOR_TYPE
+import random
+import struct
+import sys
+import zlib
+
+CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+def chunk(t, d):
+    return struct.pack('>I', len(d)) + t + d + \
+        struct.pack('>I', zlib.crc32(t + d))
+
+
+def paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def filter_row(ft, row, prev, bpp):
+    out = bytearray()
+    for i, x in enumerate(row):
+        a = row[i - bpp] if i >= bpp else 0
+        b = prev[i]
+        c = prev[i - bpp] if i >= bpp else 0
+        pred = [0, a, b, (a + b) // 2, paeth(a, b, c)][ft]
+        out.append((x - pred) % 256)
+    return bytes(out)
+
+
+out, width, height, bit_depth, color_type = sys.argv[1], *map(
+    int, sys.argv[2:])
+random.seed(width * height)
+bpp = CHANNELS[color_type] * bit_depth // 8
+stride = width * bpp
+prev = bytes(stride)
+raw = b''
+for y in range(height):
+    row = bytes(random.randrange(256) for _ in range(stride))
+    ft = y % 5
+    raw += bytes([ft]) + filter_row(ft, row, prev, bpp)
+    prev = row
+idat = zlib.compress(raw)
+with open(out, 'wb') as fd:
+    fd.write(b'\x89PNG\r\n\x1a\n')
+    fd.write(chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0)))
+    fd.write(chunk(b'tEXt', b'Comment\x00carrier'))
+    fd.write(chunk(b'IDAT', idat[:len(idat) // 2]))
+    fd.write(chunk(b'IDAT', idat[len(idat) // 2:]))
+    fd.write(chunk(b'IEND', b''))
@@ -0,0 +1,43 @@
+set -eu
+OUTDIR="$1"
+python3 -c 'import numpy' 2>/dev/null || { echo "NumPy not installed, skipping"; exit 0; }
+
+seq 1 300 > $OUTDIR/input
+s=$(sha1sum $OUTDIR/input | cut -d ' ' -f 1)
+for SHAPE in "8 2" "8 6" "16 0" "8 4"; do
+    python3 make_carrier.py $OUTDIR/carrier.png 151 97 $SHAPE
+    for ARGS in "" "-c xz" "-e --key-file key.txt"; do
+        KEY_ARGS=""
+        [[ "$ARGS" == -e* ]] && KEY_ARGS="--key-file key.txt"
+        pngrecon encode --embed lsb $ARGS -s $OUTDIR/carrier.png \
+            -i $OUTDIR/input -o $OUTDIR/o.png 2>/dev/null
+        # None of our chunks are left for anything to notice
+        ! grep --quiet -e deQm -e maTt -e yyBo $OUTDIR/o.png
+        cat $OUTDIR/o.png | pngrecon decode --embed lsb $KEY_ARGS \
+            > $OUTDIR/output
+        [[ "$s" = "$(sha1sum $OUTDIR/output | cut -d ' ' -f 1)" ]]
+    done
+    # Only the least significant bits changed
+    python3 - $OUTDIR/carrier.png $OUTDIR/o.png <<'PYEOF'
+import sys
+from pngrecon.lib.chunk import read_image_stream
+from pngrecon.lib.lsb import read_pixel_image
+a, b = [read_pixel_image(read_image_stream(open(f, 'rb')))
+        for f in sys.argv[1:]]
+assert a.pixels.shape == b.pixels.shape
+diff = a.pixels ^ b.pixels
+assert diff.max() == 1
+if a.bit_depth == 16:
+    assert diff.reshape(-1)[0::2].max() == 0
+PYEOF
+done
+
+# Capacity is checked up front
+head -c 100000 /dev/zero > $OUTDIR/big
+! pngrecon encode --embed lsb -s $OUTDIR/carrier.png -i $OUTDIR/big \
+    -o $OUTDIR/o.png 2> $OUTDIR/err
+grep --quiet "can hold" $OUTDIR/err
+grep --quiet "won't fit" $OUTDIR/err
+# but compressed, it fits
+pngrecon encode --embed lsb -c xz -s $OUTDIR/carrier.png -i $OUTDIR/big \
+    -o $OUTDIR/o.png 2>/dev/null
@@ -0,0 +1,60 @@
+set -eu
+OUTDIR="$1"
+
+seq 1 5000 > $OUTDIR/input
+pngrecon encode --buffer-max-bytes 2000 -i $OUTDIR/input -o $OUTDIR/a.png
+pngrecon encode -c gzip -i $OUTDIR/input -o $OUTDIR/b.png
+echo "not a png" > $OUTDIR/notpng.txt
+
+# One record per image, in the order given, even with several workers. A bad
+# image doesn't stop the others from being inspected, but is reported in the
+# exit code.
+! pngrecon info -j 2 --format jsonl $OUTDIR/a.png $OUTDIR/notpng.txt \
+    $OUTDIR/b.png $OUTDIR/missing.png > $OUTDIR/o
+python3 - $OUTDIR/o <<'PYEOF'
+import json
+import sys
+records = [json.loads(line) for line in open(sys.argv[1])]
+names = [r['image'].rsplit('/', 1)[-1] for r in records]
+assert names == ['a.png', 'notpng.txt', 'b.png', 'missing.png'], names
+a, notpng, b, missing = records
+assert not a['errors'] and not b['errors']
+assert a['pngrecon']['num_data_chunks'] > 1
+assert a['pngrecon']['data_bytes'] == sum(
+    c['data_bytes'] for c in a['chunks'] if c['type'] == 'maTt')
+assert b['pngrecon']['compression'] == 'Zlib'
+assert all(c['valid'] for c in a['chunks'] + b['chunks'])
+assert notpng['errors'] and missing['errors']
+assert not notpng['chunks'] and notpng['pngrecon'] is None
+PYEOF
+
+# Text output is unchanged for good images
+pngrecon info $OUTDIR/a.png > $OUTDIR/o
+grep --quiet "a.png contains .* chunks" $OUTDIR/o
+grep --quiet "Claiming [0-9]* data chunks" $OUTDIR/o
+! grep --quiet "Problem:" $OUTDIR/o
+
+# An index chunk that can't be parsed (with a good crc) is a problem with
+# that image alone, in either format
+python3 - $OUTDIR/a.png $OUTDIR/badindex.png <<'PYEOF'
+import struct
+import sys
+import zlib
+b = bytearray(open(sys.argv[1], 'rb').read())
+i = b.index(b'deQm')
+length, = struct.unpack_from('>I', b, i - 4)
+b[i + 7] = 99
+struct.pack_into('>I', b, i + 4 + length, zlib.crc32(b[i:i + 4 + length]))
+open(sys.argv[2], 'wb').write(b)
+PYEOF
+! pngrecon info --format jsonl $OUTDIR/badindex.png $OUTDIR/b.png > $OUTDIR/o
+python3 - $OUTDIR/o <<'PYEOF'
+import json
+import sys
+bad, b = [json.loads(line) for line in open(sys.argv[1])]
+assert any('parse' in e for e in bad['errors']), bad['errors']
+assert not b['errors'] and b['pngrecon']['compression'] == 'Zlib'
+PYEOF
+! pngrecon info $OUTDIR/badindex.png $OUTDIR/b.png > $OUTDIR/o
+grep --quiet "Problem: .*parse" $OUTDIR/o
+grep --quiet "b.png contains .* chunks" $OUTDIR/o
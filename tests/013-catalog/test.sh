@@ -0,0 +1,43 @@
+set -eu
+OUTDIR="$1"
+export PNGRECON_CATALOG=$OUTDIR/catalog.sqlite3
+
+mkdir -p $OUTDIR/imgs/sub
+seq 1 20000 > $OUTDIR/input
+pngrecon encode -c -e --key-file key.txt -i $OUTDIR/input \
+    -o $OUTDIR/imgs/enc.png
+pngrecon encode --buffer-max-bytes 3000 -i $OUTDIR/input \
+    -o $OUTDIR/imgs/sub/plain.png
+echo "not a png" > $OUTDIR/imgs/notpng.txt
+
+# Only images are cataloged, and unchanged ones aren't read again
+pngrecon index -j 2 $OUTDIR/imgs 2> $OUTDIR/o
+grep --quiet "Indexed 2 images, 0 unchanged" $OUTDIR/o
+pngrecon index $OUTDIR/imgs 2> $OUTDIR/o
+grep --quiet "Indexed 0 images, 2 unchanged" $OUTDIR/o
+
+# Queries only need the catalog
+[[ "$(pngrecon find --encrypted)" == "$(realpath $OUTDIR/imgs/enc.png)" ]]
+[[ "$(pngrecon find --not-encrypted --min-data-bytes 100000)" == \
+    "$(realpath $OUTDIR/imgs/sub/plain.png)" ]]
+[[ "$(pngrecon find -c xz)" == "" ]]
+
+# info from the catalog says the same as info from the image
+pngrecon info --format jsonl $OUTDIR/imgs/enc.png > $OUTDIR/cached
+pngrecon info --catalog '' --format jsonl $OUTDIR/imgs/enc.png > $OUTDIR/read
+cmp $OUTDIR/cached $OUTDIR/read
+
+pngrecon decode --key-file key.txt -i $OUTDIR/imgs/enc.png | \
+    cmp - $OUTDIR/input
+pngrecon decode -i $OUTDIR/imgs/sub/plain.png | cmp - $OUTDIR/input
+
+# A changed image isn't described by its stale entry
+seq 1 10 | pngrecon append $OUTDIR/imgs/sub/plain.png
+pngrecon info $OUTDIR/imgs/sub/plain.png | grep --quiet "Generation 1"
+(seq 1 20000; seq 1 10) | cmp - <(pngrecon decode -i $OUTDIR/imgs/sub/plain.png)
+
+# Images that are gone are forgotten on the next index
+rm $OUTDIR/imgs/enc.png
+pngrecon index $OUTDIR/imgs 2> $OUTDIR/o
+grep --quiet "Indexed 1 images, 0 unchanged, 1 removed" $OUTDIR/o
+[[ "$(pngrecon find --encrypted)" == "" ]]
@@ -0,0 +1,91 @@
+set -eu
+OUTDIR="$1"
+
+seq 1 50000 > $OUTDIR/input
+
+# Many transfers at once, each encoding then decoding its own data, over real
+# sockets. One image is kept for the command line tool to decode.
+python3 - $OUTDIR <<'PYEOF'
+import asyncio
+import os
+import sys
+from pngrecon import aio
+from pngrecon.lib.chunk import CompressMethod
+
+outdir = sys.argv[1]
+data = open(os.path.join(outdir, 'input'), 'rb').read()
+methods = list(CompressMethod)
+
+
+async def roundtrip(i):
+    kw = {'compress_method': methods[i % len(methods)],
+          'buffer_max_bytes': 4096 + i, 'manifest': i % 2 == 0,
+          'index_first': i % 3 != 0, 'key_check': i % 20 == 0}
+    pw = b'password' if i % 10 == 0 else None
+    image = bytearray()
+    decoded = bytearray()
+
+    async def encode_conn(reader, writer):
+        await aio.encode(reader, writer, password=pw, **kw)
+        writer.close()
+
+    async def decode_conn(reader, writer):
+        await aio.decode(reader, writer, password=pw)
+        writer.close()
+
+    for handler, source, sink in ((encode_conn, data, image),
+                                  (decode_conn, None, decoded)):
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(source if source is not None else bytes(image))
+        writer.write_eof()
+        while True:
+            b = await reader.read(65536)
+            if not b:
+                break
+            sink += b
+        writer.close()
+        server.close()
+    assert bytes(decoded) == data, i
+    return bytes(image)
+
+
+async def failures():
+    ''' Errors are raised as exceptions, not by exiting '''
+    class Sink():
+        def write(self, b):
+            pass
+
+        async def drain(self):
+            pass
+
+    for image, pw in ((b'not a png at all', None),
+                      (open(os.path.join(outdir, 'enc.png'), 'rb').read(),
+                       None),
+                      (open(os.path.join(outdir, 'enc.png'), 'rb').read()[:-30],
+                       b'password')):
+        reader = asyncio.StreamReader()
+        reader.feed_data(image)
+        reader.feed_eof()
+        try:
+            await aio.decode(reader, Sink(), password=pw)
+        except aio.PngreconError:
+            pass
+        else:
+            assert False, 'expected decode to fail'
+
+
+async def main():
+    images = await asyncio.gather(*(roundtrip(i) for i in range(60)))
+    open(os.path.join(outdir, 'plain.png'), 'wb').write(images[1])
+    open(os.path.join(outdir, 'enc.png'), 'wb').write(images[10])
+    await failures()
+
+asyncio.run(main())
+PYEOF
+
+pngrecon decode -i $OUTDIR/plain.png | cmp - $OUTDIR/input
+printf 'password' > $OUTDIR/key
+pngrecon decode --key-file $OUTDIR/key -i $OUTDIR/enc.png | cmp - $OUTDIR/input
+pngrecon verify $OUTDIR/plain.png $OUTDIR/enc.png > /dev/null
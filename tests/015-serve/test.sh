@@ -0,0 +1,108 @@
+set -eu
+OUTDIR="$1"
+
+seq 1 100000 > $OUTDIR/input
+python3 ../011-lsb/make_carrier.py $OUTDIR/carrier.png 64 48 8 2
+cp key.txt $OUTDIR/key.txt
+KEY="$(realpath $OUTDIR/key.txt)"
+
+pngrecon serve -q --listen 127.0.0.1:0 --root $OUTDIR > /dev/null \
+    2> $OUTDIR/log &
+SERVER=$!
+trap "kill $SERVER" EXIT
+for i in $(seq 50); do
+    grep --quiet "Listening on" $OUTDIR/log && break
+    sleep 0.1
+done
+ADDR=$(sed -n 's/Listening on //p' $OUTDIR/log)
+
+python3 - $ADDR $OUTDIR "$KEY" <<'PYEOF'
+import http.client
+import json
+import sys
+from urllib.parse import urlencode
+
+addr, outdir, key = sys.argv[1:]
+host, port = addr.rsplit(':', 1)
+data = open(outdir + '/input', 'rb').read()
+
+
+def request(method, path, body=None, **query):
+    conn = http.client.HTTPConnection(host, int(port))
+    if query:
+        path += '?' + urlencode(query)
+    conn.request(method, path, body=body)
+    resp = conn.getresponse()
+    return resp.status, resp.read()
+
+
+# Several images with the same key, one on a carrier
+for i, extra in enumerate(({}, {'source': outdir + '/carrier.png'},
+                           {'compress': 'xz', 'manifest': '1'})):
+    status, image = request('POST', '/encode', data, encrypt='1',
+                            key_file=key, buffer_max_bytes='50000', **extra)
+    assert status == 200, (status, image)
+    open('{}/{}.png'.format(outdir, i), 'wb').write(image)
+    # Paths may also be relative to --root
+    status, decoded = request('POST', '/decode', image, key_file='key.txt')
+    assert status == 200 and decoded == data
+
+# Errors come back as 4xx with the reason
+status, body = request('POST', '/decode', image)
+assert status == 400 and b'no key' in body, (status, body)
+status, body = request('POST', '/decode', b'not a png', key_file=key)
+assert status == 400 and b'PNG' in body, (status, body)
+status, body = request('GET', '/nope')
+assert status == 404
+
+# Nothing outside --root can be named, however it's spelled
+for path in ('/etc/passwd', outdir + '/../key.txt', '../key.txt'):
+    status, body = request('POST', '/decode', image, key_file=path)
+    assert status == 400 and b'outside --root' in body, (path, status, body)
+    status, body = request('GET', '/info', image=path)
+    assert status == 400 and b'outside --root' in body, (path, status, body)
+
+status, body = request('POST', '/info', image, name='x.png')
+record = json.loads(body)
+assert record['image'] == 'x.png' and record['pngrecon']['manifest']
+status, body = request('GET', '/info?image={0}/0.png&image={0}/no.png'.format(
+    outdir))
+records = [json.loads(line) for line in body.splitlines()]
+assert len(records) == 2 and not records[0]['errors'] and records[1]['errors']
+
+# The key was only derived once, and every request was counted
+status, body = request('GET', '/metrics')
+metrics = json.loads(body)
+assert metrics['key_cache']['misses'] == 1, metrics['key_cache']
+encode = metrics['endpoints']['/encode']
+assert encode['requests'] == 3 and encode['errors'] == 0
+assert encode['bytes_in'] == 3 * len(data)
+assert metrics['endpoints']['/decode']['errors'] == 5
+PYEOF
+
+# Without --root, requests can't name paths on the server at all
+pngrecon serve -q --listen 127.0.0.1:0 > /dev/null 2> $OUTDIR/log2 &
+SERVER2=$!
+trap "kill $SERVER $SERVER2" EXIT
+for i in $(seq 50); do
+    grep --quiet "Listening on" $OUTDIR/log2 && break
+    sleep 0.1
+done
+ADDR=$(sed -n 's/Listening on //p' $OUTDIR/log2)
+python3 - $ADDR "$KEY" <<'PYEOF'
+import http.client
+import sys
+from urllib.parse import urlencode
+addr, key = sys.argv[1:]
+host, port = addr.rsplit(':', 1)
+conn = http.client.HTTPConnection(host, int(port))
+conn.request('POST', '/encode?' + urlencode({'encrypt': 1, 'key_file': key}),
+             body=b'hi')
+resp = conn.getresponse()
+body = resp.read()
+assert resp.status == 400 and b'--root' in body, (resp.status, body)
+PYEOF
+
+# Images from the server are ordinary images
+pngrecon decode --key-file key.txt -i $OUTDIR/1.png | cmp - $OUTDIR/input
+pngrecon verify $OUTDIR/0.png $OUTDIR/1.png $OUTDIR/2.png > /dev/null
@@ -0,0 +1,191 @@
+# Encode and decode synthetic inputs of growing sizes in this process, and
+# check that the most memory Python has allocated at once stays within a
+# multiple of --buffer-max-bytes no matter the size, and hardly grows as the
+# size does, and that CPU time grows no faster than the size does. Inputs are
+# generated as they are read and never stored. Usage:
+#
+#     memscale.py OUTDIR BUFFER_MAX_BYTES SIZE_MB [SIZE_MB ...]
+#
+# For example, `memscale.py /tmp 1048576 1 16 256 2048` goes from 1 MB to
+# 2 GB. Every compression and encryption combination is covered, as is
+# --source.
+from argparse import Namespace
+from itertools import product
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from pngrecon.commands import decode, encode
+from pngrecon.util.crypto import KeyCache
+
+# Peak traced memory may be at most this many times --buffer-max-bytes, plus
+# FIXED_BUDGET_BYTES for everything that doesn't depend on the data
+BUFFER_BUDGET_FACTOR = 8
+FIXED_BUDGET_BYTES = 2 * 1024 * 1024
+# What compressors and decompressors need for their own state, which doesn't
+# depend on the data either. lzma's is large, and Python traces it.
+CODEC_BUDGET_BYTES = {
+    ('xz', 'encode'): 100 * 1024 * 1024,
+    ('xz', 'decode'): 10 * 1024 * 1024,
+}
+# Doubling the input may grow peak traced memory by at most this many times
+# --buffer-max-bytes. Anything held per data chunk has to be small.
+DOUBLING_MEMORY_FACTOR = 1
+# Doubling the input may at most multiply CPU time by this much. Linear is 2,
+# quadratic is 4. Only sizes of at least TIME_MIN_BYTES are compared, since
+# fixed costs dominate below that, and each is timed as the best of TIME_RUNS
+# runs so that whatever else the machine is doing doesn't count. Times
+# shorter than TIME_MIN_S jitter by more than any factor, so sizes that took
+# less than that aren't compared against.
+DOUBLING_TIME_FACTOR = 3
+TIME_MIN_S = 0.02
+TIME_MIN_BYTES = 2 * 1000 * 1000
+TIME_RUNS = 3
+
+
+class SyntheticInput():
+    ''' A file-like object producing size bytes that compress somewhat, like
+    real data, without having to hold them all '''
+    def __init__(self, size, seed):
+        rand = random.Random(seed)
+        self.remaining = size
+        self.blocks = [rand.randbytes(4096) for _ in range(16)]
+        self.counter = 0
+
+    def seekable(self):
+        return False
+
+    def read(self, n):
+        parts = []
+        n = min(n, self.remaining)
+        while n > 0:
+            block = self.blocks[self.counter % len(self.blocks)]
+            b = self.counter.to_bytes(8, 'big') + block[8:]
+            b = b[:n]
+            parts.append(b)
+            n -= len(b)
+            self.remaining -= len(b)
+            self.counter += 1
+        return b''.join(parts)
+
+
+def measure(func):
+    ''' Return the peak traced memory while calling func, and the CPU time it
+    took '''
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    start = time.process_time()
+    func()
+    took = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    return peak - base, took
+
+
+def run_case(outdir, buffer_max_bytes, size, compress, encrypt, source,
+             keys, key_file):
+    image = os.path.join(outdir, 'memscale.png')
+    args = Namespace(
+        input='synthetic', output=image, source=source, encrypt=encrypt,
+        key_file=key_file if encrypt else None, key_check=False,
+        buffer_max_bytes=buffer_max_bytes, pipeline=False, index_first=False,
+        manifest=False, parity=None, zdict=None, compress_level=None,
+        fingerprint=True)
+
+    def do_encode():
+        if source:
+            layout = encode.get_provided_source_image_layout(args)
+        else:
+            layout = encode.get_basic_source_image_chunks()
+        chunks = encode.completely_encode_stream(
+            SyntheticInput(size, size), args,
+            encode.get_compress_method(compress), gen_key=keys.gen_key)
+        encode.encode_source_and_data_chunks_together(args, layout, chunks)
+
+    def do_decode():
+        decode.main(Namespace(
+            input=image, output=os.devnull,
+            key_file=[args.key_file] if args.key_file else None, jobs=1,
+            embed='chunks', pipeline=False, stream=False, catalog='',
+            buffer_max_bytes=buffer_max_bytes, spill_max_bytes=0, zdict=None))
+
+    results = (measure(do_encode), measure(do_decode))
+    os.unlink(image)
+    return results
+
+
+def main(outdir, buffer_max_bytes, sizes):
+    key_file = os.path.join(outdir, 'memscale.key')
+    with open(key_file, 'wb') as fd:
+        fd.write(b'memscale')
+    # Derive the key up front so it isn't counted against the smallest size
+    keys = KeyCache()
+    keys.gen_key(b'memscale')
+    source = os.path.join(outdir, 'memscale-source.png')
+    encode.encode_source_and_data_chunks_together(
+        Namespace(output=source, source=None),
+        encode.get_basic_source_image_chunks(), [])
+    tracemalloc.start()
+    ok = True
+    for compress, encrypt, use_source in product(
+            ('no', 'gzip', 'xz'), (False, True), (False, True)):
+        name = 'compress={} encrypt={} source={}'.format(
+            compress, encrypt, use_source)
+        prev = None
+        prev_timed = None
+        for size in sizes:
+            runs = [run_case(outdir, buffer_max_bytes, size, compress,
+                             encrypt, source if use_source else None, keys,
+                             key_file)
+                    for _ in range(TIME_RUNS if size >= TIME_MIN_BYTES
+                                   else 1)]
+            enc_peak = max(enc[0] for enc, _ in runs)
+            enc_time = min(enc[1] for enc, _ in runs)
+            dec_peak = max(dec[0] for _, dec in runs)
+            dec_time = min(dec[1] for _, dec in runs)
+            print('{} size={} encode: {} bytes {:.2f}s decode: {} bytes '
+                  '{:.2f}s'.format(name, size, enc_peak, enc_time, dec_peak,
+                                   dec_time))
+            for what, peak in (('encode', enc_peak), ('decode', dec_peak)):
+                budget = BUFFER_BUDGET_FACTOR * buffer_max_bytes + \
+                    FIXED_BUDGET_BYTES + \
+                    CODEC_BUDGET_BYTES.get((compress, what), 0)
+                if peak > budget:
+                    print('FAIL {} {} size={} used {} bytes, more than {}'
+                          .format(name, what, size, peak, budget))
+                    ok = False
+            if prev is not None:
+                prev_size, prev_peaks = prev
+                for what, peak, prev_peak in zip(('encode', 'decode'),
+                                                 (enc_peak, dec_peak),
+                                                 prev_peaks):
+                    allowed = DOUBLING_MEMORY_FACTOR * buffer_max_bytes * \
+                        max(1, math.log2(size / prev_size))
+                    if peak > prev_peak + allowed:
+                        print('FAIL {} {} used {} bytes at size={} but {} '
+                              'at size={}'.format(name, what, peak, size,
+                                                  prev_peak, prev_size))
+                        ok = False
+            prev = (size, (enc_peak, dec_peak))
+            if size < TIME_MIN_BYTES:
+                continue
+            if prev_timed is not None:
+                prev_size, prev_times = prev_timed
+                for what, t, prev_t in zip(('encode', 'decode'),
+                                           (enc_time, dec_time), prev_times):
+                    allowed = DOUBLING_TIME_FACTOR ** math.log2(
+                        size / prev_size)
+                    if prev_t >= TIME_MIN_S and t > prev_t * allowed:
+                        print('FAIL {} {} took {:.2f}s at size={} but '
+                              '{:.2f}s at size={}'.format(
+                                  name, what, t, size, prev_t, prev_size))
+                        ok = False
+            prev_timed = (size, (enc_time, dec_time))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1], int(sys.argv[2]),
+                  [int(float(s) * 1000 * 1000) for s in sys.argv[3:]]))
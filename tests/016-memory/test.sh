@@ -0,0 +1,7 @@
+set -eu
+OUTDIR="$1"
+
+# Small enough to run with everything else. For a real workout, try something
+# like MEMSCALE_SIZES_MB="1 16 256 2048" MEMSCALE_BUFFER_MAX_BYTES=1048576
+python3 memscale.py $OUTDIR ${MEMSCALE_BUFFER_MAX_BYTES:-262144} \
+    ${MEMSCALE_SIZES_MB:-1 2 4 8} > $OUTDIR/o || { cat $OUTDIR/o; exit 1; }
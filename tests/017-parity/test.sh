@@ -0,0 +1,105 @@
+set -eu
+OUTDIR="$1"
+python3 -c 'import numpy' 2>/dev/null || { echo "NumPy not installed, skipping"; exit 0; }
+
+# Random, so that compressing it still leaves plenty of data chunks
+head -c 100000 /dev/urandom > $OUTDIR/input
+s=$(sha1sum $OUTDIR/input | cut -d ' ' -f 1)
+
+# Damage the data fields of the data chunks with the given indexes, and
+# remove the ones with the given indexes (after --remove) altogether
+cat > $OUTDIR/damage.py <<'PYEOF'
+import sys
+from pngrecon.lib.chunk import ChunkType
+from pngrecon.lib.layout import scan_image_stream, read_data_chunk_index
+fname, out = sys.argv[1:3]
+damage, remove, dest = set(), set(), None
+for a in sys.argv[3:]:
+    if a == '--remove':
+        dest = remove
+    else:
+        (remove if dest is remove else damage).add(int(a))
+b = bytearray(open(fname, 'rb').read())
+found = set()
+with open(fname, 'rb') as fd:
+    layout = scan_image_stream(fd)
+    for h in reversed(layout):
+        if ChunkType.from_string(h.type) != ChunkType.Data:
+            continue
+        i = read_data_chunk_index(fd, h)
+        if i in remove:
+            del b[h.offset:h.end]
+        elif i in damage:
+            b[h.crc_offset - 1] ^= 0xff
+        found.add(i)
+assert damage | remove <= found, 'No such data chunks'
+open(out, 'wb').write(b)
+PYEOF
+
+for ARGS in "" "-c xz" "-e --key-file key.txt"; do
+    KEY_ARGS=""
+    [[ "$ARGS" == -e* ]] && KEY_ARGS="--key-file key.txt"
+    pngrecon encode --parity 4:2 --buffer-max-bytes 10000 $ARGS \
+        -i $OUTDIR/input -o $OUTDIR/o.png
+    pngrecon info $OUTDIR/o.png | grep --quiet 'ChunkType.Parity'
+    # Intact, and with up to 2 chunks per stripe damaged or missing. xz
+    # makes the fewest data chunks: 4.
+    for DAMAGE in "" "0" "1 3" "0 --remove 2" "--remove 2 3"; do
+        python3 $OUTDIR/damage.py $OUTDIR/o.png $OUTDIR/bad.png $DAMAGE
+        pngrecon decode $KEY_ARGS -i $OUTDIR/bad.png -o $OUTDIR/output \
+            2> $OUTDIR/err
+        [[ "$s" = "$(sha1sum $OUTDIR/output | cut -d ' ' -f 1)" ]]
+        if [ -n "$DAMAGE" ]; then
+            grep --quiet "Rebuilt data chunk" $OUTDIR/err
+        fi
+    done
+    # 3 in one stripe is too many
+    python3 $OUTDIR/damage.py $OUTDIR/o.png $OUTDIR/bad.png 0 1 --remove 2
+    ! pngrecon decode $KEY_ARGS -i $OUTDIR/bad.png -o $OUTDIR/output \
+        2> $OUTDIR/err
+    grep --quiet "are damaged to rebuild them" $OUTDIR/err
+done
+
+# Appending adds parity for the new data chunks
+pngrecon encode --parity 3:1 --buffer-max-bytes 10000 -i $OUTDIR/input \
+    -o $OUTDIR/o.png
+seq 1 20000 | pngrecon append --parity 3:1 --buffer-max-bytes 10000 \
+    $OUTDIR/o.png
+n=$(pngrecon info $OUTDIR/o.png | grep 'Claiming' | tail -n 1 | \
+    grep -o '[0-9]*')
+python3 $OUTDIR/damage.py $OUTDIR/o.png $OUTDIR/bad.png 0 $(( n - 1 ))
+pngrecon decode -i $OUTDIR/bad.png -o $OUTDIR/output 2>/dev/null
+(cat $OUTDIR/input; seq 1 20000) | cmp - $OUTDIR/output
+
+# Any m of k shards can be rebuilt from any m parities
+python3 - <<'PYEOF'
+from itertools import combinations, islice
+import numpy as np
+from pngrecon.lib import parity
+rand = np.random.default_rng(1)
+for k, m in ((1, 1), (5, 3), (10, 4), (200, 56)):
+    shards = [rand.integers(0, 256, rand.integers(1, 50), dtype=np.uint8)
+              for _ in range(k)]
+    acc = None
+    for p, shard in enumerate(shards):
+        acc = parity.accumulate(np, acc, p, shard.tobytes(), m)
+    parities = {r: acc[r].tobytes() for r in range(m)}
+    for n in sorted(set((1, (min(k, m) + 1) // 2, min(k, m)))):
+        for missing in islice(combinations(range(k), n), 3):
+            for rows in islice(combinations(range(m)[::-1], n), 3):
+                present = [(p, shards[p].tobytes()) for p in range(k)
+                           if p not in missing]
+                rebuilt = parity.rebuild(
+                    np, present, {r: parities[r] for r in rows},
+                    list(missing))
+                for p, shard in zip(missing, rebuilt):
+                    assert (shard[:len(shards[p])] == shards[p]).all()
+                    assert not shard[len(shards[p]):].any()
+PYEOF
+
+# Bad --parity values are caught before anything is written
+for P in "4" "0:1" "4:0" "200:57" "a:b"; do
+    ! pngrecon encode --parity $P -i $OUTDIR/input -o $OUTDIR/never.png \
+        2>/dev/null
+    [ ! -e $OUTDIR/never.png ]
+done
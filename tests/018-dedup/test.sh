@@ -0,0 +1,91 @@
+set -eu
+OUTDIR="$1"
+python3 -c 'import numpy' 2>/dev/null || { echo "NumPy not installed, skipping"; exit 0; }
+
+# The second version has some bytes inserted and some changed, and the third
+# is the second with its first half dropped
+head -c 3000000 /dev/urandom > $OUTDIR/v1
+(head -c 1000000 $OUTDIR/v1; echo inserted; tail -c +1000001 $OUTDIR/v1 | \
+    head -c 1000000; head -c 1000 /dev/urandom; tail -c +2001001 $OUTDIR/v1) \
+    > $OUTDIR/v2
+tail -c +1500000 $OUTDIR/v2 > $OUTDIR/v3
+
+for ARGS in "" "-c gzip" "-c xz -e --key-file key.txt"; do
+    KEY_ARGS=""
+    [[ "$ARGS" == *-e* ]] && KEY_ARGS="--key-file key.txt"
+    POOL=$OUTDIR/pool
+    rm -rf $POOL
+    for V in v1 v2 v3; do
+        pngrecon encode --pool $POOL --block-avg-bytes 65536 $ARGS \
+            -i $OUTDIR/$V -o $OUTDIR/$V.png 2> $OUTDIR/err.$V
+        pngrecon info $OUTDIR/$V.png | grep --quiet 'EncodingType.Blocks'
+    done
+    # Only the blocks around the changes are new
+    grep --quiet "Stored \([0-9]*\) new blocks of \1 " $OUTDIR/err.v1
+    new=$(grep -o 'Stored [0-9]*' $OUTDIR/err.v2 | grep -o '[0-9]*')
+    (( new > 0 && new <= 6 ))
+    grep --quiet "Stored [0-2] new blocks" $OUTDIR/err.v3
+    # Every version decodes, seekable and streamed
+    for V in v1 v2 v3; do
+        pngrecon decode --pool $POOL $KEY_ARGS -i $OUTDIR/$V.png | \
+            cmp - $OUTDIR/$V
+        cat $OUTDIR/$V.png | pngrecon decode --pool $POOL $KEY_ARGS | \
+            cmp - $OUTDIR/$V
+    done
+done
+
+# The pool's blocks are all compressed and encrypted the same way, with the
+# same key
+! pngrecon encode --pool $POOL -c gzip -i $OUTDIR/v1 -o $OUTDIR/o.png \
+    2> $OUTDIR/err
+grep --quiet "so those must be used with it" $OUTDIR/err
+echo wrong > $OUTDIR/wrong.key
+! pngrecon encode --pool $POOL -c xz -e --key-file $OUTDIR/wrong.key \
+    -i $OUTDIR/v1 -o $OUTDIR/o.png 2> $OUTDIR/err
+grep --quiet "Passphrase appears to be incorrect" $OUTDIR/err
+
+# Damaged and missing blocks are noticed, and a pool is needed at all
+rm -rf $OUTDIR/pool
+pngrecon encode --pool $OUTDIR/pool --block-avg-bytes 65536 -i $OUTDIR/v1 \
+    -o $OUTDIR/v1.png 2>/dev/null
+! pngrecon decode -i $OUTDIR/v1.png -o $OUTDIR/o 2> $OUTDIR/err
+grep --quiet "Give --pool" $OUTDIR/err
+block=$(ls $OUTDIR/pool/*/*.png | head -n 1)
+python3 - $block <<'PYEOF'
+import sys
+from pngrecon.lib.chunk import ChunkType, DataChunk
+from pngrecon.lib.layout import scan_image_stream
+# Change a data chunk, keeping its CRC right so only the digest catches it
+fname = sys.argv[1]
+with open(fname, 'rb') as fd:
+    layout = scan_image_stream(fd)
+    fd.seek(0, 0)
+    b = bytearray(fd.read())
+h = [h for h in layout if h.type == ChunkType.Data.value][0]
+index = int.from_bytes(b[h.data_offset:h.data_offset + 4], 'big')
+data = bytes(b[h.data_offset + 4:h.crc_offset])
+c = DataChunk(index, bytes([data[0] ^ 1]) + data[1:])
+b[h.offset:h.end] = c.raw_data
+open(fname, 'wb').write(b)
+PYEOF
+! pngrecon decode --pool $OUTDIR/pool -i $OUTDIR/v1.png -o $OUTDIR/o \
+    2> $OUTDIR/err
+grep --quiet "is corrupt" $OUTDIR/err
+rm $block
+! pngrecon decode --pool $OUTDIR/pool -i $OUTDIR/v1.png -o $OUTDIR/o \
+    2> $OUTDIR/err
+grep --quiet "is missing from the pool" $OUTDIR/err
+
+# Cut points only depend on nearby bytes: the same content is cut the same
+# way wherever it starts
+python3 - $OUTDIR/v1 <<'PYEOF'
+import io
+import sys
+from pngrecon.lib.blocks import iter_blocks
+data = open(sys.argv[1], 'rb').read()
+a = list(iter_blocks(io.BytesIO(data), 65536))
+b = list(iter_blocks(io.BytesIO(data[12345:]), 65536))
+assert b''.join(a) == data and b''.join(b) == data[12345:]
+assert all(16384 <= len(x) <= 262144 for x in a[:-1])
+assert len(set(a) & set(b)) >= len(a) - 3
+PYEOF
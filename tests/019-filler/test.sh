@@ -0,0 +1,189 @@
+set -eu
+OUTDIR="$1"
+
+rm -rf $OUTDIR/bench
+
+# filler encodes a small tree both ways, and every leaf comes back out
+python3 ../../scripts/filler_bench.py --work-dir $OUTDIR/bench --depth 2 \
+    --fanout 2 --files-per-dir 3 --huge-files 1 --huge-file-size 300000 \
+    --split-file-size-limit-mb 0.1 -j 2 --json > $OUTDIR/results.json \
+    2> $OUTDIR/bench.log
+python3 - $OUTDIR/results.json <<'PYEOF'
+import json
+import sys
+r = json.load(open(sys.argv[1]))
+assert r['tree']['leaf_dirs'] == 5 and r['tree']['files'] == 13
+for style, s in r['styles'].items():
+    assert s['ok'], style
+    assert s['queries']['INSERT'] > 0, style
+    assert 0 < s['worker_utilization'] <= 1, style
+PYEOF
+# The tiny leaves were packed into one job each time, and every leaf (and,
+# for split_file, every file) can be found from the catalog and gotten back
+# on its own, even the huge one that was split over several PNGs
+python3 - $OUTDIR/results.json $OUTDIR/bench <<'PYEOF'
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+r = json.load(open(sys.argv[1]))
+bench = sys.argv[2]
+key = os.path.join(bench, 'filler.key')
+for style, s in r['styles'].items():
+    assert s['jobs'] == 1, (style, s['jobs'])
+    conn = sqlite3.connect(os.path.join(bench, 'filler-{}.db'.format(style)))
+    locs = conn.execute('''
+        SELECT DISTINCT obj_id, png, member_offset, member_bytes
+        FROM encoded_location''').fetchall()
+    assert len(locs) == (5 if style == 'bundle_leaf_dir' else 13), locs
+    for obj_id, png, offset, size in locs:
+        d = os.path.dirname(png)
+        pngs = sorted(f for f in os.listdir(d) if f >= os.path.basename(png))
+        data = b''
+        for f in pngs:
+            if len(data) >= offset + size:
+                break
+            data += subprocess.run(
+                ['pngrecon', 'decode', '--key-file', key, '-i',
+                 os.path.join(d, f)], stdout=subprocess.PIPE,
+                check=True).stdout
+        names = subprocess.run(
+            ['tar', 't'], input=data[offset:offset + size],
+            stdout=subprocess.PIPE, check=True).stdout.decode().split()
+        name = conn.execute('SELECT name FROM name_map WHERE rowid = ?',
+                            (obj_id,)).fetchone()[0]
+        assert names[0].rstrip('/').split('/')[-1] == name, (names, name)
+        files = len(names) - 1 if style == 'bundle_leaf_dir' else 1
+        assert files in (1, 3), names
+PYEOF
+# The huge file was split into pieces
+(( $(find $OUTDIR/bench/outputs-split_file -name '*.png' | wc -l) >= 3 ))
+
+# Each job was recorded with what it did, which stats reports on
+python3 - $OUTDIR/bench/filler-bundle_leaf_dir.db <<'PYEOF'
+import sqlite3
+import sys
+conn = sqlite3.connect(sys.argv[1])
+conn.row_factory = sqlite3.Row
+run, = conn.execute('SELECT * FROM run').fetchall()
+assert run['end_time'] > run['start_time'] and run['max_jobs'] == 2
+job, = conn.execute('SELECT * FROM job').fetchall()
+assert job['leaves'] == 5 and job['volumes'] >= 3, dict(job)
+assert run['start_time'] <= job['start_time'] < job['end_time'] \
+    <= run['end_time'], dict(job)
+assert job['in_bytes'] > 300000 and job['out_bytes'] > job['in_bytes'] / 2
+assert job['tar_s'] + job['encode_s'] + job['mark_done_s'] <= \
+    job['end_time'] - job['start_time']
+PYEOF
+printf '[db]\nfname = %s\n' $OUTDIR/bench/filler-bundle_leaf_dir.db \
+    > $OUTDIR/stats.conf
+python3 ../../scripts/filler.py stats $OUTDIR/stats.conf --interval-s 1 \
+    > $OUTDIR/stats.txt
+for heading in Runs Throughput 'Time in jobs' 'Compression by root' Slowest; do
+    grep "^$heading" $OUTDIR/stats.txt > /dev/null
+done
+grep "/bench/tree/" $OUTDIR/stats.txt > /dev/null
+for ARGS in "--interval-s 0" "--interval-s -1" "--top 0"; do
+    ! python3 ../../scripts/filler.py stats $OUTDIR/stats.conf $ARGS \
+        > /dev/null 2> $OUTDIR/err
+    grep "error: ${ARGS% *} must be" $OUTDIR/err > /dev/null
+done
+
+# Without packing, each leaf gets a job of its own
+python3 ../../scripts/filler_bench.py --work-dir $OUTDIR/bench --depth 2 \
+    --fanout 2 --files-per-dir 3 --huge-files 1 --huge-file-size 300000 \
+    --split-file-size-limit-mb 0.1 --pack-size-limit-mb 0 \
+    --style bundle_leaf_dir -j 2 --json > $OUTDIR/results-nopack.json \
+    2> $OUTDIR/bench-nopack.log
+python3 - $OUTDIR/results-nopack.json <<'PYEOF'
+import json
+import sys
+r = json.load(open(sys.argv[1]))
+s = r['styles']['bundle_leaf_dir']
+assert s['ok'] and s['jobs'] == 5, s
+PYEOF
+(( $(ls $OUTDIR/bench/outputs-bundle_leaf_dir/*/*/*/001.png | wc -l) == 4 ))
+
+# If jobs die before marking their leaves done, the PNGs they left behind are
+# removed when the leaves are done again, even when they're packed into jobs
+# named after other leaves
+python3 - $OUTDIR/bench <<'PYEOF'
+import configparser
+import glob
+import os
+import sqlite3
+import sys
+sys.path.insert(0, '../../scripts')
+import filler
+bench = sys.argv[1]
+out = os.path.join(bench, 'outputs-bundle_leaf_dir')
+db = os.path.join(bench, 'filler-bundle_leaf_dir.db')
+conn = sqlite3.connect(db)
+conn.execute('UPDATE work SET is_done = FALSE')
+conn.execute('DELETE FROM encoded_location')
+conn.execute('DELETE FROM job')
+conn.commit()
+for first in glob.glob(out + '/**/001.png', recursive=True):
+    open(os.path.join(os.path.dirname(first), '099.png'), 'wb').close()
+conf = configparser.ConfigParser()
+conf['db'] = {'fname': db}
+conf['pngrecon'] = {'path': 'pngrecon',
+                    'keyfile': os.path.join(bench, 'filler.key')}
+conf['general'] = {'max_jobs': '2'}
+conf['roots'] = {'bench': os.path.join(bench, 'tree')}
+conf['bench_options'] = {
+    'output': out, 'outdir_size_limit_mb': str(1024 * 1024),
+    'split_file_size_limit_mb': '0.1', 'style': 'bundle_leaf_dir'}
+filler.log = lambda *a, **kw: None
+assert filler.main(conf) == 0
+pngs = glob.glob(out + '/**/*.png', recursive=True)
+assert not any(p.endswith('/099.png') for p in pngs), pngs
+d, = set(os.path.realpath(os.path.dirname(row[0])) for row in conn.execute(
+    'SELECT png FROM encoded_location'))
+assert all(os.path.realpath(os.path.dirname(p)) == d for p in pngs), pngs
+PYEOF
+
+# Walking catalogs every directory (and, for split_file, every file) once,
+# however many times it's run, and leaves out excluded ones without looking
+# in them
+python3 - $OUTDIR <<'PYEOF'
+import os
+import sqlite3
+import sys
+sys.path.insert(0, '../../scripts')
+import filler
+out = sys.argv[1]
+tree = os.path.join(out, 'walk')
+for d in ('a/b/c', 'a/skip/deep', 'x.tmp', 'e/f'):
+    os.makedirs(os.path.join(tree, d), exist_ok=True)
+for f in ('a/1', 'a/b/c/2', 'e/3.tmp', 'a/skip/deep/4'):
+    open(os.path.join(tree, f), 'w').close()
+listed = []
+orig_scandir = os.scandir
+def scandir(d):
+    listed.append(os.path.relpath(d, tree))
+    return orig_scandir(d)
+os.scandir = scandir
+db = os.path.join(out, 'walk.db')
+if os.path.exists(db):
+    os.unlink(db)
+conn = sqlite3.connect(db)
+conn.row_factory = sqlite3.Row
+conn.executescript('''
+    CREATE TABLE name_map(name NOT NULL, parent INTEGER);
+    CREATE INDEX name_map_parent ON name_map (parent, name);
+''')
+root = filler.Root(filler.Path.from_str(tree), None, {
+    'style': filler.SPLIT_FILE, 'exclude': ['skip', '*.tmp']})
+filler.insert_roots(conn, [root])
+for threads in (1, 4):
+    filler.walk_roots(conn, [root], threads)
+    paths = set()
+    for row in conn.execute('SELECT rowid FROM name_map'):
+        _, sub, _ = filler.get_path(conn, row['rowid'])
+        paths.add(str(sub))
+    assert paths == {'', 'a', 'a/1', 'a/b', 'a/b/c', 'a/b/c/2', 'e',
+                     'e/f'}, paths
+assert not any('skip' in d for d in listed), listed
+PYEOF
@@ -0,0 +1,115 @@
+set -eu
+OUTDIR="$1"
+python3 -c 'import numpy' 2>/dev/null || { echo "NumPy not installed, skipping"; exit 0; }
+
+# Lots of small, similar files, like what filler's split_file style encodes
+rm -rf $OUTDIR/samples
+mkdir $OUTDIR/samples
+python3 - $OUTDIR/samples <<'PYEOF'
+import json
+import os
+import random
+import sys
+r = random.Random(1)
+words = ['status', 'ok', 'error', 'request', 'response', 'latency', 'user']
+for i in range(400):
+    d = {'id': i, 'user': 'user{}'.format(r.randrange(100)),
+         'events': [{'type': r.choice(words), 'ms': r.randrange(1000),
+                     'message': ' '.join(r.choices(words, k=6))}
+                    for _ in range(r.randrange(3, 15))]}
+    with open(os.path.join(sys.argv[1], '{}.json'.format(i)), 'w') as fd:
+        json.dump(d, fd, indent=2)
+PYEOF
+pngrecon train-dict $OUTDIR/samples -o $OUTDIR/dict 2> $OUTDIR/err
+grep --quiet "Trained a [0-9]* byte dictionary" $OUTDIR/err
+(( $(stat -c %s $OUTDIR/dict) <= 32768 ))
+
+# Small files come out smaller with the dictionary, and decode the same every
+# way
+with=0
+without=0
+for F in $OUTDIR/samples/{1,2}?.json; do
+    pngrecon encode -c gzip --zdict $OUTDIR/dict -i $F -o $OUTDIR/z.png
+    pngrecon encode -c gzip -i $F -o $OUTDIR/plain.png
+    with=$(( with + $(stat -c %s $OUTDIR/z.png) ))
+    without=$(( without + $(stat -c %s $OUTDIR/plain.png) ))
+    pngrecon decode --zdict $OUTDIR/dict -i $OUTDIR/z.png | cmp - $F
+    cat $OUTDIR/z.png | pngrecon decode --zdict $OUTDIR/dict | cmp - $F
+done
+(( with < without * 9 / 10 ))
+pngrecon info $OUTDIR/z.png | grep 'ChunkType.ZDict' > /dev/null
+pngrecon encode -c gzip -e --key-file key.txt --index-first --zdict \
+    $OUTDIR/dict -i $F -o $OUTDIR/z.png
+pngrecon decode --key-file key.txt --zdict $OUTDIR/dict -i $OUTDIR/z.png | \
+    cmp - $F
+cat $OUTDIR/z.png | pngrecon decode --key-file key.txt --zdict $OUTDIR/dict \
+    | cmp - $F
+
+# Appending compresses with the same dictionary
+pngrecon encode -c gzip --zdict $OUTDIR/dict -i $F -o $OUTDIR/z.png
+pngrecon append --zdict $OUTDIR/dict -i $OUTDIR/samples/8.json $OUTDIR/z.png
+pngrecon decode --zdict $OUTDIR/dict -i $OUTDIR/z.png | \
+    cmp - <(cat $F $OUTDIR/samples/8.json)
+
+# Without the dictionary, or with the wrong one, it says which one it needs
+digest=$(sha256sum $OUTDIR/dict | cut -d ' ' -f 1)
+head -c 1000 $OUTDIR/dict > $OUTDIR/wrong
+for D in "" "--zdict $OUTDIR/wrong"; do
+    ! pngrecon decode $D -i $OUTDIR/z.png -o $OUTDIR/o 2> $OUTDIR/err
+    grep --quiet "$digest" $OUTDIR/err
+    ! cat $OUTDIR/z.png | pngrecon decode $D -o $OUTDIR/o 2> $OUTDIR/err
+    grep --quiet "$digest" $OUTDIR/err
+    ! pngrecon append $D -i $F $OUTDIR/z.png 2> $OUTDIR/err
+    grep --quiet "$digest" $OUTDIR/err
+done
+# Giving one for data compressed without one is harmless
+pngrecon decode --zdict $OUTDIR/dict -i $OUTDIR/plain.png >/dev/null
+# Only zlib can use one
+for C in "no" "xz"; do
+    ! pngrecon encode -c $C --zdict $OUTDIR/dict -i $F -o $OUTDIR/o.png \
+        2> $OUTDIR/err
+    grep --quiet "only works with -c gzip" $OUTDIR/err
+done
+
+# The async API can use one too
+python3 - $OUTDIR/dict $F 2> $OUTDIR/err <<'PYEOF'
+import asyncio
+import sys
+from pngrecon import aio
+from pngrecon.lib.chunk import CompressMethod
+zdict = open(sys.argv[1], 'rb').read()
+data = open(sys.argv[2], 'rb').read()
+
+
+class Sink():
+    def __init__(self):
+        self.b = bytearray()
+
+    def write(self, b):
+        self.b += b
+
+    async def drain(self):
+        pass
+
+
+async def run(func, data, **kw):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    sink = Sink()
+    await func(reader, sink, **kw)
+    return bytes(sink.b)
+
+
+async def main():
+    image = await run(aio.encode, data, compress_method=CompressMethod.Zlib,
+                      zdict=zdict)
+    assert await run(aio.decode, image, zdict=zdict) == data
+    try:
+        await run(aio.decode, image)
+    except aio.PngreconError as e:
+        assert 'Give --zdict' in str(e)
+    else:
+        assert False
+asyncio.run(main())
+PYEOF
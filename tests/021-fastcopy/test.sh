@@ -0,0 +1,73 @@
+set -eu
+OUTDIR="$1"
+
+# Plain data from a regular file is copied by the kernel. From a pipe it goes
+# through Python. Either way the image is the same.
+head -c 3000000 /dev/urandom > $OUTDIR/input
+for ARGS in "" "--manifest" "--parity 3:1" "--index-first"; do
+    [[ "$ARGS" == --parity* ]] && ! python3 -c 'import numpy' 2>/dev/null \
+        && continue
+    pngrecon encode --buffer-max-bytes 500000 $ARGS -i $OUTDIR/input \
+        -o $OUTDIR/file.png
+    cat $OUTDIR/input | pngrecon encode --buffer-max-bytes 500000 $ARGS \
+        -o $OUTDIR/pipe.png
+    cmp $OUTDIR/file.png $OUTDIR/pipe.png
+    # And so is what's decoded from it
+    pngrecon decode -i $OUTDIR/file.png -o $OUTDIR/output
+    cmp $OUTDIR/input $OUTDIR/output
+    pngrecon decode -i $OUTDIR/file.png | cmp - $OUTDIR/input
+    pngrecon decode --stream -i $OUTDIR/file.png | cmp - $OUTDIR/input
+done
+pngrecon verify -q $OUTDIR/file.png
+
+# Appending plain data, and an empty input
+pngrecon encode -i /dev/null -o $OUTDIR/file.png
+pngrecon append -i $OUTDIR/input $OUTDIR/file.png
+seq 1 1000 > $OUTDIR/more
+pngrecon append -i $OUTDIR/more $OUTDIR/file.png
+pngrecon decode -i $OUTDIR/file.png | cmp - <(cat $OUTDIR/input $OUTDIR/more)
+
+# Damaged data is still noticed, and still decoded as it is
+python3 - $OUTDIR/file.png <<'PYEOF'
+import sys
+from pngrecon.lib.chunk import ChunkType
+from pngrecon.lib.layout import scan_image_stream
+fname = sys.argv[1]
+with open(fname, 'rb') as fd:
+    layout = scan_image_stream(fd)
+h = [h for h in layout if h.type == ChunkType.Data.value][0]
+with open(fname, 'r+b') as fd:
+    fd.seek(h.crc_offset - 1, 0)
+    b = fd.read(1)
+    fd.seek(h.crc_offset - 1, 0)
+    fd.write(bytes([b[0] ^ 1]))
+PYEOF
+pngrecon decode -i $OUTDIR/file.png -o $OUTDIR/output 2> $OUTDIR/err
+grep --quiet "CRC that doesn't match" $OUTDIR/err
+! cmp --quiet $OUTDIR/output <(cat $OUTDIR/input $OUTDIR/more)
+
+# Files that say they're empty, like those in procfs, are read anyway
+pngrecon encode -i /proc/version -o $OUTDIR/proc.png
+pngrecon decode -i $OUTDIR/proc.png | cmp - /proc/version
+
+# When the kernel copies nothing from a file with data left, as it does on
+# some filesystems, plain reads carry on
+python3 - $OUTDIR/input <<'PYEOF'
+import os
+import sys
+import tempfile
+from pngrecon.util import fastcopy
+os.copy_file_range = lambda *args: 0
+os.sendfile = lambda *args: 0
+with open(sys.argv[1], 'rb') as fd, tempfile.TemporaryFile() as out:
+    fastcopy.copy_range(fd.fileno(), out.fileno(), 1000, 2000000)
+    out.seek(0, 0)
+    fd.seek(1000, 0)
+    assert out.read() == fd.read(2000000)
+    try:
+        fastcopy.copy_range(fd.fileno(), out.fileno(), 0, 4000000)
+    except EOFError:
+        pass
+    else:
+        assert False, 'no EOFError'
+PYEOF
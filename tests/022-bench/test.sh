@@ -0,0 +1,56 @@
+set -eu
+OUTDIR="$1"
+export PNGRECON_CONFIG=$OUTDIR/config.ini
+
+# Recommends settings from among the ones tried, saving them where encode and
+# decode read their defaults from
+head -c 600000 /dev/urandom > $OUTDIR/input
+pngrecon bench -c gzip -c no --compress-level 1 --sample-bytes 300000 \
+    > $OUTDIR/o 2> $OUTDIR/err
+grep --quiet "Trying 4 settings on 300000 bytes of synthetic data" $OUTDIR/err
+grep --quiet "^\[encode\]" $OUTDIR/o
+[ ! -e $PNGRECON_CONFIG ]
+pngrecon bench -i $OUTDIR/input -c gzip --buffer-max-bytes 65536 \
+    --buffer-max-bytes 131072 --save -e > $OUTDIR/o 2> $OUTDIR/err
+grep --quiet "on 600000 bytes of $OUTDIR/input" $OUTDIR/err
+grep --quiet "^compress = gzip" $PNGRECON_CONFIG
+grep --quiet "^buffer_max_bytes = \(65536\|131072\)" $PNGRECON_CONFIG
+grep --quiet "^\[decode\]" $PNGRECON_CONFIG
+! pngrecon bench -c gzip --sample-bytes 300000 --memory-budget-bytes 1 \
+    > /dev/null 2> $OUTDIR/err
+grep --quiet "fit in a memory budget of 1 bytes" $OUTDIR/err
+
+# Settings are defaults, which the command line still overrides
+cat > $PNGRECON_CONFIG <<EOF
+[encode]
+compress = xz
+compress_level = 0
+buffer_max_bytes = 100000
+pipeline = True
+
+[decode]
+buffer_max_bytes = 100000
+pipeline = True
+EOF
+pngrecon encode -h | grep --quiet "(default: 100000)"
+pngrecon encode -i $OUTDIR/input -o $OUTDIR/o.png
+pngrecon info $OUTDIR/o.png | grep "CompressMethod.Lzma" > /dev/null
+[ $(pngrecon info $OUTDIR/o.png | grep -c "ChunkType.Data") -ge 6 ]
+pngrecon decode -i $OUTDIR/o.png | cmp - $OUTDIR/input
+pngrecon encode -c no --buffer-max-bytes 1000000 -i $OUTDIR/input \
+    -o $OUTDIR/o.png
+pngrecon info $OUTDIR/o.png | grep "CompressMethod.No" > /dev/null
+[ $(pngrecon info $OUTDIR/o.png | grep -c "ChunkType.Data") -eq 1 ]
+pngrecon decode -i $OUTDIR/o.png | cmp - $OUTDIR/input
+
+# Mistakes in the settings file are pointed out
+for SETTING in "bogus = 1" "pipeline = maybe" "compress = zip" \
+        "buffer_max_bytes = lots"; do
+    printf "[encode]\n$SETTING\n" > $PNGRECON_CONFIG
+    ! pngrecon encode -i $OUTDIR/input -o $OUTDIR/o.png 2> $OUTDIR/err
+    grep --quiet "in \[encode\] of $PNGRECON_CONFIG" $OUTDIR/err
+done
+rm $PNGRECON_CONFIG
+! pngrecon encode --compress-level 10 -c gzip -i $OUTDIR/input \
+    -o $OUTDIR/o.png 2> $OUTDIR/err
+grep --quiet "from 0 to 9" $OUTDIR/err
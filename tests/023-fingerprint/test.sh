@@ -0,0 +1,104 @@
+set -eu
+OUTDIR="$1"
+KEY=$OUTDIR/key
+printf hunter2 > $KEY
+
+head -c 300000 /dev/urandom > $OUTDIR/input
+cp $OUTDIR/input $OUTDIR/same
+cp $OUTDIR/input $OUTDIR/changed
+head -c 1000 /dev/zero | dd of=$OUTDIR/changed bs=1000 seek=150 conv=notrunc \
+    2> /dev/null
+head -c 299999 $OUTDIR/input > $OUTDIR/short
+
+# Whatever it was encoded with, the local file alone is enough to tell
+for OPTS in "-c no" "-c gzip" "-c xz -e --key-file $KEY" \
+        "-c gzip --pipeline --buffer-max-bytes 65536"; do
+    pngrecon encode $OPTS -i $OUTDIR/input -o $OUTDIR/o.png
+    [ "$(pngrecon compare --key-file $KEY $OUTDIR/same $OUTDIR/o.png)" \
+        == same ]
+    ! pngrecon compare --key-file $KEY $OUTDIR/changed $OUTDIR/o.png \
+        > $OUTDIR/out
+    [ "$(cat $OUTDIR/out)" == different ]
+    [ "$(cat $OUTDIR/input | pngrecon compare --key-file $KEY /dev/stdin \
+        $OUTDIR/o.png)" == same ]
+done
+cat $OUTDIR/input | pngrecon encode -c gzip -o $OUTDIR/o.png
+pngrecon compare $OUTDIR/same $OUTDIR/o.png > /dev/null
+
+# Unencrypted, it's the SHA-256 of the data. A file of the wrong size doesn't
+# even need the key.
+pngrecon encode -i $OUTDIR/input -o $OUTDIR/o.png
+pngrecon info $OUTDIR/o.png | grep \
+    "300000 bytes of data with DigestType.Sha256 $(sha256sum $OUTDIR/input | \
+    cut -d ' ' -f 1), in the first 1 data chunks" > /dev/null
+pngrecon encode -e --key-file $KEY -i $OUTDIR/input -o $OUTDIR/o.png
+pngrecon info $OUTDIR/o.png | grep "DigestType.HmacSha256" > /dev/null
+! pngrecon compare $OUTDIR/short $OUTDIR/o.png > $OUTDIR/out
+[ "$(cat $OUTDIR/out)" == different ]
+printf hunter3 > $OUTDIR/wrongkey
+! pngrecon compare --key-file $OUTDIR/wrongkey $OUTDIR/same $OUTDIR/o.png \
+    > /dev/null 2> $OUTDIR/err
+grep --quiet "Unable to decrypt" $OUTDIR/err
+
+# Appended data isn't covered, and images without a fingerprint can still be
+# compared by decoding them
+head -c 1000 /dev/urandom > $OUTDIR/more
+cat $OUTDIR/input $OUTDIR/more > $OUTDIR/both
+pngrecon append --key-file $KEY -i $OUTDIR/more $OUTDIR/o.png
+! pngrecon compare --key-file $KEY $OUTDIR/both $OUTDIR/o.png 2> $OUTDIR/err
+grep --quiet "has had data appended" $OUTDIR/err
+[ "$(pngrecon compare --decode --key-file $KEY $OUTDIR/both $OUTDIR/o.png \
+    2> /dev/null)" == same ]
+! pngrecon compare --decode --key-file $KEY $OUTDIR/same $OUTDIR/o.png \
+    > /dev/null 2>&1
+pngrecon encode --no-fingerprint -i $OUTDIR/input -o $OUTDIR/o.png
+! pngrecon info $OUTDIR/o.png | grep "ChunkType.Fingerprint" > /dev/null
+! pngrecon compare $OUTDIR/same $OUTDIR/o.png 2> $OUTDIR/err
+grep --quiet "has no fingerprint" $OUTDIR/err
+[ "$(pngrecon compare --decode $OUTDIR/same $OUTDIR/o.png 2> /dev/null)" \
+    == same ]
+! pngrecon compare --decode $OUTDIR/short $OUTDIR/o.png > /dev/null 2>&1
+
+# The catalog knows how much data a fingerprinted image holds
+pngrecon encode -c gzip -i $OUTDIR/input -o $OUTDIR/o.png
+pngrecon index --catalog $OUTDIR/catalog.sqlite3 $OUTDIR/o.png 2> /dev/null
+pngrecon info --catalog $OUTDIR/catalog.sqlite3 $OUTDIR/o.png | \
+    grep "300000 bytes of data" > /dev/null
+
+# So do images from the pool and from pngrecon.aio
+if python3 -c 'import numpy' 2>/dev/null; then
+    pngrecon encode --pool $OUTDIR/pool -i $OUTDIR/input -o $OUTDIR/o.png \
+        2> /dev/null
+    pngrecon compare $OUTDIR/same $OUTDIR/o.png > /dev/null
+fi
+python3 - $OUTDIR/input $OUTDIR/o.png <<'PYEOF'
+import asyncio
+import sys
+import pngrecon.aio
+
+
+async def main(in_fname, out_fname):
+    with open(in_fname, 'rb') as fd:
+        data = fd.read()
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+
+    class Writer():
+        def __init__(self):
+            self.buf = bytearray()
+
+        def write(self, b):
+            self.buf += b
+
+        async def drain(self):
+            pass
+    writer = Writer()
+    await pngrecon.aio.encode(reader, writer, password=b'hunter2')
+    with open(out_fname, 'wb') as fd:
+        fd.write(writer.buf)
+
+
+asyncio.run(main(*sys.argv[1:]))
+PYEOF
+[ "$(pngrecon compare --key-file $KEY $OUTDIR/same $OUTDIR/o.png)" == same ]
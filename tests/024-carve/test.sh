@@ -0,0 +1,75 @@
+set -eu
+OUTDIR="$1"
+KEY=$OUTDIR/key
+printf hunter2 > $KEY
+
+head -c 200000 /dev/urandom > $OUTDIR/a
+head -c 300000 /dev/urandom > $OUTDIR/b
+head -c 100000 /dev/urandom > $OUTDIR/c
+pngrecon encode -i $OUTDIR/a -o $OUTDIR/a.png
+pngrecon encode -c gzip -e --key-file $KEY -i $OUTDIR/b -o $OUTDIR/b.png
+pngrecon encode --buffer-max-bytes 30000 -i $OUTDIR/c -o $OUTDIR/c.png
+# An image that lost its signature, whose chunks can still be salvaged
+cp $OUTDIR/c.png $OUTDIR/damaged.png
+printf 'XXXXXXXX' | dd of=$OUTDIR/damaged.png conv=notrunc 2> /dev/null
+# A PNG with none of our data
+python3 - $OUTDIR/plain.png <<'PYEOF'
+import struct
+import sys
+import zlib
+
+
+def chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+with open(sys.argv[1], 'wb') as fd:
+    fd.write(b'\x89PNG\r\n\x1a\n')
+    fd.write(chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)))
+    fd.write(chunk(b'IDAT', zlib.compress(b'\0\0')))
+    fd.write(chunk(b'IEND', b''))
+PYEOF
+{
+    head -c 4093 /dev/urandom
+    cat $OUTDIR/a.png
+    head -c 5000 /dev/urandom
+    cat $OUTDIR/plain.png $OUTDIR/b.png
+    head -c 777 /dev/urandom
+    cat $OUTDIR/damaged.png
+    head -c 3000 /dev/urandom
+} > $OUTDIR/blob
+
+# Everything is found however the input is split between workers, including
+# images that straddle regions
+pngrecon carve --all -j 1 $OUTDIR/blob > $OUTDIR/expected 2> /dev/null
+[ $(grep -c " image$" $OUTDIR/expected) -eq 2 ]
+[ $(grep -c " png$" $OUTDIR/expected) -eq 1 ]
+[ $(grep -c " salvaged$" $OUTDIR/expected) -eq 1 ]
+grep --quiet "^4093 $(stat -c %s $OUTDIR/a.png) image$" $OUTDIR/expected
+for REGION in 4096 5000 65536; do
+    pngrecon carve --all -j 2 --region-bytes $REGION $OUTDIR/blob \
+        2> /dev/null | cmp - $OUTDIR/expected
+done
+
+# What's extracted decodes to what was encoded
+rm -rf $OUTDIR/out
+pngrecon carve -o $OUTDIR/out --region-bytes 4096 $OUTDIR/blob \
+    > $OUTDIR/o 2> $OUTDIR/err
+grep --quiet "Found 2 pngrecon images, 1 other PNGs, and 1 runs" $OUTDIR/err
+[ $(ls $OUTDIR/out | wc -l) -eq 3 ]
+cmp $OUTDIR/out/4093.png $OUTDIR/a.png
+for F in $OUTDIR/out/*; do
+    pngrecon decode --key-file $KEY -i $F > $OUTDIR/decoded
+    cmp --silent $OUTDIR/decoded $OUTDIR/a || \
+        cmp --silent $OUTDIR/decoded $OUTDIR/b || \
+        cmp --silent $OUTDIR/decoded $OUTDIR/c
+done
+pngrecon decode -i $OUTDIR/out/*-salvaged.png | cmp - $OUTDIR/c
+
+# Images stored whole inside another aren't found separately
+pngrecon encode -c no -i $OUTDIR/a.png -o $OUTDIR/outer.png
+[ "$(pngrecon carve $OUTDIR/outer.png 2> /dev/null)" == \
+    "0 $(stat -c %s $OUTDIR/outer.png) image" ]
+: > $OUTDIR/empty
+! pngrecon carve $OUTDIR/empty 2> /dev/null
@@ -0,0 +1,92 @@
+set -eu
+OUTDIR="$1"
+KEY=$OUTDIR/key
+printf hunter2 > $KEY
+OUT=$OUTDIR/o.png
+
+head -c 2000000 /dev/urandom > $OUTDIR/input
+python3 -c "print('hello world ' * 100000)" >> $OUTDIR/input
+
+# Checkpointed encodes decode the same as any other, however they're stored
+for OPTS in "" "-c gzip" "-c xz -e --key-file $KEY" \
+        "-c gzip --manifest --parity 3:1 --index-first --pipeline"; do
+    pngrecon encode $OPTS --resume --checkpoint-bytes 300000 \
+        --buffer-max-bytes 100000 -i $OUTDIR/input -o $OUT
+    [ ! -e $OUT.resume ]
+    pngrecon decode --key-file $KEY -i $OUT | cmp - $OUTDIR/input
+    [ "$(pngrecon compare --key-file $KEY $OUTDIR/input $OUT)" == same ]
+done
+pngrecon verify $OUT > /dev/null
+
+# Kill an encode after its first checkpoint, leaving part of a chunk after
+# it, and it carries on from there
+head -c 8000000 /dev/urandom > $OUTDIR/input
+OPTS="-c xz -e --key-file $KEY --manifest --resume --checkpoint-bytes 1000000"
+pngrecon encode $OPTS -i $OUTDIR/input -o $OUT &
+PID=$!
+until grep --quiet '"input_offset": [1-9]' $OUT.resume 2> /dev/null; do
+    sleep 0.05
+done
+kill -9 $PID
+! { wait $PID; } 2> /dev/null
+head -c 5000 /dev/urandom >> $OUT
+cp $OUT $OUTDIR/partial.png
+cp $OUT.resume $OUTDIR/partial.png.resume
+
+# Only with the same settings and key
+! pngrecon encode ${OPTS/xz/gzip} -i $OUTDIR/input -o $OUT 2> $OUTDIR/err
+grep --quiet "had different compress" $OUTDIR/err
+printf hunter3 > $OUTDIR/wrongkey
+! pngrecon encode ${OPTS/$KEY/$OUTDIR/wrongkey} -i $OUTDIR/input -o $OUT \
+    2> $OUTDIR/err
+grep --quiet "Unable to decrypt" $OUTDIR/err
+
+pngrecon encode $OPTS -i $OUTDIR/input -o $OUT 2> $OUTDIR/err
+grep --quiet "Resuming from [1-9][0-9]* of 8000000 bytes" $OUTDIR/err
+[ ! -e $OUT.resume ]
+pngrecon decode --key-file $KEY -i $OUT | cmp - $OUTDIR/input
+pngrecon verify $OUT > /dev/null
+[ "$(pngrecon compare --key-file $KEY $OUTDIR/input $OUT)" == same ]
+
+# Damage before the last checkpoint isn't carried on with
+cp $OUTDIR/partial.png $OUT
+cp $OUTDIR/partial.png.resume $OUT.resume
+# In the last frame, since only its CRCs are checked
+DAMAGE=$(python3 -c 'import json, sys
+print(json.load(sys.stdin)["output_offset"] - 100)' < $OUT.resume)
+printf 'XXXX' | dd of=$OUT bs=1 seek=$DAMAGE conv=notrunc 2> /dev/null
+! pngrecon encode $OPTS -i $OUTDIR/input -o $OUT 2> $OUTDIR/err
+grep --quiet "Can't resume: .* has a damaged chunk" $OUTDIR/err
+
+# Make $OUT look like it was interrupted before any data was written, with
+# the given key_check setting
+function rewind {
+    python3 - $OUT $OUTDIR/partial.png.resume $1 <<'PYEOF'
+import json
+import sys
+image, resume, key_check = sys.argv[1:]
+b = open(image, 'rb').read()
+head_end = b.index(b'maTt') - 4
+d = json.load(open(resume))
+d['settings']['key_check'] = key_check == '1'
+d.update(salt=b[b.index(b'yyBo') + 4:][:16].hex(), input_offset=0,
+         num_data_chunks=0, output_offset=head_end, frame_offset=head_end)
+json.dump(d, open(image + '.resume', 'w'))
+PYEOF
+}
+# Then, only a key check value can tell whether the key is the one it was
+# started with, so without one it isn't carried on with
+cp $OUTDIR/partial.png $OUT
+rewind 0
+! pngrecon encode $OPTS -i $OUTDIR/input -o $OUT 2> $OUTDIR/err
+grep --quiet "Can't resume: there's nothing in" $OUTDIR/err
+# With one, a wrong key is turned away and the right one carries on
+rm $OUT.resume
+pngrecon encode $OPTS --key-check -i $OUTDIR/input -o $OUT
+rewind 1
+! pngrecon encode ${OPTS/$KEY/$OUTDIR/wrongkey} --key-check \
+    -i $OUTDIR/input -o $OUT 2> $OUTDIR/err
+grep --quiet "Passphrase appears to be incorrect" $OUTDIR/err
+pngrecon encode $OPTS --key-check -i $OUTDIR/input -o $OUT 2> $OUTDIR/err
+grep --quiet "Resuming from 0 of 8000000 bytes" $OUTDIR/err
+pngrecon decode --key-file $KEY -i $OUT | cmp - $OUTDIR/input
@@ -5,6 +5,9 @@ function finish {
     rm -rf $T
 }
 trap finish EXIT
+# Don't let the defaults in the user's settings file (see `pngrecon bench`)
+# change what the tests do
+export PNGRECON_CONFIG=
 
 base="$(dirname $0)"
 pushd $base>/dev/null